@@ -0,0 +1,165 @@
+"""
+This module offers the policies that choose which producer a consumer buys from.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+
+import heapq
+import random
+
+
+class AllocationPolicy:
+    """
+    Class that chooses, among the producers that have a product in stock, the one
+    add_to_cart() takes the next units from. The marketplace calls its methods while
+    holding the lock of the product's stripe, so the state of a product is never
+    changed by two threads at once.
+    """
+    def pick(self, product_id, holders, stock):
+        """
+        Returns the producer the next units of the product are taken from.
+
+        :type product_id: Int
+        :param product_id: the id of the product
+
+        :type holders: Dict
+        :param holders: producer id -> None, for the producers that have the product in
+        stock, in the order they stocked it. It is never empty
+
+        :type stock: List
+        :param stock: the inventory matrix, stock[producer id][product id] -> quantity
+
+        :rtype: Int
+        :return: the producer id
+        """
+        raise NotImplementedError
+
+    def stocked(self, product_id, producer_id, quantity):
+        """
+        Tells the policy that the quantity of the product in a producer's queue changed.
+
+        :type product_id: Int
+        :param product_id: the id of the product
+
+        :type producer_id: Int
+        :param producer_id: the producer
+
+        :type quantity: Int
+        :param quantity: the new quantity
+        """
+
+
+class FirstFit(AllocationPolicy):
+    """
+    Policy that takes from the producer with the lowest id that has the product in
+    stock. Every product has a min heap of producer ids, holding every producer once,
+    and the producers that ran out are dropped when they reach the top.
+    """
+    def __init__(self):
+        """
+        Constructor
+        """
+        # product id -> heap of producer ids, and the set of the ids in the heap
+        self.heaps = {}
+        self.members = {}
+
+    def pick(self, product_id, holders, stock):
+        heap = self.heaps.get(product_id, [])
+        members = self.members.get(product_id, set())
+
+        while heap:
+            if heap[0] in holders:
+                return heap[0]
+            members.discard(heapq.heappop(heap))
+
+        return min(holders)
+
+    def stocked(self, product_id, producer_id, quantity):
+        members = self.members.setdefault(product_id, set())
+        if quantity > 0 and producer_id not in members:
+            members.add(producer_id)
+            heapq.heappush(self.heaps.setdefault(product_id, []), producer_id)
+
+
+class OldestStock(AllocationPolicy):
+    """
+    Policy that takes from the producer that has stocked the product the longest: the
+    first of the holders, which are kept in the order they stocked it.
+    """
+    def pick(self, product_id, holders, stock):
+        return next(iter(holders))
+
+
+class RoundRobin(AllocationPolicy):
+    """
+    Policy that takes from the producers that have the product in turn. The chosen
+    producer is moved to the end of the holders, so the next pick is the one after it.
+    """
+    def pick(self, product_id, holders, stock):
+        producer_id = next(iter(holders))
+        del holders[producer_id]
+        holders[producer_id] = None
+        return producer_id
+
+
+class MostStocked(AllocationPolicy):
+    """
+    Policy that takes from the producer with the most units of the product, so the
+    fullest queues are the first to get free space. Every product has a max heap of
+    (quantity, producer id) entries, and the entries that are no longer true are
+    dropped when they reach the top.
+    """
+    def __init__(self):
+        """
+        Constructor
+        """
+        # product id -> heap of (-quantity, producer id)
+        self.heaps = {}
+
+    def pick(self, product_id, holders, stock):
+        heap = self.heaps.get(product_id)
+
+        # The heap is missing or too stale, rebuild it from the holders
+        if heap is None or len(heap) > 4 * len(holders) + 16:
+            heap = self.heaps[product_id] = [(-stock[producer_id][product_id], producer_id)
+                                             for producer_id in holders]
+            heapq.heapify(heap)
+
+        while heap:
+            quantity, producer_id = heap[0]
+            if producer_id in holders and stock[producer_id][product_id] == -quantity:
+                return producer_id
+            heapq.heappop(heap)
+
+        return next(iter(holders))
+
+    def stocked(self, product_id, producer_id, quantity):
+        if quantity > 0:
+            heapq.heappush(self.heaps.setdefault(product_id, []), (-quantity, producer_id))
+
+
+class RandomPick(AllocationPolicy):
+    """
+    Policy that takes from a random producer that has the product.
+    """
+    def __init__(self, seed=None):
+        """
+        Constructor
+
+        :type seed: Int
+        :param seed: the seed of the random choices
+        """
+        self.rng = random.Random(seed)
+
+    def pick(self, product_id, holders, stock):
+        if len(holders) == 1:
+            return next(iter(holders))
+
+        return self.rng.choice(list(holders))
+
+
+# The policies by name
+POLICIES = {'first_fit': FirstFit, 'oldest_stock': OldestStock, 'round_robin': RoundRobin,
+            'most_stocked': MostStocked, 'random': RandomPick}
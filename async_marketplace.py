@@ -0,0 +1,630 @@
+"""
+This module represents the asyncio Marketplace, with its Producer and Consumer.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+
+import asyncio
+import unittest
+
+from marketplace_log import CallSampler, setup_logging
+from order_sink import StdoutSink
+
+
+def current_name():
+    """
+    Returns the name of the task that is running, used in the logs and receipts.
+
+    :rtype: str
+    :return: the name of the current task
+    """
+    task = asyncio.current_task()
+    return task.get_name() if task is not None else "main"
+
+
+class AsyncMarketplace:
+    """
+    Class that represents the asyncio Marketplace. It has the same operations as the
+    Marketplace, as coroutines, so many producers and consumers can run as tasks of
+    a single event loop instead of one thread each.
+
+    All the tasks run on the same thread and no operation awaits in the middle of
+    changing the queues or the carts, so no locks are needed. The conditions are only
+    used to wait for stock and for free space in a producer's queue.
+    """
+    def __init__(self, queue_size_per_producer, log_sampling=None, order_sink=None):
+        """
+        Constructor
+
+        :type queue_size_per_producer: Int
+        :param queue_size_per_producer: the maximum size of a queue associated with each producer
+
+        :type log_sampling: Dict
+        :param log_sampling: method name -> fraction of its calls to log
+
+        :type order_sink: OrderSink
+        :param order_sink: where the placed orders are written, stdout by default
+        """
+        # Initialize the Marketplace
+        self.queue_size_per_producer = queue_size_per_producer
+
+        # Initialize the producers list
+        self.producers = []
+
+        # Initialize the per producer index: product -> [product, quantity] entry
+        self.producers_index = []
+
+        # Initialize the inventory index: product -> {producer id: [product, quantity] entry}
+        # Only the producers that currently have the product in stock are kept
+        self.stock_index = {}
+
+        # Initialize the total number of elements a producer published
+        self.total_producers_elements = []
+
+        # Initialize the costumer's cart list
+        self.consumers_carts = []
+
+        # Initialize the conditions used to wait for a product, created when first needed
+        self.stock_conditions = {}
+
+        # Initialize the conditions used to wait for free space in a producer's queue
+        self.capacity_conditions = []
+
+        # Initialize the sink of the placed orders
+        self.order_sink = order_sink if order_sink is not None else StdoutSink()
+
+        # Initialize the logger and the sampling of the logged calls
+        self.logger = setup_logging()
+        self.sample_log = CallSampler(self.logger, log_sampling)
+
+    async def register_producer(self):
+        """
+        Returns an id for the producer that calls this.
+        """
+        # Log the call
+        log = self.sample_log("register_producer")
+        if log:
+            self.logger.info("register_producer() called by %s", current_name())
+
+        # Add a new producer
+        self.capacity_conditions.append(asyncio.Condition())
+        self.total_producers_elements.append(0)
+        self.producers_index.append({})
+        self.producers.append([])
+
+        # Log the exit
+        if log:
+            self.logger.info("register_producer() exited by %s", current_name())
+
+        # Return the index of the new producer in the producers list
+        return len(self.producers) - 1
+
+    async def publish(self, producer_id, product, timeout=0):
+        """
+        Adds the product provided by the producer to the marketplace
+
+        :type producer_id: Int
+        :param producer_id: producer id
+
+        :type product: Product
+        :param product: the Product that will be published in the Marketplace
+
+        :type timeout: Float
+        :param timeout: the number of seconds to wait for free space in the producer's queue.
+        0 does not wait, None waits until there is space
+
+        :returns True or False. If the caller receives False, it should wait and then try again.
+        """
+        return await self.publish_many(producer_id, product, 1, timeout) == 1
+
+    async def publish_many(self, producer_id, product, quantity, timeout=0):
+        """
+        Adds up to quantity units of the product provided by the producer to the marketplace.
+
+        :type producer_id: Int
+        :param producer_id: producer id
+
+        :type product: Product
+        :param product: the Product that will be published in the Marketplace
+
+        :type quantity: Int
+        :param quantity: the number of units to publish
+
+        :type timeout: Float
+        :param timeout: the number of seconds to wait for free space in the producer's queue.
+        0 does not wait, None waits until there is space
+
+        :returns the number of units published
+        """
+        # Log the call with the parameters
+        log = self.sample_log("publish")
+        if log:
+            self.logger.info("publish() called by %s with parameters: %s, %s, %s",
+                             current_name(), producer_id, product, quantity)
+
+        # Check if producer_id is valid
+        if producer_id < 0 or producer_id >= len(self.producers) or quantity <= 0:
+            return 0
+
+        def free_space():
+            return self.queue_size_per_producer - self.total_producers_elements[producer_id]
+
+        # Wait for free space in the producer's queue
+        if not await self._wait(self.capacity_conditions[producer_id],
+                                lambda: free_space() > 0, timeout):
+            return 0
+
+        published = min(quantity, free_space())
+        self._restock(producer_id, product, published)
+
+        # Wake up the consumers waiting for the product
+        await self._notify(self.stock_conditions.get(product))
+
+        # Log the exit
+        if log:
+            self.logger.info("publish() exited by %s", current_name())
+
+        return published
+
+    async def new_cart(self):
+        """
+        Creates a new cart for the consumer
+
+        :returns an int representing the cart_id
+        """
+        # Add a new cart in the costumer's cart list
+        self.consumers_carts.append([])
+
+        # Log the creation
+        log = self.sample_log("new_cart")
+        if log:
+            self.logger.info("new_cart() called by %s", current_name())
+
+        # Return the index of the new cart in the costumer's cart list
+        return len(self.consumers_carts) - 1
+
+    async def add_to_cart(self, cart_id, product, timeout=0, quantity=None):
+        """
+        Adds a product to the given cart.
+
+        :type cart_id: Int
+        :param cart_id: id cart
+
+        :type product: Product
+        :param product: the product to add to cart
+
+        :type timeout: Float
+        :param timeout: the number of seconds to wait for the product to be published.
+        0 does not wait, None waits until the product is in stock
+
+        :type quantity: Int
+        :param quantity: the number of units to add. If it is given, the method returns
+        the number of units added instead of True or False
+
+        :returns True or False. If the caller receives False, it should wait and then try again
+        """
+        # Log the call with the parameters
+        log = self.sample_log("add_to_cart")
+        if log:
+            self.logger.info("add_to_cart() called by %s with parameters: %s, %s",
+                             current_name(), cart_id, product)
+
+        wanted = 1 if quantity is None else quantity
+        added = 0
+
+        # Check if the cart_id is valid and wait for the product to be published
+        if 0 <= cart_id < len(self.consumers_carts) and wanted > 0:
+            condition = self.stock_conditions.get(product)
+            if condition is None:
+                condition = self.stock_conditions[product] = asyncio.Condition()
+
+            if await self._wait(condition, lambda: self.stock_index.get(product), timeout):
+                # Take the product from the producers that have it in stock
+                taken = self._take_stock(product, wanted)
+
+                # Add it to cart
+                cart = self.consumers_carts[cart_id]
+                for producer_index, count in taken:
+                    cart.extend([product, producer_index] for _ in range(count))
+                    added += count
+
+                # Wake up the producers waiting for free space in their queue
+                for producer_index, _ in taken:
+                    await self._notify(self.capacity_conditions[producer_index])
+
+        # Log the exit
+        if log:
+            self.logger.info("add_to_cart() exited by %s", current_name())
+
+        if quantity is None:
+            return added == 1
+
+        return added
+
+    async def remove_from_cart(self, cart_id, product, quantity=None):
+        """
+        Removes a product from cart.
+
+        :type cart_id: Int
+        :param cart_id: id cart
+
+        :type product: Product
+        :param product: the product to remove from cart
+
+        :type quantity: Int
+        :param quantity: the number of units to remove. If it is given, the method returns
+        the number of units removed
+        """
+        # Log the call with the parameters
+        log = self.sample_log("remove_from_cart")
+        if log:
+            self.logger.info("remove_from_cart() called by %s with parameters: %s, %s",
+                             current_name(), cart_id, product)
+
+        wanted = 1 if quantity is None else quantity
+        removed = 0
+
+        # Check if the cart_id is valid
+        if 0 <= cart_id < len(self.consumers_carts) and wanted > 0:
+            cart = self.consumers_carts[cart_id]
+
+            # Find the first units of the product in the cart and their producers
+            returned = {}
+            kept = []
+            for element in cart:
+                if removed < wanted and element[0] == product:
+                    returned[element[1]] = returned.get(element[1], 0) + 1
+                    removed += 1
+                else:
+                    kept.append(element)
+
+            # Add the product back to the producers' queues
+            cart[:] = kept
+            for producer_index, count in returned.items():
+                self._restock(producer_index, product, count)
+
+            # Wake up the consumers waiting for the product
+            if returned:
+                await self._notify(self.stock_conditions.get(product))
+
+        # Log the exit
+        if log:
+            self.logger.info("remove_from_cart() exited by %s", current_name())
+
+        if quantity is None:
+            return None
+
+        return removed
+
+    async def place_order(self, cart_id):
+        """
+        Return a list with all the products in the cart.
+
+        :type cart_id: Int
+        :param cart_id: id cart
+        """
+        # Log the call with the parameters
+        log = self.sample_log("place_order")
+        if log:
+            self.logger.info("place_order() called by %s with parameters: %s",
+                             current_name(), cart_id)
+
+        # Check if the cart_id is valid
+        if cart_id < 0 or cart_id >= len(self.consumers_carts):
+            return False
+
+        # Get the cart and empty it
+        cart = self.consumers_carts[cart_id]
+        self.consumers_carts[cart_id] = []
+
+        # Write the receipt
+        self.order_sink.emit(current_name(), cart)
+
+        # Return the cart
+        return cart
+
+    def _restock(self, producer_id, product, quantity):
+        """
+        Adds units of the product to the producer's queue.
+
+        :type producer_id: Int
+        :param producer_id: the producer that owns the queue
+
+        :type product: Product
+        :param product: the product
+
+        :type quantity: Int
+        :param quantity: the number of units to add
+        """
+        # Check if the product is already in the producer's queue
+        entry = self.producers_index[producer_id].get(product)
+        if entry is None:
+            entry = [product, 0]
+            self.producers[producer_id].append(entry)
+            self.producers_index[producer_id][product] = entry
+
+        entry[1] += quantity
+        self.total_producers_elements[producer_id] += quantity
+        self.stock_index.setdefault(product, {})[producer_id] = entry
+
+    def _take_stock(self, product, quantity):
+        """
+        Removes up to quantity units of the product from the queues of the producers
+        that have it in stock.
+
+        :type product: Product
+        :param product: the product
+
+        :type quantity: Int
+        :param quantity: the number of units to take
+
+        :rtype: List
+        :return: a list of (producer id, number of units taken from it)
+        """
+        taken = []
+        holders = self.stock_index.get(product, {})
+
+        while quantity > 0 and holders:
+            producer_index, entry = next(iter(holders.items()))
+
+            # Remove the product from the producer's queue
+            count = min(quantity, entry[1])
+            entry[1] -= count
+            self.total_producers_elements[producer_index] -= count
+
+            # The producer ran out of the product
+            if entry[1] == 0:
+                del holders[producer_index]
+
+            taken.append((producer_index, count))
+            quantity -= count
+
+        if not holders:
+            self.stock_index.pop(product, None)
+
+        return taken
+
+    @staticmethod
+    async def _wait(condition, predicate, timeout):
+        """
+        Waits on a condition until the predicate is true.
+
+        :type condition: asyncio.Condition
+        :param condition: the condition that is notified when the predicate may change
+
+        :type predicate: Callable
+        :param predicate: the state to wait for
+
+        :type timeout: Float
+        :param timeout: the number of seconds to wait. 0 does not wait, None waits forever
+
+        :rtype: bool
+        :return: True if the predicate is true, False if the timeout expired
+        """
+        if timeout == 0 or predicate():
+            return bool(predicate())
+
+        async with condition:
+            try:
+                return bool(await asyncio.wait_for(condition.wait_for(predicate), timeout))
+            except asyncio.TimeoutError:
+                return False
+
+    @staticmethod
+    async def _notify(condition):
+        """
+        Wakes up the tasks waiting on a condition.
+
+        :type condition: asyncio.Condition
+        :param condition: the condition, or None if nobody ever waited on it
+        """
+        if condition is not None:
+            async with condition:
+                condition.notify_all()
+
+
+class AsyncProducer:
+    """
+    Class that represents a producer running as an asyncio task.
+    """
+
+    def __init__(self, products, marketplace, republish_wait_time, name=None):
+        """
+        Constructor.
+
+        :type products: List()
+        :param products: a list of products that the producer will produce
+
+        :type marketplace: AsyncMarketplace
+        :param marketplace: a reference to the marketplace
+
+        :type republish_wait_time: Time
+        :param republish_wait_time: the number of seconds that a producer must
+        wait until the marketplace becomes available
+
+        :type name: str
+        :param name: the name of the producer's task
+        """
+        self.products = products
+        self.marketplace = marketplace
+        self.republish_wait_time = republish_wait_time
+        self.name = name
+
+    def start(self):
+        """
+        Starts the producer as a task of the running event loop.
+
+        :rtype: asyncio.Task
+        :return: the task of the producer
+        """
+        return asyncio.create_task(self.run(), name=self.name)
+
+    async def run(self):
+        """
+        Publishes the products forever, like Producer.run().
+        """
+        producer_id = await self.marketplace.register_producer()
+        while True:
+            for (product, quantity, sleep_time) in self.products:
+                while quantity > 0:
+                    # Without a production time, the whole quantity can be published at once
+                    batch = quantity if sleep_time == 0 else 1
+
+                    # Wait at most republish_wait_time for free space in the queue
+                    published = await self.marketplace.publish_many(
+                        producer_id, product, batch, timeout=self.republish_wait_time)
+
+                    if published > 0:
+                        await asyncio.sleep(sleep_time)
+                        quantity -= published
+
+
+class AsyncConsumer:
+    """
+    Class that represents a consumer running as an asyncio task.
+    """
+
+    def __init__(self, carts, marketplace, retry_wait_time, name=None):
+        """
+        Constructor.
+
+        :type carts: List
+        :param carts: a list of add and remove operations
+
+        :type marketplace: AsyncMarketplace
+        :param marketplace: a reference to the marketplace
+
+        :type retry_wait_time: Time
+        :param retry_wait_time: the number of seconds that a consumer must wait
+        until the Marketplace becomes available
+
+        :type name: str
+        :param name: the name of the consumer's task
+        """
+        self.carts = carts
+        self.marketplace = marketplace
+        self.retry_wait_time = retry_wait_time
+        self.name = name
+
+    def start(self):
+        """
+        Starts the consumer as a task of the running event loop.
+
+        :rtype: asyncio.Task
+        :return: the task of the consumer
+        """
+        return asyncio.create_task(self.run(), name=self.name)
+
+    async def run(self):
+        """
+        Buys the carts, like Consumer.run().
+
+        :rtype: List
+        :return: the orders placed, one for each cart
+        """
+        orders = []
+
+        for carts in self.carts:
+            cart_id = await self.marketplace.new_cart()
+
+            for cart in carts:
+                op_type = cart['type']
+                product = cart['product']
+                quantity = cart['quantity']
+
+                while quantity > 0:
+                    if op_type == "add":
+                        # Wait at most retry_wait_time for the product to be published
+                        quantity -= await self.marketplace.add_to_cart(
+                            cart_id, product, timeout=self.retry_wait_time, quantity=quantity)
+                    elif op_type == "remove":
+                        await self.marketplace.remove_from_cart(cart_id, product,
+                                                                quantity=quantity)
+                        quantity = 0
+
+            # Buy the cart
+            orders.append(await self.marketplace.place_order(cart_id))
+
+        return orders
+
+
+class TestAsyncMarketplace(unittest.IsolatedAsyncioTestCase):
+    """
+    Test class for the AsyncMarketplace class.
+    """
+    async def test_add_to_cart(self):
+        """
+        Tests adding a published product to a cart.
+        """
+        market = AsyncMarketplace(10)
+        producer_id = await market.register_producer()
+        self.assertTrue(await market.publish(producer_id, "product1"))
+
+        cart_id = await market.new_cart()
+
+        # Verify that the product was added only once
+        self.assertTrue(await market.add_to_cart(cart_id, "product1"))
+        self.assertFalse(await market.add_to_cart(cart_id, "product1"))
+        self.assertEqual(market.consumers_carts[cart_id], [["product1", producer_id]])
+
+    async def test_add_to_cart_waits_for_publish(self):
+        """
+        Tests that add_to_cart() with a timeout returns as soon as the product is published.
+        """
+        market = AsyncMarketplace(10)
+        producer_id = await market.register_producer()
+        cart_id = await market.new_cart()
+
+        waiting = asyncio.create_task(market.add_to_cart(cart_id, "product1", timeout=10))
+        await asyncio.sleep(0)
+        await market.publish(producer_id, "product1")
+
+        # Verify that the waiting consumer got the product
+        self.assertTrue(await asyncio.wait_for(waiting, 5))
+        self.assertFalse(await market.add_to_cart(cart_id, "product1", timeout=0.01))
+
+    async def test_publish_waits_for_capacity(self):
+        """
+        Tests that publish() with a timeout returns as soon as the queue has space.
+        """
+        market = AsyncMarketplace(1)
+        producer_id = await market.register_producer()
+        self.assertTrue(await market.publish(producer_id, "product1"))
+        self.assertFalse(await market.publish(producer_id, "product1", timeout=0.01))
+
+        waiting = asyncio.create_task(market.publish(producer_id, "product1", timeout=10))
+        await asyncio.sleep(0)
+        cart_id = await market.new_cart()
+        await market.add_to_cart(cart_id, "product1")
+
+        # Verify that the waiting producer published the product
+        self.assertTrue(await asyncio.wait_for(waiting, 5))
+        self.assertEqual(market.total_producers_elements[producer_id], 1)
+
+    async def test_producers_and_consumers(self):
+        """
+        Tests that the consumers buy everything they want from the producers.
+        """
+        market = AsyncMarketplace(10)
+        producers = [AsyncProducer([("product1", 3, 0), ("product2", 1, 0.001)],
+                                   market, 0.01).start() for _ in range(2)]
+        carts = [[{"type": "add", "product": "product1", "quantity": 3},
+                  {"type": "remove", "product": "product1", "quantity": 1},
+                  {"type": "add", "product": "product2", "quantity": 1}]]
+        consumers = [AsyncConsumer(carts, market, 0.01, name="cons{}".format(i)).start()
+                     for i in range(3)]
+
+        orders = await asyncio.wait_for(asyncio.gather(*consumers), 10)
+        for producer in producers:
+            producer.cancel()
+
+        # Verify that every consumer bought two of product1 and one of product2
+        for order in orders:
+            self.assertEqual(sorted(element[0] for element in order[0]),
+                             ["product1", "product1", "product2"])
+
+
+if __name__ == '__main__':
+    unittest.main()
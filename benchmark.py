@@ -0,0 +1,1673 @@
+"""
+This module benchmarks the Marketplace.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+
+import argparse
+import asyncio
+from contextlib import redirect_stdout
+import io
+import json
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import tempfile
+import threading
+from threading import Lock, Thread
+import time
+import tracemalloc
+
+from allocation import POLICIES
+from async_marketplace import AsyncConsumer, AsyncMarketplace, AsyncProducer
+from capacity import CAPACITIES
+from clock import VirtualClock
+from consumer import Consumer, ConsumerExecutor
+from marketplace import Marketplace
+from order_sink import BufferSink, NullSink, StdoutSink
+from persistence import MarketplaceStore
+from producer import Producer, ProducerScheduler
+from product import Coffee, Tea
+from rpc import MarketplaceClient, MarketplaceServer
+from shared_marketplace import SharedMarketplace
+from sharded_marketplace import ShardedMarketplace
+from workload import CartStream, ProductCache, write_carts
+
+
+def quiet_marketplace(queue_size_per_producer):
+    """
+    Creates a marketplace that does not log, so the logging does not hide the
+    cost of the operations.
+
+    :type queue_size_per_producer: Int
+    :param queue_size_per_producer: the maximum size of a queue associated with each producer
+
+    :rtype: Marketplace
+    :return: the new marketplace
+    """
+    return Marketplace(queue_size_per_producer, log_level=logging.WARNING)
+
+
+def bench_add_to_cart_scaling(producer_counts=(1, 10, 100, 1000),
+                              products_per_producer=10, operations=20000):
+    """
+    Measures the cost of add_to_cart() and remove_from_cart() while the number of
+    producers grows. The wanted product is only held by the last producer.
+
+    :type producer_counts: Tuple
+    :param producer_counts: the numbers of producers to measure
+
+    :type products_per_producer: Int
+    :param products_per_producer: the number of distinct products each producer publishes
+
+    :type operations: Int
+    :param operations: the number of add / remove pairs to time
+
+    :rtype: List
+    :return: a list of (producers, microseconds per add / remove pair)
+    """
+    results = []
+
+    for producers in producer_counts:
+        market = quiet_marketplace(products_per_producer)
+
+        # Every producer publishes its own products
+        for producer in range(producers):
+            producer_id = market.register_producer()
+            for index in range(products_per_producer):
+                market.publish(producer_id, Tea("tea{}-{}".format(producer, index), 1, "Green"))
+
+        wanted = Tea("tea{}-0".format(producers - 1), 1, "Green")
+        cart_id = market.new_cart()
+
+        start = time.perf_counter()
+        for _ in range(operations):
+            market.add_to_cart(cart_id, wanted)
+            market.remove_from_cart(cart_id, wanted)
+        elapsed = time.perf_counter() - start
+
+        results.append((producers, elapsed / operations * 1e6))
+
+    return results
+
+
+def bench_logging_overhead(operations=20000):
+    """
+    Measures the cost of add_to_cart() and remove_from_cart() with the logging
+    disabled, sampled and fully enabled.
+
+    :type operations: Int
+    :param operations: the number of add / remove pairs to time
+
+    :rtype: List
+    :return: a list of (logging mode, microseconds per add / remove pair)
+    """
+    modes = [
+        ("disabled", logging.WARNING, None),
+        ("1% sampled", logging.INFO, {"add_to_cart": 0.01, "remove_from_cart": 0.01}),
+        ("enabled", logging.INFO, None),
+    ]
+    results = []
+
+    for mode, level, sampling in modes:
+        market = Marketplace(1, log_level=level, log_sampling=sampling)
+        producer_id = market.register_producer()
+        product = Tea("Linden", 9, "Herbal")
+        market.publish(producer_id, product)
+        cart_id = market.new_cart()
+
+        start = time.perf_counter()
+        for _ in range(operations):
+            market.add_to_cart(cart_id, product)
+            market.remove_from_cart(cart_id, product)
+        elapsed = time.perf_counter() - start
+
+        results.append((mode, elapsed / operations * 1e6))
+
+    # Leave the logger quiet for the other benchmarks
+    logging.getLogger('marketplace').setLevel(logging.WARNING)
+
+    return results
+
+
+def bench_metrics_overhead(operations=20000):
+    """
+    Measures the cost of add_to_cart() and remove_from_cart() with the metrics
+    disabled and enabled.
+
+    :type operations: Int
+    :param operations: the number of add / remove pairs to time
+
+    :rtype: List
+    :return: a list of (metrics mode, microseconds per add / remove pair)
+    """
+    results = []
+
+    for mode, metrics in (("disabled", False), ("enabled", True)):
+        market = Marketplace(1, log_level=logging.WARNING, metrics=metrics)
+        producer_id = market.register_producer()
+        product = Tea("Linden", 9, "Herbal")
+        market.publish(producer_id, product)
+        cart_id = market.new_cart()
+
+        start = time.perf_counter()
+        for _ in range(operations):
+            market.add_to_cart(cart_id, product)
+            market.remove_from_cart(cart_id, product)
+        elapsed = time.perf_counter() - start
+
+        results.append((mode, elapsed / operations * 1e6))
+
+    return results
+
+
+def bench_durability(operations=20000):
+    """
+    Measures the cost of add_to_cart() and remove_from_cart() without a store, with a
+    store that does not fsync and with a store that fsyncs every group commit, and how
+    long it takes to recover the marketplace from the log afterwards.
+
+    :type operations: Int
+    :param operations: the number of add / remove pairs to time
+
+    :rtype: List
+    :return: a list of (durability mode, microseconds per add / remove pair,
+    milliseconds to recover or None)
+    """
+    results = []
+    product = Tea("Linden", 9, "Herbal")
+
+    for mode, fsync in (("none", None), ("no fsync", False), ("fsync", True)):
+        with tempfile.TemporaryDirectory() as directory:
+            store = MarketplaceStore(directory, fsync=fsync) if fsync is not None else None
+            market = Marketplace(1, log_level=logging.WARNING, store=store)
+            producer_id = market.register_producer()
+            market.publish(producer_id, product)
+            cart_id = market.new_cart()
+
+            start = time.perf_counter()
+            for _ in range(operations):
+                market.add_to_cart(cart_id, product)
+                market.remove_from_cart(cart_id, product)
+            elapsed = time.perf_counter() - start
+
+            recovery = None
+            if store is not None:
+                store.close()
+                start = time.perf_counter()
+                recovered = MarketplaceStore(directory, fsync=fsync)
+                Marketplace(1, log_level=logging.WARNING, store=recovered)
+                recovery = (time.perf_counter() - start) * 1e3
+                recovered.close()
+
+        results.append((mode, elapsed / operations * 1e6, recovery))
+
+    return results
+
+
+def bench_place_order(cart_size=10000, orders=20):
+    """
+    Measures the cost of place_order() for a large cart with every order sink.
+
+    :type cart_size: Int
+    :param cart_size: the number of units in every cart
+
+    :type orders: Int
+    :param orders: the number of orders to time
+
+    :rtype: List
+    :return: a list of (sink, milliseconds per order)
+    """
+    results = []
+    product = Tea("Linden", 9, "Herbal")
+
+    for name, sink in (("stdout", StdoutSink()), ("buffer", BufferSink()), ("null", NullSink())):
+        market = Marketplace(cart_size, log_level=logging.WARNING, order_sink=sink)
+        producer_id = market.register_producer()
+        elapsed = 0
+
+        # The printed receipts are not shown
+        with redirect_stdout(io.StringIO()):
+            for _ in range(orders):
+                market.publish_many(producer_id, product, cart_size)
+                cart_id = market.new_cart()
+                market.add_to_cart(cart_id, product, quantity=cart_size)
+
+                start = time.perf_counter()
+                market.place_order(cart_id)
+                elapsed += time.perf_counter() - start
+
+        results.append((name, elapsed / orders * 1e3))
+
+    return results
+
+
+def rss_mb():
+    """
+    Returns the resident memory of the process, in megabytes. Where /proc is missing,
+    it returns the peak resident memory instead.
+
+    :rtype: Float
+    :return: the resident memory
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+
+
+def bench_cart_soak(carts=20000000, samples=20, abandon_every=10):
+    """
+    Measures the resident memory while a marketplace serves many short lived carts.
+    Every cart buys one product and is placed, or abandoned every abandon_every carts,
+    so the memory should stay flat as the cart slots are reused.
+
+    :type carts: Int
+    :param carts: the number of carts to serve
+
+    :type samples: Int
+    :param samples: the number of times the resident memory is measured
+
+    :type abandon_every: Int
+    :param abandon_every: one cart in this many is abandoned instead of placed
+
+    :rtype: Dict
+    :return: the elapsed time, the carts per second, the number of cart slots and a
+    list of (carts served, resident megabytes)
+    """
+    market = Marketplace(1, log_level=logging.WARNING, order_sink=NullSink())
+    producer_id = market.register_producer()
+    product = Tea("Linden", 9, "Herbal")
+    every = max(1, carts // samples)
+    memory = [(0, rss_mb())]
+
+    start = time.perf_counter()
+    for served in range(1, carts + 1):
+        market.publish(producer_id, product)
+        cart_id = market.new_cart()
+        market.add_to_cart(cart_id, product)
+
+        if served % abandon_every == 0:
+            market.abandon_cart(cart_id)
+        else:
+            market.place_order(cart_id)
+
+        if served % every == 0:
+            memory.append((served, rss_mb()))
+    elapsed = time.perf_counter() - start
+
+    return {
+        'carts': carts,
+        'elapsed_sec': elapsed,
+        'carts_per_sec': carts / elapsed,
+        'cart_slots': len(market.consumers_carts),
+        'rss_mb': memory,
+    }
+
+
+def print_soak(result):
+    """
+    Prints the resident memory measured by the soak benchmark.
+
+    :type result: Dict
+    :param result: the result returned by bench_cart_soak()
+    """
+    print("{} carts in {:.1f} s ({:.0f} carts/s), {} cart slots".format(
+        result['carts'], result['elapsed_sec'], result['carts_per_sec'], result['cart_slots']))
+    for served, memory in result['rss_mb']:
+        print("{:>12} carts: {:8.1f} MB resident".format(served, memory))
+
+
+def bench_allocation(producers=8, consumers=4, queue_size=5, wait_time=0.001,
+                     think_time=0.0001, duration=1.0):
+    """
+    Measures how every allocation policy spreads the consumption over producers that
+    publish the same product. The producers can publish faster than the consumers buy,
+    and a producer whose queue is full is rejected and waits wait_time before
+    publishing again.
+
+    :type producers: Int
+    :param producers: the number of producer threads
+
+    :type consumers: Int
+    :param consumers: the number of consumer threads
+
+    :type queue_size: Int
+    :param queue_size: queue_size_per_producer
+
+    :type wait_time: Float
+    :param wait_time: the time a rejected producer waits
+
+    :type think_time: Float
+    :param think_time: the time a consumer waits between its one unit orders
+
+    :type duration: Float
+    :param duration: the number of seconds every policy runs
+
+    :rtype: List
+    :return: a list of (policy, published units per second, rejected publish calls,
+    fewest units published by a producer, most units published by a producer)
+    """
+    results = []
+    product = Tea("Linden", 9, "Herbal")
+
+    for name, policy in POLICIES.items():
+        market = Marketplace(queue_size, log_level=logging.WARNING, order_sink=NullSink(),
+                             allocation=policy())
+        stop = threading.Event()
+        published = [0] * producers
+        rejected = [0] * producers
+
+        def produce(index, market=market, stop=stop, published=published, rejected=rejected):
+            producer_id = market.register_producer()
+            while not stop.is_set():
+                if market.publish(producer_id, product):
+                    published[index] += 1
+                else:
+                    rejected[index] += 1
+                    time.sleep(wait_time)
+
+        def consume(market=market, stop=stop):
+            while not stop.is_set():
+                cart_id = market.new_cart()
+                market.add_to_cart(cart_id, product, timeout=wait_time)
+                market.place_order(cart_id)
+                time.sleep(think_time)
+
+        threads = [Thread(target=produce, args=(index,)) for index in range(producers)]
+        threads += [Thread(target=consume) for _ in range(consumers)]
+
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        time.sleep(duration)
+        stop.set()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        results.append((name, sum(published) / elapsed, sum(rejected),
+                        min(published), max(published)))
+
+    return results
+
+
+def bench_capacity(producers=8, consumers=4, queue_size=5, period=0.01, hot=2,
+                   wait_time=0.001, duration=1.0):
+    """
+    Measures the fixed and the adaptive queue capacity when the demand is skewed. Every
+    producer has its own product and publishes as many units as its queue takes every
+    period, and the consumers buy one unit at a time, 80% of them from the hot
+    producers. A consumer that finds no unit within wait_time misses its order.
+
+    :type producers: Int
+    :param producers: the number of producer threads, and of products
+
+    :type consumers: Int
+    :param consumers: the number of consumer threads
+
+    :type queue_size: Int
+    :param queue_size: queue_size_per_producer, the average queue size of the adaptive capacity
+
+    :type period: Float
+    :param period: the time between two batches of a producer
+
+    :type hot: Int
+    :param hot: the number of producers whose products are bought the most
+
+    :type wait_time: Float
+    :param wait_time: the time a consumer waits for a unit
+
+    :type duration: Float
+    :param duration: the number of seconds every capacity runs
+
+    :rtype: List
+    :return: a list of (capacity, orders per second, fraction of the orders filled,
+    rejected publish calls, most units queued at once)
+    """
+    results = []
+    catalog = make_catalog(producers)
+
+    for name, policy in CAPACITIES.items():
+        market = Marketplace(queue_size, log_level=logging.WARNING, order_sink=NullSink(),
+                             capacity=policy(queue_size))
+        stop = threading.Event()
+        rejected = [0] * producers
+        orders = [[0, 0] for _ in range(consumers)]
+        peak = [0]
+
+        def produce(index, market=market, stop=stop, rejected=rejected, peak=peak):
+            producer_id = market.register_producer()
+            while not stop.is_set():
+                if not market.publish_many(producer_id, catalog[index], queue_size * producers):
+                    rejected[index] += 1
+                peak[0] = max(peak[0], sum(market.total_producers_elements))
+                time.sleep(period)
+
+        def consume(index, market=market, stop=stop, orders=orders):
+            rng = random.Random(index)
+            while not stop.is_set():
+                hot_product = rng.random() < 0.8
+                product = catalog[rng.randrange(hot) if hot_product
+                                  else rng.randrange(hot, producers)]
+                cart_id = market.new_cart()
+                filled = market.add_to_cart(cart_id, product, timeout=wait_time)
+                market.place_order(cart_id)
+                orders[index][0] += 1
+                orders[index][1] += bool(filled)
+
+        threads = [Thread(target=produce, args=(index,)) for index in range(producers)]
+        threads += [Thread(target=consume, args=(index,)) for index in range(consumers)]
+
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        time.sleep(duration)
+        stop.set()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        attempted = sum(tried for tried, _ in orders)
+        filled = sum(done for _, done in orders)
+        results.append((name, filled / elapsed, filled / max(attempted, 1), sum(rejected),
+                        peak[0]))
+
+    return results
+
+
+def bench_thread_scaling(thread_counts=(1, 2, 4, 8), operations=5000):
+    """
+    Measures the throughput of the marketplace while the number of threads grows.
+    Every thread publishes its own product and moves it in and out of its own cart,
+    so the threads only compete for the marketplace itself.
+
+    :type thread_counts: Tuple
+    :param thread_counts: the numbers of threads to measure
+
+    :type operations: Int
+    :param operations: the number of publish / add / remove rounds of each thread
+
+    :rtype: List
+    :return: a list of (threads, operations per second)
+    """
+    results = []
+
+    for threads in thread_counts:
+        market = quiet_marketplace(operations)
+
+        def worker(index, market=market):
+            producer_id = market.register_producer()
+            cart_id = market.new_cart()
+            product = Tea("tea{}".format(index), 1, "Green")
+
+            for _ in range(operations):
+                market.publish(producer_id, product)
+                market.add_to_cart(cart_id, product)
+                market.remove_from_cart(cart_id, product)
+
+        workers = [Thread(target=worker, args=(index,)) for index in range(threads)]
+
+        start = time.perf_counter()
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        results.append((threads, threads * operations * 3 / elapsed))
+
+    return results
+
+
+def bench_sharding(shard_counts=(1, 2, 4), threads=4, operations=500):
+    """
+    Measures the throughput of a ShardedMarketplace whose shards run in their own
+    processes, as the number of shards grows, against one Marketplace. Every thread
+    publishes its own product and moves it in and out of its own cart, like
+    bench_thread_scaling().
+
+    :type shard_counts: Tuple
+    :param shard_counts: the numbers of shards to measure
+
+    :type threads: Int
+    :param threads: the number of threads
+
+    :type operations: Int
+    :param operations: the number of publish / add / remove rounds of each thread
+
+    :rtype: List
+    :return: a list of (shards, operations per second), with 0 shards for one Marketplace
+    """
+    results = []
+
+    for shards in (0,) + tuple(shard_counts):
+        if shards == 0:
+            market = quiet_marketplace(operations)
+        else:
+            market = ShardedMarketplace(operations * shards, shards=shards, processes=True,
+                                        log_level=logging.WARNING, order_sink=NullSink())
+
+        def worker(index, market=market):
+            producer_id = market.register_producer()
+            cart_id = market.new_cart()
+            product = Tea("tea{}".format(index), 1, "Green")
+
+            for _ in range(operations):
+                market.publish(producer_id, product)
+                market.add_to_cart(cart_id, product)
+                market.remove_from_cart(cart_id, product)
+
+        workers = [Thread(target=worker, args=(index,)) for index in range(threads)]
+
+        start = time.perf_counter()
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        if shards:
+            market.close()
+        results.append((shards, threads * operations * 3 / elapsed))
+
+    return results
+
+
+def rpc_server(address, ready):
+    """
+    Serves a marketplace that does not log until the process is terminated.
+
+    :type address: str
+    :param address: the path of the Unix socket
+
+    :type ready: multiprocessing.Event
+    :param ready: set when the server accepts connections
+    """
+    MarketplaceServer(quiet_marketplace(1000), address).start()
+    ready.set()
+    while True:
+        time.sleep(60)
+
+
+def bench_rpc(thread_counts=(1, 4, 16), operations=1000, connections=4):
+    """
+    Measures a marketplace served by a MarketplaceServer in another process, over a
+    Unix socket, as the number of client threads grows. Every thread publishes its own
+    product and moves it in and out of its own cart.
+
+    :type thread_counts: Tuple
+    :param thread_counts: the numbers of client threads to measure
+
+    :type operations: Int
+    :param operations: the number of publish / add / remove rounds of each thread
+
+    :type connections: Int
+    :param connections: the number of connections of the client's pool
+
+    :rtype: List
+    :return: a list of (threads, operations per second, p50 us, p99 us, p999 us)
+    """
+    results = []
+
+    with tempfile.TemporaryDirectory() as directory:
+        address = os.path.join(directory, "market.sock")
+        ready = multiprocessing.Event()
+        server = multiprocessing.Process(target=rpc_server, args=(address, ready), daemon=True)
+        server.start()
+        ready.wait()
+        client = MarketplaceClient(address, connections=connections)
+
+        for threads in thread_counts:
+            samples = []
+
+            def worker(index, samples=samples):
+                producer_id = client.register_producer()
+                cart_id = client.new_cart()
+                product = Tea("tea{}".format(index), 1, "Green")
+
+                latencies = []
+                for _ in range(operations):
+                    for call, args in ((client.publish, (producer_id, product)),
+                                       (client.add_to_cart, (cart_id, product)),
+                                       (client.remove_from_cart, (cart_id, product))):
+                        start = time.perf_counter()
+                        call(*args)
+                        latencies.append(time.perf_counter() - start)
+                samples.extend(latencies)
+
+            workers = [Thread(target=worker, args=(index,)) for index in range(threads)]
+            start = time.perf_counter()
+            for thread in workers:
+                thread.start()
+            for thread in workers:
+                thread.join()
+            elapsed = time.perf_counter() - start
+
+            summary = summarize({'rpc': samples}, elapsed)['rpc']
+            results.append((threads, summary['ops_per_sec'], summary['p50_us'],
+                            summary['p99_us'], summary['p999_us']))
+
+        client.close()
+        server.terminate()
+        server.join()
+
+    return results
+
+
+def bench_async_vs_threads(shoppers=10000, producers=10):
+    """
+    Measures how long it takes for many shoppers, each buying one product, to be served
+    by an AsyncMarketplace with tasks and by a Marketplace with one thread per shopper.
+
+    :type shoppers: Int
+    :param shoppers: the number of consumers
+
+    :type producers: Int
+    :param producers: the number of producers
+
+    :rtype: List
+    :return: a list of (implementation, seconds until every shopper placed its order)
+    """
+    product = Tea("Linden", 9, "Herbal")
+    queue_size = shoppers // producers + 1
+    products = [(product, queue_size, 0)]
+    carts = [[{"type": "add", "product": product, "quantity": 1}]]
+
+    async def run_async():
+        market = AsyncMarketplace(queue_size)
+        producer_tasks = [AsyncProducer(products, market, 0.01).start()
+                          for _ in range(producers)]
+
+        start = time.perf_counter()
+        await asyncio.gather(*[AsyncConsumer(carts, market, 0.01, name="cons{}".format(i)).start()
+                               for i in range(shoppers)])
+        elapsed = time.perf_counter() - start
+
+        for task in producer_tasks:
+            task.cancel()
+        return elapsed
+
+    def run_threads():
+        market = quiet_marketplace(queue_size)
+        for i in range(producers):
+            Producer(products, market, 0.01, name="prod{}".format(i), daemon=True).start()
+
+        consumers = [Consumer(carts, market, 0.01, name="cons{}".format(i))
+                     for i in range(shoppers)]
+
+        start = time.perf_counter()
+        for consumer in consumers:
+            consumer.start()
+        for consumer in consumers:
+            consumer.join()
+        return time.perf_counter() - start
+
+    logging.getLogger('marketplace').setLevel(logging.WARNING)
+
+    # The receipts are not part of the measurement
+    with redirect_stdout(io.StringIO()):
+        async_time = asyncio.run(run_async())
+        thread_time = run_threads()
+
+    return [("asyncio tasks", async_time), ("threads", thread_time)]
+
+
+def bench_producer_scheduler(producers=1000, queue_size=10, sleep_time=0.001):
+    """
+    Measures how long it takes to fill the queues of many producers, with one Producer
+    thread for every producer and with a ProducerScheduler thread. The Producer threads
+    never stop, so they wait a long republish_wait_time once their queues are full.
+
+    :type producers: Int
+    :param producers: the number of producers
+
+    :type queue_size: Int
+    :param queue_size: queue_size_per_producer
+
+    :type sleep_time: Float
+    :param sleep_time: the production time of a unit
+
+    :rtype: List
+    :return: a list of (implementation, threads, seconds until every queue is full)
+    """
+    results = []
+    product = Tea("Linden", 9, "Herbal")
+    products = [(product, queue_size, sleep_time)]
+
+    def wait_full(market):
+        while any(total < queue_size for total in market.total_producers_elements):
+            time.sleep(0.001)
+
+    market = quiet_marketplace(queue_size)
+    threads = [Producer(products, market, 1, name="prod{}".format(i), daemon=True)
+               for i in range(producers)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    while len(market.total_producers_elements) < producers:
+        time.sleep(0.001)
+    wait_full(market)
+    results.append(("threads", producers, time.perf_counter() - start))
+
+    market = quiet_marketplace(queue_size)
+    scheduler = ProducerScheduler(market, 1)
+    start = time.perf_counter()
+    for _ in range(producers):
+        scheduler.add(products)
+    scheduler.start()
+    wait_full(market)
+    results.append(("scheduler", 1, time.perf_counter() - start))
+    scheduler.stop()
+
+    return results
+
+
+def bench_consumer_executor(consumers=2000, producers=10, workers=4):
+    """
+    Measures how long it takes for many consumers, each buying one product, to be
+    served with one Consumer thread for every consumer and with a ConsumerExecutor.
+
+    :type consumers: Int
+    :param consumers: the number of consumers
+
+    :type producers: Int
+    :param producers: the number of producers
+
+    :type workers: Int
+    :param workers: the number of worker threads of the executor
+
+    :rtype: List
+    :return: a list of (implementation, threads, seconds until every consumer placed its order)
+    """
+    results = []
+    product = Tea("Linden", 9, "Herbal")
+    queue_size = consumers // producers + 1
+    carts = [[{"type": "add", "product": product, "quantity": 1}]]
+
+    def marketplace():
+        market = Marketplace(queue_size, log_level=logging.WARNING, order_sink=NullSink())
+        for _ in range(producers):
+            market.publish_many(market.register_producer(), product, queue_size)
+        return market
+
+    market = marketplace()
+    threads = [Consumer(carts, market, 0.01, name="cons{}".format(i)) for i in range(consumers)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    results.append(("threads", consumers, time.perf_counter() - start))
+
+    market = marketplace()
+    executor = ConsumerExecutor(market, 0.01, workers=workers)
+    start = time.perf_counter()
+    jobs = [executor.submit(carts, "cons{}".format(i)) for i in range(consumers)]
+    for job in jobs:
+        job.result()
+    results.append(("executor", workers, time.perf_counter() - start))
+    executor.shutdown()
+
+    return results
+
+
+def bench_reservation_recovery(consumers=10, limit=2.0):
+    """
+    Measures how long live consumers take to buy the stock held by as many consumers
+    that stalled with full carts, without reservation timeouts and with them.
+
+    :type consumers: Int
+    :param consumers: the number of stalled and of live consumers
+
+    :type limit: Float
+    :param limit: the number of seconds after which the live consumers are given up on
+
+    :rtype: List
+    :return: a list of (time to live, orders placed, seconds until the last order or None)
+    """
+    results = []
+    product = Tea("Linden", 9, "Herbal")
+    carts = [[{"type": "add", "product": product, "quantity": 2}]]
+
+    for ttl in (None, 0.05, 0.2):
+        sink = BufferSink()
+        market = Marketplace(2 * consumers, log_level=logging.WARNING, order_sink=sink,
+                             reservation_ttl=ttl)
+        market.publish_many(market.register_producer(), product, 2 * consumers)
+
+        # The stalled consumers take all the stock and never come back
+        stalled = [market.new_cart() for _ in range(consumers)]
+        for cart_id in stalled:
+            market.add_to_cart(cart_id, product, quantity=2)
+
+        threads = [Consumer(carts, market, 0.01, name="cons{}".format(i), daemon=True)
+                   for i in range(consumers)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(max(0, start + limit - time.perf_counter()))
+        elapsed = time.perf_counter() - start
+
+        done = not any(thread.is_alive() for thread in threads)
+        results.append((ttl, len(sink.lines) // 2, elapsed if done else None))
+
+        # Let the consumers that are stuck finish
+        for cart_id in stalled:
+            market.abandon_cart(cart_id)
+        for thread in threads:
+            thread.join()
+
+    return results
+
+
+def bench_reservation_contention(consumers=8, products=4, carts=25, queue_size=2, limit=2.0):
+    """
+    Measures the orders per second when stock is scarce: every cart needs one unit of
+    every product, in a different order for every consumer, and every product trickles
+    in from its own producer, whose queue holds queue_size units, until there is just
+    enough for every cart. The consumers add the units one by one, holding part of a
+    cart while they wait for the rest, or reserve the whole cart at once.
+
+    :type consumers: Int
+    :param consumers: the number of consumers
+
+    :type products: Int
+    :param products: the number of products, and of producers
+
+    :type carts: Int
+    :param carts: the number of carts of every consumer
+
+    :type queue_size: Int
+    :param queue_size: the size of a producer's queue
+
+    :type limit: Float
+    :param limit: the number of seconds after which the consumers are given up on
+
+    :rtype: List
+    :return: a list of (mode, orders placed, orders wanted, orders per second)
+    """
+    results = []
+    catalog = make_catalog(products)
+    wanted = consumers * carts
+
+    for mode, all_or_nothing in (("one by one", False), ("reserve", True)):
+        sink = BufferSink()
+        market = Marketplace(queue_size, log_level=logging.WARNING, order_sink=sink)
+
+        def produce(product, units):
+            producer_id = market.register_producer()
+            for _ in range(units):
+                market.publish(producer_id, product, timeout=None)
+
+        producers = [Thread(target=produce, args=(product, wanted), daemon=True)
+                     for product in catalog]
+        threads = []
+        for index in range(consumers):
+            # Every consumer wants the products in a different order
+            order = catalog[index % products:] + catalog[:index % products]
+            operations = [{"type": "add", "product": product, "quantity": 1} for product in order]
+            threads.append(Consumer([operations] * carts, market, 0.001,
+                                    all_or_nothing=all_or_nothing, name="cons{}".format(index),
+                                    daemon=True))
+
+        start = time.perf_counter()
+        for thread in producers + threads:
+            thread.start()
+        for thread in threads:
+            thread.join(max(0, start + limit - time.perf_counter()))
+        elapsed = time.perf_counter() - start
+        orders = len(sink.lines) // products
+        results.append((mode, orders, wanted, orders / elapsed))
+
+        # The consumers stuck with parts of carts get one more unit of every product
+        # each, so they finish
+        for product in catalog:
+            Thread(target=produce, args=(product, consumers), daemon=True).start()
+        for thread in threads:
+            thread.join()
+
+    return results
+
+
+def bench_fair_waiting(consumers=16, period=0.0005, wait_time=0.001, duration=1.0):
+    """
+    Measures how long the consumers wait for a scarce product: one producer publishes a
+    unit every period, fewer than the consumers want, and every consumer buys one unit
+    per cart, retrying until it gets it. The consumers either poll without waiting in
+    the marketplace and sleep wait_time between tries, wait on the product's condition
+    and race for every unit, or wait in the product's line with fair waiting.
+
+    :type consumers: Int
+    :param consumers: the number of consumer threads
+
+    :type period: Float
+    :param period: the time between two units of the producer
+
+    :type wait_time: Float
+    :param wait_time: the time a consumer sleeps or waits before trying again
+
+    :type duration: Float
+    :param duration: the number of seconds every mode runs
+
+    :rtype: List
+    :return: a list of (mode, units bought per second, p50, p99, p999 and max ms
+    between the start of a cart and its unit)
+    """
+    results = []
+    product = Tea("Linden", 9, "Herbal")
+
+    for mode, fair_waiting, timeout in (("polling", False, 0), ("racing", False, wait_time),
+                                        ("fair", True, wait_time)):
+        market = Marketplace(consumers, log_level=logging.WARNING, order_sink=NullSink(),
+                             fair_waiting=fair_waiting)
+        stop = threading.Event()
+        latencies = []
+
+        def produce(market=market, stop=stop):
+            producer_id = market.register_producer()
+            while not stop.is_set():
+                market.publish(producer_id, product)
+                time.sleep(period)
+
+        def consume(market=market, stop=stop, latencies=latencies, timeout=timeout):
+            while not stop.is_set():
+                cart_id = market.new_cart()
+                start = time.perf_counter()
+                while not market.add_to_cart(cart_id, product, timeout=timeout):
+                    if stop.is_set():
+                        return
+                    if timeout == 0:
+                        time.sleep(wait_time)
+                latencies.append(time.perf_counter() - start)
+                market.place_order(cart_id)
+
+        threads = [Thread(target=produce)] + [Thread(target=consume) for _ in range(consumers)]
+
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        time.sleep(duration)
+        stop.set()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        summary = summarize({'add_to_cart': latencies}, elapsed)['add_to_cart']
+        results.append((mode, summary['ops_per_sec'], summary['p50_us'] / 1000,
+                        summary['p99_us'] / 1000, summary['p999_us'] / 1000,
+                        summary['max_us'] / 1000))
+
+    return results
+
+
+def bench_workload_loader(carts=20000):
+    """
+    Measures reading a consumer's carts from a JSON lines file: loading them all into a
+    list, like the carts given to a Consumer, and streaming them with a CartStream.
+
+    :type carts: Int
+    :param carts: the number of carts in the file
+
+    :rtype: List
+    :return: a list of (loader, ms until the first cart, ms for every cart, peak MB allocated)
+    """
+    results = []
+    rng = random.Random(0)
+    catalog = make_catalog(16)
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "cons.jsonl")
+        write_carts(path, (make_carts(rng, catalog, 1, 10, 3, 0.2)[0] for _ in range(carts)))
+
+        def load_all():
+            return iter(list(CartStream(path, ProductCache())))
+
+        def stream():
+            return iter(CartStream(path, ProductCache()))
+
+        for loader, open_carts in (("list", load_all), ("stream", stream)):
+            tracemalloc.start()
+            start = time.perf_counter()
+            loaded = open_carts()
+            next(loaded)
+            first = time.perf_counter() - start
+            for _ in loaded:
+                pass
+            elapsed = time.perf_counter() - start
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            results.append((loader, first * 1e3, elapsed * 1e3, peak / (1 << 20)))
+
+    return results
+
+
+def shared_worker(market, index, operations):
+    """
+    Publishes a product and moves it in and out of a cart, in a worker process.
+
+    :type market: SharedMarketplace
+    :param market: the marketplace
+
+    :type index: Int
+    :param index: the index of the worker, which is also the index of its product
+
+    :type operations: Int
+    :param operations: the number of publish / add / remove rounds
+    """
+    producer_id = market.register_producer()
+    cart_id = market.new_cart()
+    product = market.catalog[index]
+
+    for _ in range(operations):
+        market.publish(producer_id, product)
+        market.add_to_cart(cart_id, product)
+        market.remove_from_cart(cart_id, product)
+
+    market.close()
+
+
+def bench_process_scaling(process_counts=(1, 2, 4, 8), operations=20000):
+    """
+    Measures the throughput of a SharedMarketplace while the number of processes grows.
+    Every process publishes its own product and moves it in and out of its own cart.
+
+    :type process_counts: Tuple
+    :param process_counts: the numbers of processes to measure
+
+    :type operations: Int
+    :param operations: the number of publish / add / remove rounds of each process
+
+    :rtype: List
+    :return: a list of (processes, operations per second)
+    """
+    results = []
+
+    for processes in process_counts:
+        products = [Tea("tea{}".format(index), 1, "Green") for index in range(processes)]
+        market = SharedMarketplace(operations, products, max_producers=processes)
+
+        workers = [multiprocessing.Process(target=shared_worker,
+                                           args=(market, index, operations))
+                   for index in range(processes)]
+
+        start = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - start
+
+        market.close()
+        results.append((processes, processes * operations * 3 / elapsed))
+
+    return results
+
+
+class TimedMarketplace:
+    """
+    Class that wraps a marketplace and records the latency of every call of its methods.
+    Every thread records in its own lists, so the measurement adds no contention.
+    """
+    METHODS = ('register_producer', 'publish', 'publish_many', 'new_cart', 'add_to_cart',
+               'reserve', 'remove_from_cart', 'place_order', 'cart_alive')
+
+    def __init__(self, marketplace, timer=time.perf_counter):
+        """
+        Constructor
+
+        :type marketplace: Marketplace
+        :param marketplace: the marketplace to measure
+
+        :type timer: Callable
+        :param timer: returns the current time in seconds
+        """
+        self.marketplace = marketplace
+        self.clock = marketplace.clock
+        self.timer = timer
+        self.local = threading.local()
+        self.lock = Lock()
+        self.recorders = []
+
+        for method in self.METHODS:
+            setattr(self, method, self._timed(method, getattr(marketplace, method)))
+
+    def _timed(self, method, function):
+        """
+        Returns a function that calls the method and records its latency.
+
+        :type method: str
+        :param method: the name of the method
+
+        :type function: Callable
+        :param function: the method of the marketplace
+
+        :rtype: Callable
+        :return: the timed method
+        """
+        def timed(*args, **kwargs):
+            start = self.timer()
+            result = function(*args, **kwargs)
+            self._recorder().setdefault(method, []).append(self.timer() - start)
+            return result
+
+        return timed
+
+    def _recorder(self):
+        """
+        Returns the latencies recorded by the current thread, method -> list of seconds.
+
+        :rtype: Dict
+        :return: the recorder of the current thread
+        """
+        recorder = getattr(self.local, 'recorder', None)
+        if recorder is None:
+            recorder = self.local.recorder = {}
+            with self.lock:
+                self.recorders.append(recorder)
+
+        return recorder
+
+    def latencies(self):
+        """
+        Returns the latencies recorded by all the threads.
+
+        :rtype: Dict
+        :return: method -> list of seconds
+        """
+        merged = {}
+        with self.lock:
+            for recorder in self.recorders:
+                for method, samples in list(recorder.items()):
+                    merged.setdefault(method, []).extend(samples)
+
+        return merged
+
+
+def percentile(samples, fraction):
+    """
+    Returns a percentile of sorted samples.
+
+    :type samples: List
+    :param samples: the sorted samples
+
+    :type fraction: Float
+    :param fraction: the percentile, between 0 and 1
+
+    :rtype: Float
+    :return: the sample at that percentile
+    """
+    return samples[min(len(samples) - 1, int(fraction * len(samples)))]
+
+
+def summarize(latencies, elapsed):
+    """
+    Returns the throughput and latency percentiles of every method.
+
+    :type latencies: Dict
+    :param latencies: method -> list of seconds
+
+    :type elapsed: Float
+    :param elapsed: the duration of the run in seconds
+
+    :rtype: Dict
+    :return: method -> {calls, ops_per_sec, p50_us, p99_us, p999_us, max_us}
+    """
+    summary = {}
+    for method, samples in sorted(latencies.items()):
+        samples.sort()
+        summary[method] = {
+            'calls': len(samples),
+            'ops_per_sec': len(samples) / elapsed,
+            'p50_us': percentile(samples, 0.50) * 1e6,
+            'p99_us': percentile(samples, 0.99) * 1e6,
+            'p999_us': percentile(samples, 0.999) * 1e6,
+            'max_us': samples[-1] * 1e6,
+        }
+
+    return summary
+
+
+def make_catalog(products):
+    """
+    Creates a catalog of Tea and Coffee products.
+
+    :type products: Int
+    :param products: the number of products
+
+    :rtype: List
+    :return: the products
+    """
+    catalog = []
+    for index in range(products):
+        if index % 2 == 0:
+            catalog.append(Tea("Tea{}".format(index), index % 10 + 1, "Green"))
+        else:
+            catalog.append(Coffee("Coffee{}".format(index), index % 10 + 1, "5.05", "MEDIUM"))
+
+    return catalog
+
+
+def make_carts(rng, catalog, carts, cart_size, max_quantity, remove_ratio):
+    """
+    Creates the carts of a consumer. A remove operation always removes part of a
+    product that was added earlier in the same cart.
+
+    :type rng: random.Random
+    :param rng: the random number generator
+
+    :type catalog: List
+    :param catalog: the products
+
+    :type carts: Int
+    :param carts: the number of carts
+
+    :type cart_size: Int
+    :param cart_size: the number of operations in a cart
+
+    :type max_quantity: Int
+    :param max_quantity: the maximum quantity of an operation
+
+    :type remove_ratio: Float
+    :param remove_ratio: the fraction of the operations that are removes
+
+    :rtype: List
+    :return: the carts, in the format taken by Consumer
+    """
+    result = []
+    for _ in range(carts):
+        operations = []
+        added = {}
+        for _ in range(cart_size):
+            if added and rng.random() < remove_ratio:
+                product = rng.choice(list(added))
+                quantity = rng.randint(1, added[product])
+                operations.append({'type': 'remove', 'product': product, 'quantity': quantity})
+                added[product] -= quantity
+                if added[product] == 0:
+                    del added[product]
+            else:
+                product = rng.choice(catalog)
+                quantity = rng.randint(1, max_quantity)
+                operations.append({'type': 'add', 'product': product, 'quantity': quantity})
+                added[product] = added.get(product, 0) + quantity
+        result.append(operations)
+
+    return result
+
+
+def run_workload(producers=4, consumers=4, products=4, carts=10, cart_size=10,
+                 max_quantity=3, remove_ratio=0.2, queue_size=20, sleep_time=0,
+                 wait_time=0.01, seed=0, timeout=60, marketplace_factory=None):
+    """
+    Runs Producer and Consumer threads against a marketplace and measures its methods.
+    Every producer publishes a single product of the catalog, so a full queue always
+    holds stock that some consumer wants. The catalog has at most one product per
+    producer, and the run ends when every consumer placed its orders.
+
+    :type producers: Int
+    :param producers: the number of Producer threads
+
+    :type consumers: Int
+    :param consumers: the number of Consumer threads
+
+    :type products: Int
+    :param products: the number of products in the catalog
+
+    :type carts: Int
+    :param carts: the number of carts of every consumer
+
+    :type cart_size: Int
+    :param cart_size: the number of operations in a cart
+
+    :type max_quantity: Int
+    :param max_quantity: the maximum quantity of an operation
+
+    :type remove_ratio: Float
+    :param remove_ratio: the fraction of the operations that are removes
+
+    :type queue_size: Int
+    :param queue_size: queue_size_per_producer
+
+    :type sleep_time: Float
+    :param sleep_time: the production time of a unit
+
+    :type wait_time: Float
+    :param wait_time: republish_wait_time and retry_wait_time
+
+    :type seed: Int
+    :param seed: the seed of the generated carts
+
+    :type timeout: Float
+    :param timeout: the maximum duration of the run in seconds
+
+    :type marketplace_factory: Callable
+    :param marketplace_factory: creates the marketplace from the queue size, a quiet
+    Marketplace by default
+
+    :rtype: Dict
+    :return: the configuration, the duration and the summary of every method
+    """
+    config = {'producers': producers, 'consumers': consumers, 'products': products,
+              'carts': carts, 'cart_size': cart_size, 'max_quantity': max_quantity,
+              'remove_ratio': remove_ratio, 'queue_size': queue_size,
+              'sleep_time': sleep_time, 'wait_time': wait_time, 'seed': seed}
+
+    rng = random.Random(seed)
+    catalog = make_catalog(min(products, producers))
+    factory = marketplace_factory or (lambda size: Marketplace(size, log_level=logging.WARNING,
+                                                               order_sink=NullSink()))
+    market = TimedMarketplace(factory(queue_size))
+
+    producer_threads = [Producer([(catalog[index % len(catalog)], 1, sleep_time)], market,
+                                 wait_time, name="prod{}".format(index), daemon=True)
+                        for index in range(producers)]
+    consumer_threads = [Consumer(make_carts(rng, catalog, carts, cart_size, max_quantity,
+                                            remove_ratio),
+                                 market, wait_time, name="cons{}".format(index), daemon=True)
+                        for index in range(consumers)]
+
+    start = time.perf_counter()
+    for thread in producer_threads + consumer_threads:
+        thread.start()
+
+    # The producers never stop, the run ends with the consumers
+    end = start + timeout
+    for thread in consumer_threads:
+        thread.join(max(0, end - time.perf_counter()))
+    elapsed = time.perf_counter() - start
+
+    return {
+        'config': config,
+        'completed': not any(thread.is_alive() for thread in consumer_threads),
+        'elapsed_sec': elapsed,
+        'methods': summarize(market.latencies(), elapsed),
+    }
+
+
+def run_simulation(producers=4, consumers=4, products=4, carts=10, cart_size=10,
+                   max_quantity=3, remove_ratio=0.2, queue_size=20, sleep_time=1.0,
+                   wait_time=5.0, seed=0, duration=3600.0):
+    """
+    Runs the workload of run_workload() on a VirtualClock: the production times and the
+    waits pass in virtual time, so a long workload takes seconds. The latencies and the
+    throughput are in virtual time, and the same seed gives the same run.
+
+    :type sleep_time: Float
+    :param sleep_time: the production time of a unit, in virtual seconds
+
+    :type wait_time: Float
+    :param wait_time: republish_wait_time and retry_wait_time, in virtual seconds
+
+    :type seed: Int
+    :param seed: the seed of the generated carts and of the clock
+
+    :type duration: Float
+    :param duration: the maximum virtual duration of the run in seconds
+
+    :rtype: Dict
+    :return: the configuration, the virtual and wall durations and the summary of every
+    method, in virtual time
+    """
+    config = {'producers': producers, 'consumers': consumers, 'products': products,
+              'carts': carts, 'cart_size': cart_size, 'max_quantity': max_quantity,
+              'remove_ratio': remove_ratio, 'queue_size': queue_size,
+              'sleep_time': sleep_time, 'wait_time': wait_time, 'seed': seed}
+
+    rng = random.Random(seed)
+    catalog = make_catalog(min(products, producers))
+    clock = VirtualClock(seed)
+    market = TimedMarketplace(Marketplace(queue_size, log_level=logging.WARNING,
+                                          order_sink=NullSink(), clock=clock),
+                              timer=clock.monotonic)
+
+    producer_threads = [Producer([(catalog[index % len(catalog)], 1, sleep_time)], market,
+                                 wait_time, name="prod{}".format(index))
+                        for index in range(producers)]
+    consumer_threads = [Consumer(make_carts(rng, catalog, carts, cart_size, max_quantity,
+                                            remove_ratio),
+                                 market, wait_time, name="cons{}".format(index))
+                        for index in range(consumers)]
+
+    start = time.perf_counter()
+    virtual = clock.run(producer_threads + consumer_threads, until=duration,
+                        finish=consumer_threads)
+    wall = time.perf_counter() - start
+
+    return {
+        'config': config,
+        'completed': virtual < duration,
+        'virtual_sec': virtual,
+        'wall_sec': wall,
+        'methods': summarize(market.latencies(), virtual),
+    }
+
+
+def print_simulation(result):
+    """
+    Prints the summary of a simulation.
+
+    :type result: Dict
+    :param result: the result returned by run_simulation()
+    """
+    config = result['config']
+    print("{} producers, {} consumers: {:.1f} virtual s in {:.3f} wall s{}".format(
+        config['producers'], config['consumers'], result['virtual_sec'], result['wall_sec'],
+        "" if result['completed'] else " (ran out of time)"))
+    for method, summary in result['methods'].items():
+        print("    {:>17}: {:8} calls {:10.3f} ops/virtual s  p50 {:9.3f} s  p99 {:9.3f} s".format(
+            method, summary['calls'], summary['ops_per_sec'], summary['p50_us'] / 1e6,
+            summary['p99_us'] / 1e6))
+
+
+def run_micro():
+    """
+    Runs the micro benchmarks.
+
+    :rtype: Dict
+    :return: the results of every micro benchmark
+    """
+    return {
+        'add_to_cart_by_producers_us': bench_add_to_cart_scaling(),
+        'add_to_cart_by_logging_us': bench_logging_overhead(),
+        'add_to_cart_by_metrics_us': bench_metrics_overhead(),
+        'add_to_cart_by_durability_us': bench_durability(),
+        'place_order_by_sink_ms': bench_place_order(),
+        'publish_by_allocation': bench_allocation(),
+        'orders_per_sec_by_capacity': bench_capacity(),
+        'ops_per_sec_by_threads': bench_thread_scaling(),
+        'ops_per_sec_by_processes': bench_process_scaling(),
+        'ops_per_sec_by_shard_processes': bench_sharding(),
+        'rpc_by_client_threads': bench_rpc(),
+        'shoppers_sec_async_vs_threads': bench_async_vs_threads(),
+        'fill_sec_producer_threads_vs_scheduler': bench_producer_scheduler(),
+        'serve_sec_consumer_threads_vs_executor': bench_consumer_executor(),
+        'load_carts_list_vs_stream': bench_workload_loader(),
+        'recovery_sec_by_reservation_ttl': bench_reservation_recovery(),
+        'orders_per_sec_by_reservation_mode': bench_reservation_contention(),
+        'wait_ms_by_waiting_mode': bench_fair_waiting(),
+    }
+
+
+def print_micro(results):
+    """
+    Prints the results of the micro benchmarks.
+
+    :type results: Dict
+    :param results: the results returned by run_micro()
+    """
+    print("add_to_cart / remove_from_cart cost by number of producers")
+    for producers, cost in results['add_to_cart_by_producers_us']:
+        print("{:>6} producers: {:8.2f} us per pair".format(producers, cost))
+
+    print("add_to_cart / remove_from_cart cost by logging mode")
+    for mode, cost in results['add_to_cart_by_logging_us']:
+        print("{:>12}: {:8.2f} us per pair".format(mode, cost))
+
+    print("add_to_cart / remove_from_cart cost by metrics mode")
+    for mode, cost in results['add_to_cart_by_metrics_us']:
+        print("{:>12}: {:8.2f} us per pair".format(mode, cost))
+
+    print("add_to_cart / remove_from_cart cost by durability mode, and recovery time")
+    for mode, cost, recovery in results['add_to_cart_by_durability_us']:
+        print("{:>12}: {:8.2f} us per pair{}".format(
+            mode, cost, "" if recovery is None else ", {:.1f} ms to recover".format(recovery)))
+
+    print("place_order cost for a 10000 units cart by order sink")
+    for sink, cost in results['place_order_by_sink_ms']:
+        print("{:>8}: {:8.3f} ms per order".format(sink, cost))
+
+    print("publishing the same product from 8 producers by allocation policy")
+    for policy, throughput, rejected, fewest, most in results['publish_by_allocation']:
+        print("{:>12}: {:10.0f} units/s {:8} rejected publishes, {} to {} units per producer".format(
+            policy, throughput, rejected, fewest, most))
+
+    print("8 producers with 5 units of queue each, 80% of the orders for 2 of them, by capacity")
+    for capacity, throughput, fill, rejected, peak in results['orders_per_sec_by_capacity']:
+        print("{:>12}: {:10.0f} orders/s {:6.1%} filled {:8} rejected publishes, {} units at most".format(
+            capacity, throughput, fill, rejected, peak))
+
+    print("publish / add_to_cart / remove_from_cart throughput by number of threads")
+    for threads, throughput in results['ops_per_sec_by_threads']:
+        print("{:>6} threads: {:10.0f} ops/s".format(threads, throughput))
+
+    print("SharedMarketplace throughput by number of processes")
+    for processes, throughput in results['ops_per_sec_by_processes']:
+        print("{:>6} processes: {:10.0f} ops/s".format(processes, throughput))
+
+    print("ShardedMarketplace throughput by number of shard processes (0 is one Marketplace)")
+    for shards, throughput in results['ops_per_sec_by_shard_processes']:
+        print("{:>6} shards: {:10.0f} ops/s".format(shards, throughput))
+
+    print("MarketplaceServer over a Unix socket by number of client threads")
+    for threads, throughput, p50, p99, p999 in results['rpc_by_client_threads']:
+        print("{:>6} threads: {:10.0f} ops/s  p50 {:8.1f} us  p99 {:8.1f} us  p999 {:8.1f} us".format(
+            threads, throughput, p50, p99, p999))
+
+    print("10000 shoppers buying one product each")
+    for implementation, elapsed in results['shoppers_sec_async_vs_threads']:
+        print("{:>14}: {:8.3f} s".format(implementation, elapsed))
+
+    print("filling the queues of 1000 producers")
+    for implementation, threads, elapsed in results['fill_sec_producer_threads_vs_scheduler']:
+        print("{:>14}: {:8.3f} s with {} threads".format(implementation, elapsed, threads))
+
+    print("2000 consumers buying one product each")
+    for implementation, threads, elapsed in results['serve_sec_consumer_threads_vs_executor']:
+        print("{:>14}: {:8.3f} s with {} threads".format(implementation, elapsed, threads))
+
+    print("10 consumers buying the stock held by 10 stalled carts, by reservation time to live")
+    for ttl, orders, elapsed in results['recovery_sec_by_reservation_ttl']:
+        print("{:>14}: {:3} orders, {}".format(
+            "none" if ttl is None else "{} s".format(ttl), orders,
+            "stuck" if elapsed is None else "done after {:.3f} s".format(elapsed)))
+
+    print("8 consumers buying carts of 4 scarce products, by the way carts are filled")
+    for mode, orders, wanted, throughput in results['orders_per_sec_by_reservation_mode']:
+        print("{:>14}: {:4} of {} orders, {:8.1f} orders/s".format(mode, orders, wanted,
+                                                                  throughput))
+
+    print("16 consumers buying a product published every 0.5 ms, by the way they wait for it")
+    for mode, throughput, p50, p99, p999, most in results['wait_ms_by_waiting_mode']:
+        print("{:>14}: {:8.0f} units/s  p50 {:7.2f} ms  p99 {:7.2f} ms  p999 {:7.2f} ms  max {:7.2f} ms".format(
+            mode, throughput, p50, p99, p999, most))
+
+    print("reading 20000 carts from a JSON lines file")
+    for loader, first, elapsed, peak in results['load_carts_list_vs_stream']:
+        print("{:>14}: first cart after {:8.2f} ms, all of them after {:8.1f} ms, {:7.2f} MB peak".format(
+            loader, first, elapsed, peak))
+
+
+def print_workload(result):
+    """
+    Prints the summary of a workload run.
+
+    :type result: Dict
+    :param result: the result returned by run_workload()
+    """
+    config = result['config']
+    print("{} producers, {} consumers: {:.3f} s{}".format(
+        config['producers'], config['consumers'], result['elapsed_sec'],
+        "" if result['completed'] else " (timed out)"))
+    for method, summary in result['methods'].items():
+        print("    {:>17}: {:8} calls {:10.0f} ops/s  p50 {:9.1f} us  p99 {:9.1f} us".format(
+            method, summary['calls'], summary['ops_per_sec'], summary['p50_us'],
+            summary['p99_us']))
+
+
+def main():
+    """
+    Runs the benchmarks, prints the results and writes them as JSON if asked.
+    """
+    parser = argparse.ArgumentParser(description="Marketplace benchmarks")
+    parser.add_argument('suite', nargs='?', choices=('micro', 'workload', 'soak', 'simulate'),
+                        default='micro')
+    parser.add_argument('--output', help="file the results are written to, as JSON")
+    parser.add_argument('--threads', default='1',
+                        help="comma separated multipliers of the producers and consumers")
+    parser.add_argument('--producers', type=int, default=4)
+    parser.add_argument('--consumers', type=int, default=4)
+    parser.add_argument('--products', type=int, default=4)
+    parser.add_argument('--carts', type=int, default=10)
+    parser.add_argument('--cart-size', type=int, default=10)
+    parser.add_argument('--max-quantity', type=int, default=3)
+    parser.add_argument('--remove-ratio', type=float, default=0.2)
+    parser.add_argument('--queue-size', type=int, default=20)
+    parser.add_argument('--sleep-time', type=float, default=0)
+    parser.add_argument('--wait-time', type=float, default=0.01)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--timeout', type=float, default=60)
+    parser.add_argument('--allocation', choices=sorted(POLICIES), default='first_fit',
+                        help="allocation policy of the workload marketplace")
+    parser.add_argument('--duration', type=float, default=3600,
+                        help="maximum virtual seconds of the simulate suite")
+    parser.add_argument('--soak-carts', type=int, default=20000000,
+                        help="number of carts served by the soak suite")
+    args = parser.parse_args()
+
+    if args.suite == 'micro':
+        results = run_micro()
+        print_micro(results)
+    elif args.suite == 'soak':
+        results = bench_cart_soak(carts=args.soak_carts)
+        print_soak(results)
+    elif args.suite == 'simulate':
+        results = run_simulation(producers=args.producers, consumers=args.consumers,
+                                 products=args.products, carts=args.carts,
+                                 cart_size=args.cart_size, max_quantity=args.max_quantity,
+                                 remove_ratio=args.remove_ratio, queue_size=args.queue_size,
+                                 sleep_time=args.sleep_time or 1.0,
+                                 wait_time=args.wait_time, seed=args.seed,
+                                 duration=args.duration)
+        print_simulation(results)
+    else:
+        def factory(size):
+            return Marketplace(size, log_level=logging.WARNING, order_sink=NullSink(),
+                               allocation=POLICIES[args.allocation]())
+
+        results = []
+        for multiplier in (int(value) for value in args.threads.split(',')):
+            result = run_workload(producers=args.producers * multiplier,
+                                  consumers=args.consumers * multiplier,
+                                  products=args.products, carts=args.carts,
+                                  cart_size=args.cart_size, max_quantity=args.max_quantity,
+                                  remove_ratio=args.remove_ratio, queue_size=args.queue_size,
+                                  sleep_time=args.sleep_time, wait_time=args.wait_time,
+                                  seed=args.seed, timeout=args.timeout,
+                                  marketplace_factory=factory)
+            print_workload(result)
+            results.append(result)
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
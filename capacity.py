@@ -0,0 +1,299 @@
+"""
+This module offers the policies that decide how many units a producer's queue can hold.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+
+from threading import Lock
+
+from clock import REAL_CLOCK
+
+
+class CapacityPolicy:
+    """
+    Class that decides how many more units a producer can publish. The marketplace
+    calls acquire(), free_space() and changed() while holding the lock of the
+    producer's queue.
+    """
+    # If the queues share a total, so units taken from any queue can free space for
+    # every producer
+    shared = False
+
+    def registered(self, producer_id):
+        """
+        Tells the policy that a producer registered.
+
+        :type producer_id: Int
+        :param producer_id: the id of the new producer
+        """
+
+    def use_clock(self, clock):
+        """
+        Tells the policy the clock of the marketplace that uses it.
+
+        :type clock: RealClock
+        :param clock: the clock
+        """
+
+    def next_change(self):
+        """
+        Returns when the limits may change without any unit being published or taken,
+        so the producers waiting for free space check them again.
+
+        :rtype: Float
+        :return: the number of seconds, or None if they only change with the units
+        """
+        return None
+
+    def acquire(self, producer_id, queued, quantity):
+        """
+        Takes the space for up to quantity units the producer publishes. The units
+        acquired are counted as queued, so changed() is not called for them.
+
+        :type producer_id: Int
+        :param producer_id: the producer
+
+        :type queued: Int
+        :param queued: the number of units in the producer's queue
+
+        :type quantity: Int
+        :param quantity: the number of units the producer wants to publish
+
+        :rtype: Int
+        :return: the number of units the producer can publish, 0 if the queue is full
+        """
+        return max(0, min(quantity, self.free_space(producer_id, queued)))
+
+    def free_space(self, producer_id, queued):
+        """
+        Returns the number of units the producer can publish now.
+
+        :type producer_id: Int
+        :param producer_id: the producer
+
+        :type queued: Int
+        :param queued: the number of units in the producer's queue
+
+        :rtype: Int
+        :return: the number of units, 0 or less if the queue is full
+        """
+        raise NotImplementedError
+
+    def changed(self, producer_id, quantity):
+        """
+        Tells the policy that units were returned to the producer's queue, if quantity
+        is positive, or taken by add_to_cart() if it is negative.
+
+        :type producer_id: Int
+        :param producer_id: the producer
+
+        :type quantity: Int
+        :param quantity: the change of the number of units in the queue
+
+        :rtype: List
+        :return: the producers whose limit grew, so the marketplace wakes them up
+        """
+        return []
+
+    def limits(self):
+        """
+        Returns the current limit of every producer's queue.
+
+        :rtype: List
+        :return: the number of units every producer's queue can hold
+        """
+        raise NotImplementedError
+
+
+class FixedCapacity(CapacityPolicy):
+    """
+    Policy that gives every producer the same queue size. It is the default.
+    """
+    def __init__(self, queue_size_per_producer):
+        """
+        Constructor
+
+        :type queue_size_per_producer: Int
+        :param queue_size_per_producer: the maximum size of a queue associated with each producer
+        """
+        self.queue_size_per_producer = queue_size_per_producer
+        self.producers = 0
+
+    def registered(self, producer_id):
+        self.producers = producer_id + 1
+
+    def free_space(self, producer_id, queued):
+        return self.queue_size_per_producer - queued
+
+    def limits(self):
+        return [self.queue_size_per_producer] * self.producers
+
+
+class AdaptiveCapacity(CapacityPolicy):
+    """
+    Policy that keeps the same total as FixedCapacity, queue_size_per_producer units for
+    every registered producer, but gives the producers whose units are bought faster a
+    larger share of it. Every interval seconds, the units taken from every producer are
+    folded into a moving average of its sell-through rate, and the total is split
+    again: every producer keeps min_size units, and the rest is shared in proportion
+    to the rates. Until something sells, the shares are equal.
+
+    A producer can publish while its queue is under its limit and the queues of all
+    the producers hold less than the total. Both are checked and the space is taken
+    under the lock of the policy, so the producers never publish more than the total
+    together, and a limit that shrinks never lets the total grow. The policy is shared,
+    so the marketplace wakes every waiting producer when units are taken from any queue,
+    and the producers whose limit grew when the total is split again. The intervals are
+    measured on the marketplace's clock, unless the policy is given one.
+    """
+    shared = True
+
+    def __init__(self, queue_size_per_producer, interval=0.1, smoothing=0.5, min_size=1,
+                 clock=None):
+        """
+        Constructor
+
+        :type queue_size_per_producer: Int
+        :param queue_size_per_producer: the average size of a producer's queue
+
+        :type interval: Float
+        :param interval: the number of seconds between two splits of the total
+
+        :type smoothing: Float
+        :param smoothing: the weight of the last interval in the moving average of the rates
+
+        :type min_size: Int
+        :param min_size: the number of units every producer keeps, so a producer that
+        sells nothing yet can still publish
+
+        :type clock: RealClock
+        :param clock: the clock that measures the intervals, the marketplace's clock by default
+        """
+        self.queue_size_per_producer = queue_size_per_producer
+        self.interval = interval
+        self.smoothing = smoothing
+        self.min_size = min(min_size, queue_size_per_producer)
+
+        # Initialize the clock, until the marketplace gives its own if none was given
+        self.clock = clock if clock is not None else REAL_CLOCK
+        self.clock_given = clock is not None
+
+        # Initialize the lock of the counters, the limit, the units taken in this
+        # interval and the average rate of every producer, and the units in all the queues
+        self.lock = Lock()
+        self.sizes = []
+        self.taken = []
+        self.rates = []
+        self.queued = 0
+        self.next_split = self.clock.monotonic() + interval
+
+    def registered(self, producer_id):
+        with self.lock:
+            self.sizes.append(self.queue_size_per_producer)
+            self.taken.append(0)
+            self.rates.append(0.0)
+            self._split()
+
+    def use_clock(self, clock):
+        with self.lock:
+            if not self.clock_given:
+                self.clock = clock
+                self.next_split = clock.monotonic() + self.interval
+
+    def next_change(self):
+        with self.lock:
+            return max(0.0, self.next_split - self.clock.monotonic())
+
+    def acquire(self, producer_id, queued, quantity):
+        with self.lock:
+            acquired = max(0, min(quantity, self._free_space(producer_id, queued)))
+            self.queued += acquired
+            return acquired
+
+    def free_space(self, producer_id, queued):
+        with self.lock:
+            return self._free_space(producer_id, queued)
+
+    def changed(self, producer_id, quantity):
+        with self.lock:
+            self.queued += quantity
+            if quantity < 0:
+                self.taken[producer_id] -= quantity
+            return self._split_due()
+
+    def limits(self):
+        return list(self.sizes)
+
+    def _free_space(self, producer_id, queued):
+        """
+        Returns the number of units the producer can publish now, splitting the total
+        again if the interval passed. The lock must be held by the caller.
+
+        :type producer_id: Int
+        :param producer_id: the producer
+
+        :type queued: Int
+        :param queued: the number of units in the producer's queue
+
+        :rtype: Int
+        :return: the number of units, 0 or less if the queue is full
+        """
+        self._split_due()
+
+        total = self.queue_size_per_producer * len(self.sizes)
+        return min(self.sizes[producer_id] - queued, total - self.queued)
+
+    def _split_due(self):
+        """
+        Splits the total again if the interval passed. The lock must be held by the caller.
+
+        :rtype: List
+        :return: the producers whose limit grew
+        """
+        if self.clock.monotonic() < self.next_split:
+            return []
+
+        sizes = self.sizes
+        self._update_rates()
+        self._split()
+        return [producer_id for producer_id, size in enumerate(self.sizes)
+                if size > sizes[producer_id]]
+
+    def _update_rates(self):
+        """
+        Folds the units taken in the last interval into the average rates. The lock
+        must be held by the caller.
+        """
+        now = self.clock.monotonic()
+        elapsed = now - self.next_split + self.interval
+        for producer_id, taken in enumerate(self.taken):
+            rate = taken / elapsed if elapsed > 0 else 0.0
+            self.rates[producer_id] += self.smoothing * (rate - self.rates[producer_id])
+            self.taken[producer_id] = 0
+        self.next_split = now + self.interval
+
+    def _split(self):
+        """
+        Splits the total between the producers, in proportion to their rates. The lock
+        must be held by the caller.
+        """
+        producers = len(self.sizes)
+        spare = (self.queue_size_per_producer - self.min_size) * producers
+        total_rate = sum(self.rates)
+
+        # Nothing sold yet, everybody gets the same
+        if total_rate == 0:
+            self.sizes = [self.queue_size_per_producer] * producers
+            return
+
+        # Share the spare units by rate, and give what rounding left to the fastest
+        sizes = [self.min_size + int(spare * rate / total_rate) for rate in self.rates]
+        fastest = max(range(producers), key=self.rates.__getitem__)
+        sizes[fastest] += self.queue_size_per_producer * producers - sum(sizes)
+        self.sizes = sizes
+
+
+# The policies by name
+CAPACITIES = {'fixed': FixedCapacity, 'adaptive': AdaptiveCapacity}
@@ -0,0 +1,270 @@
+"""
+This module offers the clocks used by the Marketplace, the producers and the consumers.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+
+import heapq
+import itertools
+import random
+from threading import Event, Lock, current_thread
+import time
+
+
+class SimulationStopped(Exception):
+    """
+    Raised in the threads of a simulation when its virtual time is over.
+    """
+
+
+class RealClock:
+    """
+    Class that represents the wall clock. It is the default clock.
+    """
+    @staticmethod
+    def monotonic():
+        """
+        Returns the current time, in seconds.
+        """
+        return time.monotonic()
+
+    @staticmethod
+    def sleep(seconds):
+        """
+        Sleeps for a number of seconds.
+        """
+        time.sleep(seconds)
+
+    @staticmethod
+    def wait_for(condition, predicate, timeout):
+        """
+        Waits on a condition until the predicate is true. The lock of the condition
+        must be held by the caller.
+
+        :type condition: Condition
+        :param condition: the condition that is notified when the predicate may change
+
+        :type predicate: Callable
+        :param predicate: the state to wait for
+
+        :type timeout: Float
+        :param timeout: the number of seconds to wait, None waits forever
+
+        :rtype: bool
+        :return: True if the predicate is true, False if the timeout expired
+        """
+        return bool(condition.wait_for(predicate, timeout))
+
+    @staticmethod
+    def session(function):
+        """
+        Runs the body of a producer or consumer thread. The wall clock needs nothing else.
+
+        :type function: Callable
+        :param function: the body of the thread
+        """
+        function()
+
+
+# The clock used when none is given
+REAL_CLOCK = RealClock()
+
+
+class VirtualClock:
+    """
+    Class that represents a virtual clock driven by a discrete event scheduler. The
+    threads of a simulation run one at a time: the running thread holds the baton
+    until it sleeps or waits, then the baton goes to the thread with the earliest
+    wake up time, and the virtual time jumps to it. Threads that wake up at the same
+    time are ordered by a seeded random number, so a run is reproducible.
+
+    A wait on a marketplace condition is polled every poll seconds of virtual time,
+    because the notifications of the marketplace do not go through the clock.
+    """
+    def __init__(self, seed=0, poll=1.0):
+        """
+        Constructor
+
+        :type seed: Int
+        :param seed: the seed of the order of the threads that wake up at the same time
+
+        :type poll: Float
+        :param poll: the number of virtual seconds between two checks of a waited condition
+        """
+        self.now = 0.0
+        self.poll = poll
+        self.rng = random.Random(seed)
+
+        # Initialize the heap of the sleeping threads: (wake up time, tie, sequence, event)
+        self.lock = Lock()
+        self.heap = []
+        self.sequence = itertools.count()
+
+        # Initialize the events the threads wait on before their first turn, and the
+        # threads whose end ends the simulation
+        self.first_turns = {}
+        self.finish = set()
+
+        self.until = None
+        self.stopped = False
+        self.done = Event()
+
+    def monotonic(self):
+        """
+        Returns the virtual time, in seconds.
+        """
+        return self.now
+
+    def _schedule(self, wake_up):
+        """
+        Adds a turn to the heap. The lock must be held by the caller.
+
+        :type wake_up: Float
+        :param wake_up: the virtual time of the turn
+
+        :rtype: Event
+        :return: the event that is set when the turn comes
+        """
+        event = Event()
+        heapq.heappush(self.heap, (wake_up, self.rng.random(), next(self.sequence), event))
+        return event
+
+    def _dispatch(self):
+        """
+        Gives the baton to the next thread, advancing the virtual time. The lock must
+        be held by the caller.
+        """
+        if not self.heap:
+            self.done.set()
+            return
+
+        wake_up, _, _, event = heapq.heappop(self.heap)
+        if self.until is not None and wake_up > self.until:
+            # The time is over: wake every thread, to stop it
+            self.stopped = True
+            event.set()
+            for _, _, _, waiting in self.heap:
+                waiting.set()
+            self.heap = []
+            self.done.set()
+            return
+
+        self.now = max(self.now, wake_up)
+        event.set()
+
+    def _wait_turn(self, event):
+        """
+        Blocks until the turn of the event comes.
+        """
+        event.wait()
+        if self.stopped:
+            raise SimulationStopped()
+
+    def sleep(self, seconds):
+        """
+        Sleeps for a number of virtual seconds, letting the other threads run.
+        """
+        with self.lock:
+            event = self._schedule(self.now + seconds)
+            self._dispatch()
+
+        self._wait_turn(event)
+
+    def wait_for(self, condition, predicate, timeout):
+        """
+        Waits on a condition until the predicate is true, checking it every poll
+        virtual seconds. The lock of the condition must be held by the caller, and it
+        is released while sleeping.
+
+        :type condition: Condition
+        :param condition: the condition whose lock protects the predicate
+
+        :type predicate: Callable
+        :param predicate: the state to wait for
+
+        :type timeout: Float
+        :param timeout: the number of virtual seconds to wait, None waits forever
+
+        :rtype: bool
+        :return: True if the predicate is true, False if the timeout expired
+        """
+        deadline = None if timeout is None else self.now + timeout
+
+        while not predicate():
+            if deadline is not None and self.now >= deadline:
+                return False
+
+            step = self.poll if deadline is None else min(self.poll, deadline - self.now)
+            condition.release()
+            try:
+                self.sleep(step)
+            finally:
+                condition.acquire()
+
+        return True
+
+    def session(self, function):
+        """
+        Runs the body of a thread started by run(): it waits for its first turn, and
+        gives the baton away when the body returns. When the simulation is over, the
+        body is stopped by a SimulationStopped exception.
+
+        :type function: Callable
+        :param function: the body of the thread
+        """
+        with self.lock:
+            event = self.first_turns.pop(current_thread())
+
+        try:
+            self._wait_turn(event)
+            function()
+        except SimulationStopped:
+            return
+        finally:
+            if not self.stopped:
+                with self.lock:
+                    # The last thread the simulation waits for ends it now
+                    if current_thread() in self.finish:
+                        self.finish.discard(current_thread())
+                        if not self.finish:
+                            self.until = self.now
+                    self._dispatch()
+
+    def run(self, threads, until=None, finish=None):
+        """
+        Runs threads until all of them return or the virtual time reaches until.
+        Their run() must call session().
+
+        :type threads: List
+        :param threads: the threads, not started yet
+
+        :type until: Float
+        :param until: the virtual time the simulation ends at, None runs until the
+        threads return
+
+        :type finish: List
+        :param finish: some of the threads. When all of them returned, the simulation
+        ends, even if the others did not
+
+        :rtype: Float
+        :return: the virtual time at the end
+        """
+        self.until = until
+        self.finish = set(finish or ())
+        with self.lock:
+            for thread in threads:
+                self.first_turns[thread] = self._schedule(self.now)
+
+        for thread in threads:
+            thread.start()
+
+        with self.lock:
+            self._dispatch()
+
+        self.done.wait()
+        for thread in threads:
+            thread.join()
+
+        return self.until if self.stopped else self.now
@@ -6,20 +6,51 @@ Assignment 1
 March 2021
 """
 
-from threading import Thread
-import time
+from collections import deque
+import heapq
+import itertools
+import logging
+from threading import Condition, Thread
+import unittest
+
+from clock import REAL_CLOCK
+
+
+def net_items(operations):
+    """
+    Returns what a cart holds after its operations: the quantity added of every
+    product, minus the quantity removed.
+
+    :type operations: List
+    :param operations: the add and remove operations of the cart
+
+    :rtype: List
+    :return: a (product, quantity) for every product left in the cart, in the order
+    they were first added
+    """
+    quantities = {}
+    for operation in operations:
+        product = operation['product']
+        if operation['type'] == "add":
+            quantities[product] = quantities.get(product, 0) + operation['quantity']
+        elif operation['type'] == "remove" and product in quantities:
+            quantities[product] = max(0, quantities[product] - operation['quantity'])
+
+    return [(product, quantity) for product, quantity in quantities.items() if quantity > 0]
 
 class Consumer(Thread):
     """
     Class that represents a consumer.
     """
 
-    def __init__(self, carts, marketplace, retry_wait_time, **kwargs):
+    def __init__(self, carts, marketplace, retry_wait_time, clock=None, all_or_nothing=False,
+                 priority=None, **kwargs):
         """
         Constructor.
 
-        :type carts: List
-        :param carts: a list of add and remove operations
+        :type carts: Iterable
+        :param carts: a list of add and remove operations for every cart. It is
+        iterated once, so it can be a CartStream (workload.py)
 
         :type marketplace: Marketplace
         :param marketplace: a reference to the marketplace
@@ -28,6 +59,17 @@ class Consumer(Thread):
         :param retry_wait_time: the number of seconds that a producer must wait
         until the Marketplace becomes available
 
+        :type clock: RealClock
+        :param clock: the clock of the consumer, the marketplace's clock by default
+
+        :type all_or_nothing: bool
+        :param all_or_nothing: if every cart is reserved at once with reserve(), instead
+        of adding its products one by one
+
+        :type priority: Int
+        :param priority: the priority of the consumer's carts in the lines of a
+        marketplace with fair waiting, the marketplace's default if it is None
+
         :type kwargs:
         :param kwargs: other arguments that are passed to the Thread's __init__()
         """
@@ -36,30 +78,490 @@ class Consumer(Thread):
         self.carts = carts
         self.marketplace = marketplace
         self.retry_wait_time = retry_wait_time
+        self.clock = clock if clock is not None else getattr(marketplace, 'clock', REAL_CLOCK)
+        self.all_or_nothing = all_or_nothing
+        self.options = {} if priority is None else {'priority': priority}
+
+        # Only a local Marketplace counts the retries in its stats()
+        self.count_retry = getattr(marketplace, 'count_retry', lambda kind: None)
 
     def run(self):
-        # For each product in the cart
+        self.clock.session(self.consume)
+
+    def consume(self):
+        """
+        Buys every cart.
+        """
         for carts in self.carts:
-            cart_id = self.marketplace.new_cart()
+            # Start the cart over if its reservation expired before it was bought
+            while not self.buy(carts):
+                self.count_retry('consumer')
 
-            for cart in carts:
-                op_type = cart['type']
-                product = cart['product']
-                quantity = cart['quantity']
+    def buy(self, carts):
+        """
+        Buys a cart.
 
-                while quantity > 0:
-                    # If the type is add, add the product to the cart
-                    if op_type == "add":
-                        res = self.marketplace.add_to_cart(cart_id, product)
-                        if res is False:
-                            # Wait for the retry wait time
-                            time.sleep(self.retry_wait_time)
-                        else:
-                            quantity -= 1
-                    elif op_type == "remove":
-                        # If the type is remove, remove the product from the cart
-                        self.marketplace.remove_from_cart(cart_id, product)
-                        quantity -= 1
+        :type carts: List
+        :param carts: the add and remove operations of the cart
+
+        :rtype: bool
+        :return: False if the reservation of the cart expired
+        """
+        cart_id = self.marketplace.new_cart()
+
+        if self.all_or_nothing:
+            # Wait at most retry_wait_time for all the products to be in stock,
+            # then try again
+            items = net_items(carts)
+            while not self.marketplace.reserve(cart_id, items, timeout=self.retry_wait_time):
+                if not self.marketplace.cart_alive(cart_id):
+                    return False
+                self.count_retry('consumer')
 
             # Buy the cart
-            product = self.marketplace.place_order(cart_id)
+            return self.marketplace.place_order(cart_id) is not False
+
+        # For each product in the cart
+        for cart in carts:
+            op_type = cart['type']
+            product = cart['product']
+            quantity = cart['quantity']
+
+            while quantity > 0:
+                # If the type is add, add the product to the cart
+                if op_type == "add":
+                    # Wait at most retry_wait_time for the product to be published,
+                    # then add as many units as there are in stock
+                    added = self.marketplace.add_to_cart(cart_id, product,
+                                                         timeout=self.retry_wait_time,
+                                                         quantity=quantity, **self.options)
+                    if added == 0 and not self.marketplace.cart_alive(cart_id):
+                        return False
+                    quantity -= added
+                    if quantity > 0:
+                        self.count_retry('consumer')
+                elif op_type == "remove":
+                    # If the type is remove, remove the product from the cart
+                    self.marketplace.remove_from_cart(cart_id, product, quantity=quantity)
+                    quantity = 0
+
+        # Buy the cart
+        return self.marketplace.place_order(cart_id) is not False
+
+
+class ConsumerJob:
+    """
+    Class that represents the carts of one consumer submitted to a ConsumerExecutor.
+    Its orders are kept in the order of the carts.
+    """
+    def __init__(self, name, carts):
+        """
+        Constructor
+
+        :type name: str
+        :param name: the name of the consumer, written on its receipts
+
+        :type carts: List
+        :param carts: a list of add and remove operations for every cart
+        """
+        self.name = name
+        self.orders = [None] * len(carts)
+        self.pending = len(carts)
+        self.condition = Condition()
+
+        # Initialize the first exception raised by a cart
+        self.error = None
+
+    def complete(self, index, order):
+        """
+        Keeps the order of a cart.
+
+        :type index: Int
+        :param index: the index of the cart
+
+        :type order: List
+        :param order: the result of place_order()
+        """
+        with self.condition:
+            self.orders[index] = order
+            self.pending -= 1
+            if self.pending == 0:
+                self.condition.notify_all()
+
+    def fail(self, index, error):
+        """
+        Keeps the exception raised by a cart, which is not placed.
+
+        :type index: Int
+        :param index: the index of the cart
+
+        :type error: Exception
+        :param error: the exception
+        """
+        with self.condition:
+            self.orders[index] = None
+            if self.error is None:
+                self.error = error
+            self.pending -= 1
+            if self.pending == 0:
+                self.condition.notify_all()
+
+    def result(self, timeout=None):
+        """
+        Waits for every cart to be placed.
+
+        :type timeout: Float
+        :param timeout: the maximum number of seconds to wait, None waits forever
+
+        :rtype: List
+        :return: the orders, in the order of the carts, or None if the timeout expired
+
+        :raises: the first exception raised by a cart, when every cart is done
+        """
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.pending == 0, timeout):
+                return None
+            if self.error is not None:
+                raise self.error
+            return self.orders
+
+
+class ConsumerExecutor:
+    """
+    Class that runs the cart sessions of many consumers on a bounded pool of worker
+    threads, instead of one thread for every Consumer. Every cart is a task: a
+    generator doing what Consumer.run does for a cart. When a product is not in stock,
+    the task yields, and it is put back in the ready queue after retry_wait_time by a
+    timer thread, so its worker moves on to another cart instead of sleeping. A cart
+    that raises an exception is not placed, and its job raises it from result().
+    """
+    def __init__(self, marketplace, retry_wait_time, workers=4, name="worker", clock=None,
+                 start=True):
+        """
+        Constructor
+
+        :type marketplace: Marketplace
+        :param marketplace: a reference to the marketplace
+
+        :type retry_wait_time: Time
+        :param retry_wait_time: the number of seconds a cart waits for a product that
+        is not in stock
+
+        :type workers: Int
+        :param workers: the number of worker threads
+
+        :type name: str
+        :param name: the prefix of the names of the threads
+
+        :type clock: RealClock
+        :param clock: the clock the carts wait on, the marketplace's clock by default
+
+        :type start: bool
+        :param start: if the threads are started now. With a VirtualClock, they are run
+        by clock.run(executor.threads) instead
+        """
+        self.marketplace = marketplace
+        self.retry_wait_time = retry_wait_time
+        self.clock = clock if clock is not None else getattr(marketplace, 'clock', REAL_CLOCK)
+        self.count_retry = getattr(marketplace, 'count_retry', lambda kind: None)
+
+        # Initialize the queue of the tasks ready to run, and the heap of the waiting
+        # tasks: (due time, sequence number, task). Both are guarded by the condition
+        self.ready = deque()
+        self.waiting = []
+        self.condition = Condition()
+        self.sequence = itertools.count()
+        self.stopped = False
+
+        # Initialize the number of tasks that are not done
+        self.pending = 0
+
+        self.workers = [Thread(target=self.clock.session, args=(self._work,),
+                               name="{}{}".format(name, index), daemon=True)
+                        for index in range(workers)]
+        self.timer = Thread(target=self.clock.session, args=(self._wake,),
+                            name="{}-timer".format(name), daemon=True)
+        self.threads = self.workers + [self.timer]
+        if start:
+            for thread in self.threads:
+                thread.start()
+
+    def submit(self, carts, name):
+        """
+        Adds the carts of a consumer.
+
+        :type carts: List
+        :param carts: a list of add and remove operations for every cart
+
+        :type name: str
+        :param name: the name of the consumer
+
+        :rtype: ConsumerJob
+        :return: the job that gives the orders
+        """
+        job = ConsumerJob(name, carts)
+        with self.condition:
+            self.pending += len(carts)
+            for index, operations in enumerate(carts):
+                self.ready.append((self._session(operations, name), job, index))
+            self.condition.notify_all()
+
+        return job
+
+    def _session(self, operations, name):
+        """
+        Buys a cart, like Consumer.run. It yields when it has to wait for stock.
+
+        :type operations: List
+        :param operations: the add and remove operations of the cart
+
+        :type name: str
+        :param name: the name of the consumer
+
+        :rtype: Generator
+        :return: the order, when the generator stops
+        """
+        while True:
+            order = yield from self._try_session(operations, name)
+
+            # Start the cart over if its reservation expired before it was bought
+            if order is not False:
+                return order
+            self.count_retry('consumer')
+
+    def _try_session(self, operations, name):
+        """
+        Buys a cart once. It yields when it has to wait for stock.
+
+        :rtype: Generator
+        :return: the order, or False if the reservation of the cart expired
+        """
+        cart_id = self.marketplace.new_cart()
+
+        for operation in operations:
+            product = operation['product']
+            quantity = operation['quantity']
+
+            if operation['type'] == "add":
+                while quantity > 0:
+                    # Add as many units as there are in stock, and wait for the rest
+                    # without holding the worker
+                    added = self.marketplace.add_to_cart(cart_id, product, quantity=quantity)
+                    if added == 0 and not self.marketplace.cart_alive(cart_id):
+                        return False
+                    quantity -= added
+                    if quantity > 0:
+                        self.count_retry('consumer')
+                        yield
+            elif operation['type'] == "remove":
+                self.marketplace.remove_from_cart(cart_id, product, quantity=quantity)
+
+        # Buy the cart
+        return self.marketplace.place_order(cart_id, name=name)
+
+    def _work(self):
+        """
+        Runs the ready tasks until the executor is shut down.
+        """
+        while True:
+            with self.condition:
+                self.clock.wait_for(self.condition, lambda: self.ready or self.stopped, None)
+                if not self.ready:
+                    return
+                task = self.ready.popleft()
+
+            generator, job, index = task
+            try:
+                next(generator)
+            except StopIteration as stop:
+                job.complete(index, stop.value)
+                self._done()
+                continue
+            except Exception as error:  # pylint: disable=broad-except
+                # The cart is given up, and its job raises the exception
+                job.fail(index, error)
+                self._done()
+                continue
+
+            # The task waits for stock
+            with self.condition:
+                heapq.heappush(self.waiting, (self.clock.monotonic() + self.retry_wait_time,
+                                              next(self.sequence), task))
+                self.condition.notify_all()
+
+    def _done(self):
+        """
+        Counts a task that is done.
+        """
+        with self.condition:
+            self.pending -= 1
+            self.condition.notify_all()
+
+    def _wake(self):
+        """
+        Puts the waiting tasks back in the ready queue when their wait is over.
+        """
+        def head():
+            return self.waiting[0][:2] if self.waiting else None
+
+        with self.condition:
+            while not self.stopped:
+                now = self.clock.monotonic()
+                woken = False
+                while self.waiting and self.waiting[0][0] <= now:
+                    self.ready.append(heapq.heappop(self.waiting)[2])
+                    woken = True
+                if woken:
+                    self.condition.notify_all()
+
+                # Wait for the first task to be due, or for an earlier one to be added
+                first = head()
+                self.clock.wait_for(self.condition,
+                                    lambda first=first: self.stopped or head() != first,
+                                    self.waiting[0][0] - now if self.waiting else None)
+
+    def shutdown(self, timeout=None):
+        """
+        Waits for the submitted carts to be placed, then stops the threads.
+
+        :type timeout: Float
+        :param timeout: the maximum number of seconds to wait for the carts
+
+        :rtype: bool
+        :return: True if every cart was placed
+        """
+        with self.condition:
+            done = self.condition.wait_for(lambda: self.pending == 0, timeout)
+            self.stopped = True
+            self.ready.clear()
+            self.condition.notify_all()
+
+        for thread in self.threads:
+            thread.join(timeout)
+
+        return done
+
+
+class TestConsumerExecutor(unittest.TestCase):
+    """
+    Class that tests the ConsumerExecutor.
+    """
+    def setUp(self):
+        """
+        Setup the test.
+        """
+        # Imported here, so the consumer does not depend on the marketplace module
+        from marketplace import Marketplace  # pylint: disable=import-outside-toplevel
+        from order_sink import BufferSink  # pylint: disable=import-outside-toplevel
+        self.sink = BufferSink()
+        self.marketplace = Marketplace(10, log_level=logging.WARNING, order_sink=self.sink)
+
+    def test_orders_in_cart_order(self):
+        """
+        Tests that the orders of a consumer keep the order of its carts and its name.
+        """
+        producer_id = self.marketplace.register_producer()
+        self.marketplace.publish_many(producer_id, "tea", 3)
+        self.marketplace.publish_many(producer_id, "coffee", 1)
+
+        carts = [[{"type": "add", "product": "tea", "quantity": 2},
+                  {"type": "remove", "product": "tea", "quantity": 1}],
+                 [{"type": "add", "product": "coffee", "quantity": 1}]]
+        executor = ConsumerExecutor(self.marketplace, 0.01, workers=2)
+        job = executor.submit(carts, "cons1")
+
+        # Verify the orders and the receipts
+        self.assertEqual(job.result(5), [[["tea", producer_id]], [["coffee", producer_id]]])
+        self.assertTrue(executor.shutdown(5))
+        self.assertEqual(sorted(self.sink.lines), ["cons1 bought coffee", "cons1 bought tea"])
+
+    def test_waiting_cart_yields_worker(self):
+        """
+        Tests that a cart waiting for stock does not block the other carts of a single worker.
+        """
+        producer_id = self.marketplace.register_producer()
+        self.marketplace.publish(producer_id, "coffee")
+
+        executor = ConsumerExecutor(self.marketplace, 0.01, workers=1)
+        waiting = executor.submit([[{"type": "add", "product": "tea", "quantity": 1}]], "cons1")
+        ready = executor.submit([[{"type": "add", "product": "coffee", "quantity": 1}]], "cons2")
+
+        # Verify that the second cart is placed while the first one waits
+        self.assertEqual(ready.result(5), [[["coffee", producer_id]]])
+        self.assertIsNone(waiting.result(0.05))
+
+        self.marketplace.publish(producer_id, "tea")
+        self.assertEqual(waiting.result(5), [[["tea", producer_id]]])
+        self.assertTrue(executor.shutdown(5))
+
+    def test_failing_cart(self):
+        """
+        Tests that a cart that raises an exception does not keep the executor from shutting down.
+        """
+        producer_id = self.marketplace.register_producer()
+        self.marketplace.publish(producer_id, "coffee")
+
+        # A product that is not hashable makes add_to_cart() raise a TypeError
+        carts = [[{"type": "add", "product": ["tea"], "quantity": 1}],
+                 [{"type": "add", "product": "coffee", "quantity": 1}]]
+        executor = ConsumerExecutor(self.marketplace, 0.01, workers=1)
+        job = executor.submit(carts, "cons1")
+
+        # Verify that the job raises the exception and the other cart is placed
+        with self.assertRaises(TypeError):
+            job.result(5)
+        self.assertTrue(executor.shutdown(5))
+        self.assertEqual(self.sink.lines, ["cons1 bought coffee"])
+
+    def test_virtual_clock(self):
+        """
+        Tests that the carts wait on the marketplace's clock.
+        """
+        # pylint: disable=import-outside-toplevel
+        from clock import VirtualClock
+        from marketplace import Marketplace
+
+        clock = VirtualClock()
+        market = Marketplace(10, log_level=logging.WARNING, clock=clock)
+        producer_id = market.register_producer()
+        executor = ConsumerExecutor(market, 1, workers=1, clock=clock, start=False)
+        job = executor.submit([[{"type": "add", "product": "tea", "quantity": 1}]], "cons1")
+
+        def publish():
+            clock.sleep(5)
+            market.publish(producer_id, "tea")
+
+        publisher = Thread(target=clock.session, args=(publish,))
+
+        # Verify that the cart is placed once the tea is published, in virtual time
+        clock.run(executor.threads + [publisher], until=10)
+        self.assertEqual(job.result(0), [[["tea", producer_id]]])
+
+
+class TestConsumer(unittest.TestCase):
+    """
+    Class that tests the Consumer.
+    """
+    def test_counts_retries(self):
+        """
+        Tests that the marketplace counts the retries of a Consumer waiting for stock.
+        """
+        # pylint: disable=import-outside-toplevel
+        from clock import VirtualClock
+        from marketplace import Marketplace
+
+        clock = VirtualClock()
+        market = Marketplace(10, log_level=logging.WARNING, clock=clock, metrics=True)
+        producer_id = market.register_producer()
+        consumer = Consumer([[{"type": "add", "product": "tea", "quantity": 1}]], market, 1,
+                            name="cons1")
+
+        def publish():
+            clock.sleep(5.5)
+            market.publish(producer_id, "tea")
+
+        publisher = Thread(target=clock.session, args=(publish,))
+
+        # Verify one retry for every second the consumer waited for the tea
+        clock.run([consumer, publisher], until=10)
+        self.assertEqual(market.stats()['retries'], {'consumer': 5})
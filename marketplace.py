@@ -6,90 +6,446 @@ Assignment 1
 March 2021
 """
 
-from threading import Lock, currentThread
+from array import array
+import heapq
+import itertools
+import os
+import tempfile
+from threading import Condition, Lock, Thread, current_thread
+import time
 import unittest
 import logging
-from logging.handlers import RotatingFileHandler
+
+from allocation import FirstFit, MostStocked, OldestStock, RoundRobin
+from capacity import AdaptiveCapacity, FixedCapacity
+from clock import REAL_CLOCK, VirtualClock
+from marketplace_log import CallSampler, setup_logging
+from metrics import MarketplaceMetrics
+from order_sink import BatchedFileSink, BufferSink, StdoutSink
+from persistence import (ABANDON_CART, ADD_TO_CART, NEW_CART, PLACE_ORDER, PUBLISH,
+                         REGISTER_PRODUCER, REMOVE_FROM_CART, MarketplaceStore)
+from product_registry import ProductRegistry
+
+
+def deadline_after(timeout, clock=REAL_CLOCK):
+    """
+    Converts a timeout into a deadline.
+
+    :type timeout: Float
+    :param timeout: the number of seconds to wait. 0 does not wait, None waits forever
+
+    :type clock: RealClock
+    :param clock: the clock of the deadline
+
+    :rtype: Float
+    :return: the deadline, or None if there is none
+    """
+    if timeout is None:
+        return None
+
+    return clock.monotonic() + timeout
+
+
+def time_left(deadline, clock=REAL_CLOCK):
+    """
+    Returns the number of seconds left until a deadline.
+
+    :type deadline: Float
+    :param deadline: the deadline returned by deadline_after()
+
+    :type clock: RealClock
+    :param clock: the clock of the deadline
+
+    :rtype: Float
+    :return: the number of seconds left, 0 if it passed, None if there is no deadline
+    """
+    if deadline is None:
+        return None
+
+    return max(0, deadline - clock.monotonic())
+
+
+def wait_for(condition, predicate, timeout, clock=REAL_CLOCK):
+    """
+    Waits on a condition until the predicate is true. The lock of the condition
+    must be held by the caller.
+
+    :type condition: Condition
+    :param condition: the condition that is notified when the predicate may change
+
+    :type predicate: Callable
+    :param predicate: the state to wait for
+
+    :type timeout: Float
+    :param timeout: the number of seconds to wait. 0 does not wait, None waits forever
+
+    :type clock: RealClock
+    :param clock: the clock that waits
+
+    :rtype: bool
+    :return: True if the predicate is true, False if the timeout expired
+    """
+    if timeout == 0:
+        return bool(predicate())
+
+    return clock.wait_for(condition, predicate, timeout)
+
+
+class _StockStripe:
+    """
+    Class that represents a stripe of the inventory index. Every product belongs to
+    exactly one stripe, chosen by its id.
+    """
+    def __init__(self, lock):
+        """
+        Constructor
+
+        :type lock: Lock
+        :param lock: the lock for the stripe
+        """
+        # Initialize the lock for the stripe
+        self.lock = lock
+
+        # Initialize the condition used to wait for the products of the stripe
+        self.condition = Condition(self.lock)
+
+        # Initialize the inventory index: product id -> {producer id: None}, in the order
+        # the producers stocked it. Only the producers that have the product in stock are kept
+        self.index = {}
+
+        # Initialize the lines of the carts waiting for a product with fair waiting:
+        # product id -> heap of (-priority, ticket, waiter). A line is only kept while
+        # the product is out of stock
+        self.waiters = {}
+
+
+class _Waiter:
+    """
+    Class that represents a cart waiting in the line of a product. The units are taken
+    for it by the thread that stocks the product, which then wakes it up.
+    """
+    def __init__(self, lock, cart_id, quantity):
+        """
+        Constructor
+
+        :type lock: Lock
+        :param lock: the lock of the product's stripe
+
+        :type cart_id: Int
+        :param cart_id: the cart the units are for
+
+        :type quantity: Int
+        :param quantity: the number of units wanted
+        """
+        self.condition = Condition(lock)
+        self.cart_id = cart_id
+        self.quantity = quantity
+
+        # Initialize the (producer id, number of units) taken for the cart, None until
+        # it is served
+        self.taken = None
+
 
 class Marketplace:
     """
     Class that represents the Marketplace. It's the central part of the implementation.
     The producers and consumers use its methods concurrently.
+
+    Every producer queue, every cart and every stripe of the inventory index has its
+    own lock. When an operation needs more than one of them, they are always acquired
+    in this order, so no two operations can deadlock:
+
+        cart lock -> stock stripe lock -> producer lock
+
+    An operation that needs several stripes (reserve) takes them in the order of
+    their indexes.
+
+    The producers_lock and consumers_carts_lock only protect registering a new
+    producer or cart and are never held together with another lock, and neither
+    is the reservations_lock: the waits read the earliest deadline of a cart before
+    taking their locks. Expiring a cart only tries its cart lock, without waiting,
+    so it is never held in the wrong order either, and it runs with no lock held.
     """
-    def __init__(self, queue_size_per_producer):
+    # The methods measured when the metrics are enabled, and if False or 0 means rejected
+    MEASURED_METHODS = {'register_producer': False, 'publish': True, 'publish_many': True,
+                        'new_cart': False, 'add_to_cart': True, 'reserve': True,
+                        'remove_from_cart': False,
+                        'place_order': False, 'abandon_cart': False}
+
+    # A cart id holds the slot of the cart in its low bits and the generation of the
+    # slot above them. The first generation is 0, so the first carts get the ids 0, 1, ...
+    CART_SLOT_BITS = 32
+    CART_SLOT_MASK = (1 << CART_SLOT_BITS) - 1
+
+    def __init__(self, queue_size_per_producer, stock_stripes=64, log_level=logging.INFO,
+                 log_sampling=None, order_sink=None, metrics=False, allocation=None,
+                 store=None, clock=None, reservation_ttl=None, capacity=None,
+                 fair_waiting=False):
         """
         Constructor
 
         :type queue_size_per_producer: Int
         :param queue_size_per_producer: the maximum size of a queue associated with each producer
+
+        :type stock_stripes: Int
+        :param stock_stripes: the number of independently locked stripes of the inventory index
+
+        :type log_level: Int
+        :param log_level: the level of the marketplace logger. The calls are logged at INFO
+
+        :type log_sampling: Dict
+        :param log_sampling: method name -> fraction of its calls to log
+
+        :type order_sink: OrderSink
+        :param order_sink: where the placed orders are written, stdout by default
+
+        :type metrics: bool
+        :param metrics: if the latency of the methods and the locks should be measured.
+        When it is False, the methods and locks are not wrapped at all
+
+        :type allocation: AllocationPolicy
+        :param allocation: chooses the producer add_to_cart() takes the units from,
+        first fit by default
+
+        :type store: MarketplaceStore
+        :param store: where the changes are logged, to survive a crash. The marketplace
+        starts from the state recovered from it
+
+        :type clock: RealClock
+        :param clock: the clock the waits use, the wall clock by default. A VirtualClock
+        runs a simulation
+
+        :type reservation_ttl: Float
+        :param reservation_ttl: the number of seconds a cart keeps its products without
+        being used, before they go back to their producers' queues. None keeps them forever
+
+        :type capacity: CapacityPolicy
+        :param capacity: decides how many units every producer's queue can hold,
+        queue_size_per_producer units each by default
+
+        :type fair_waiting: bool
+        :param fair_waiting: if the carts waiting in add_to_cart() for a product are
+        served in order, the highest priority first, instead of racing for every unit
         """
         # Initialize the Marketplace
         self.queue_size_per_producer = queue_size_per_producer
+        self.clock = clock if clock is not None else REAL_CLOCK
 
-        # Initialize the producers list
-        self.producers = []
+        # Initialize the metrics
+        self.metrics = MarketplaceMetrics() if metrics else None
+
+        # Initialize the registry that gives every product a small integer id
+        self.registry = ProductRegistry()
+
+        # Initialize the inventory matrix: one row per producer, holding the quantity of
+        # every product id in its queue. A row grows when the producer publishes a new id
+        self.stock = []
+
+        # Initialize the striped inventory index
+        self.stock_stripes = [_StockStripe(self._new_lock('stock_stripe'))
+                              for _ in range(stock_stripes)]
 
         # Initialize the total number of elements a producer published
         self.total_producers_elements = []
 
-        # Initialize the costumer's cart list
+        # Initialize the costumer's cart list. A released slot holds None until it is
+        # reused, with the next generation, for a new cart
         self.consumers_carts = []
+        self.cart_generations = []
+        self.free_carts = []
+
+        # Initialize the lock for registering producers
+        self.producers_lock = self._new_lock('producers')
+
+        # Initialize the lock of every producer's queue and the condition used to wait
+        # for free space in it
+        self.producer_locks = []
+        self.capacity_conditions = []
+
+        # Initialize the number of threads waiting for free space in every producer's queue
+        self.capacity_waiting = []
+
+        # Initialize the lock for creating carts
+        self.consumers_carts_lock = self._new_lock('consumers_carts')
+
+        # Initialize the lock of every cart
+        self.cart_locks = []
+
+        # Initialize the reservation timeouts: the time to live and the deadline of
+        # every cart slot, and the heap of (deadline, cart id) of the carts that expire.
+        # A deadline that moved later is only pushed again when its entry is popped
+        self.reservation_ttl = reservation_ttl
+        self.cart_ttls = []
+        self.cart_deadlines = []
+        self.reservations = []
+        self.reservations_lock = self._new_lock('reservations')
+        self.expired_carts = 0
+
+        # Initialize the fair waiting: the tickets give the order of the carts in the
+        # lines, and a cart that stops waiting keeps its (product id, ticket), so it gets
+        # its place back when it waits for the product again
+        self.fair_waiting = fair_waiting
+        self.tickets = itertools.count()
+        self.cart_tickets = {}
+
+        # Initialize the sink of the placed orders
+        self.order_sink = order_sink if order_sink is not None else StdoutSink()
+
+        # Initialize the policy that chooses the producer to take the units from
+        self.allocation = allocation if allocation is not None else FirstFit()
+
+        # Initialize the policy that decides the size of every producer's queue
+        self.capacity = (capacity if capacity is not None
+                         else FixedCapacity(queue_size_per_producer))
+        self.capacity.use_clock(self.clock)
+
+        # Initialize the logger. The handler is added once per process and writes
+        # the records on a background thread
+        self.logger = setup_logging()
 
-        # Initialize the lock for the producers list
-        self.producers_lock = Lock()
-
-        # Initialize the lock for the total number of elements a producer published
-        self.total_producers_elements_lock = Lock()
+        # Set the logger level
+        self.logger.setLevel(log_level)
+
+        # Initialize the sampling of the logged calls
+        self.sample_log = CallSampler(self.logger, log_sampling)
+
+        # Initialize the durability. The recovered state is restored before the new
+        # changes are logged
+        self.store = None
+        if store is not None:
+            self._restore(store.recover())
+            self.registry.on_new = store.append_product
+            store.open()
+            self.store = store
+
+        # Measure the methods, by replacing them on this instance only
+        if self.metrics is not None:
+            for method, rejectable in self.MEASURED_METHODS.items():
+                setattr(self, method, self.metrics.timed(method, getattr(self, method),
+                                                         rejectable))
+
+    def _restore(self, state):
+        """
+        Rebuilds the products, the producers' queues and the carts of a recovered state.
+        Nothing else uses the marketplace yet, so no lock is taken.
 
-        # Initialize the lock for the costumer's cart list
-        self.consumers_carts_lock = Lock()
+        :type state: MarketplaceState
+        :param state: the recovered state
+        """
+        # Give the products the same ids, in the same order
+        for product in state.products:
+            self.registry.intern(product)
+
+        # Register the producers and put their products back in their queues
+        for row in state.stock:
+            producer_id = self.register_producer()
+            for product_id, quantity in enumerate(row):
+                if quantity:
+                    self._restock(self._stripe(product_id), producer_id, product_id, quantity)
+                    self.capacity.changed(producer_id, quantity)
+
+        # Put the live carts back in their slots, with the generations of the slots
+        self.cart_generations = list(state.cart_generations)
+        self.consumers_carts = [None] * len(self.cart_generations)
+        self.cart_locks = [self._new_lock('cart') for _ in self.cart_generations]
+        self.cart_ttls = [None] * len(self.cart_generations)
+        self.cart_deadlines = [None] * len(self.cart_generations)
+        for cart_id, cart in state.carts.items():
+            self.consumers_carts[cart_id & self.CART_SLOT_MASK] = cart
+            self._schedule_expiry(cart_id, self.reservation_ttl)
+        self.free_carts = [slot for slot, cart in enumerate(self.consumers_carts) if cart is None]
+
+    def _new_lock(self, kind):
+        """
+        Returns a new lock, measured if the metrics are enabled.
 
-        # Initialize print lock
-        self.print_lock = Lock()
+        :type kind: str
+        :param kind: the kind of lock, used to group the metrics
 
-        # Initialize the logger
-        self.logger = logging.getLogger('marketplace')
-        handler = RotatingFileHandler('marketplace.log')
+        :rtype: Lock
+        :return: the lock
+        """
+        if self.metrics is None:
+            return Lock()
 
-        # Set the logger format
-        formatter = logging.Formatter('%(asctime)s UTC/GMT - %(levelname)s - %(message)s')
-        handler.setFormatter(formatter)
+        return self.metrics.lock(kind)
 
-        # Add the handler to the logger
-        self.logger.addHandler(handler)
+    def stats(self):
+        """
+        Returns a snapshot of the metrics of the marketplace. The methods and locks are
+        only measured if the marketplace was created with metrics=True.
+
+        :rtype: Dict
+        :return: {'methods': per method calls, rejections, timeouts and latency histogram,
+        'locks': per kind of lock wait and hold time histograms,
+        'retries': the number of times the producers and the consumers tried again
+        after a rejected or partial call,
+        'inventory': the number of elements in every producer's queue,
+        'expired_carts': the number of carts whose reservation expired}
+        """
+        stats = self.metrics.snapshot() if self.metrics is not None else {'methods': {},
+                                                                           'locks': {},
+                                                                           'retries': {}}
+        stats['inventory'] = list(self.total_producers_elements)
+        stats['expired_carts'] = self.expired_carts
+        return stats
+
+    def count_retry(self, kind):
+        """
+        Counts a retry of a producer or a consumer, that calls the marketplace again
+        after a call that was rejected or only partly done. It is only counted if the
+        marketplace was created with metrics=True.
 
-        # Set the logger level
-        self.logger.setLevel(logging.INFO)
+        :type kind: str
+        :param kind: 'producer' or 'consumer'
+        """
+        if self.metrics is not None:
+            self.metrics.count(('retry', kind))
 
     def register_producer(self):
         """
         Returns an id for the producer that calls this.
         """
         # Log the call
-        self.logger.info("register_producer() called by %s", currentThread().getName())
+        log = self.sample_log("register_producer")
+        if log:
+            self.logger.info("register_producer() called")
 
         # Acquire the lock for the producers list
         self.producers_lock.acquire()
 
-        # Add a new producer in the producers list
-        self.producers.append([])
+        # Add the lock and the condition of the new producer's queue
+        producer_lock = self._new_lock('producer')
+        self.producer_locks.append(producer_lock)
+        self.capacity_conditions.append(Condition(producer_lock))
+        self.capacity_waiting.append(0)
 
         # Add a new producer in the total number of elements a producer published list
         self.total_producers_elements.append(0)
+        self.capacity.registered(len(self.stock))
+
+        # Add a new row in the inventory matrix. This is done last, because the
+        # number of rows is used to validate a producer id
+        self.stock.append(array('i'))
 
-        # Get the length of the producers list
-        producer_id = len(self.producers) - 1
+        # Get the number of rows of the inventory matrix
+        producer_id = len(self.stock) - 1
+
+        # Log the new producer, in the order of the ids
+        if self.store is not None:
+            self.store.append(REGISTER_PRODUCER)
 
         # Release the lock for the producers list
         self.producers_lock.release()
 
         # Log the exit
-        self.logger.info("register_producer() exited by %s", currentThread().getName())
+        if log:
+            self.logger.info("register_producer() exited")
 
-        # Return the index of the new producer in the producers list
+        # Return the row of the new producer in the inventory matrix
         return producer_id
 
-    def publish(self, producer_id, product):
+    def publish(self, producer_id, product, timeout=0):
         """
         Adds the product provided by the producer to the marketplace
 
@@ -99,81 +455,192 @@ class Marketplace:
         :type product: Product
         :param product: the Product that will be published in the Marketplace
 
+        :type timeout: Float
+        :param timeout: the number of seconds to wait for free space in the producer's queue.
+        0 does not wait, None waits until there is space
+
         :returns True or False. If the caller receives False, it should wait and then try again.
         """
         # Log the call with the parameters
-        self.logger.info("publish() called by %s with parameters: %s, %s",
-                         currentThread().getName(), str(producer_id), str(product))
+        log = self.sample_log("publish")
+        if log:
+            self.logger.info("publish() called with parameters: %s, %s", producer_id, product)
 
-        # Check if producer_id is valid
-        if producer_id < 0 or producer_id >= len(self.producers):
-            return False
+        published = self._publish(producer_id, product, 1, timeout)
 
-        # Check if the producer's queue is full
-        if self.total_producers_elements[producer_id] >= self.queue_size_per_producer:
-            return False
+        # Log the exit
+        if log:
+            self.logger.info("publish() exited")
 
-        # Acquire the lock for the producers list
-        self.producers_lock.acquire()
+        return published == 1
+
+    def publish_many(self, producer_id, product, quantity, timeout=0):
+        """
+        Adds up to quantity units of the product provided by the producer to the
+        marketplace, in a single critical section.
 
-        # Check if the product is already in the producer's queue
-        for i in range(len(self.producers[producer_id])):
-            if self.producers[producer_id][i][0] == product:
-                # Increase the quantity of the product in the producer's queue
-                self.producers[producer_id][i][1] += 1
+        :type producer_id: String
+        :param producer_id: producer id
 
-                # Acquire the lock for the total number of elements a producer published
-                self.total_producers_elements_lock.acquire()
-                self.total_producers_elements[producer_id] += 1
-                self.total_producers_elements_lock.release()
+        :type product: Product
+        :param product: the Product that will be published in the Marketplace
 
-                # Release the lock for the producers list
-                self.producers_lock.release()
-                return True
+        :type quantity: Int
+        :param quantity: the number of units to publish
 
-        # If the product is not in the producer's queue, add it
-        self.producers[producer_id].append([product, 1])
-        self.total_producers_elements_lock.acquire()
-        self.total_producers_elements[producer_id] += 1
-        self.total_producers_elements_lock.release()
+        :type timeout: Float
+        :param timeout: the number of seconds to wait for free space in the producer's queue.
+        0 does not wait, None waits until there is space
 
-        # Release the lock for the producers list
-        self.producers_lock.release()
+        :returns the number of units published. It is lower than quantity if the producer's
+        queue filled up, and the caller should publish the rest later.
+        """
+        # Log the call with the parameters
+        log = self.sample_log("publish_many")
+        if log:
+            self.logger.info("publish_many() called with parameters: %s, %s, %s",
+                             producer_id, product, quantity)
+
+        published = self._publish(producer_id, product, quantity, timeout)
 
         # Log the exit
-        self.logger.info("publish() exited by %s", currentThread().getName())
+        if log:
+            self.logger.info("publish_many() exited")
 
-        return True
+        return published
 
-    def new_cart(self):
+    def _publish(self, producer_id, product, quantity, timeout):
+        """
+        Adds up to quantity units of the product to the producer's queue, waiting for
+        free space for at most timeout seconds.
+
+        :type producer_id: Int
+        :param producer_id: producer id
+
+        :type product: Product
+        :param product: the Product that will be published in the Marketplace
+
+        :type quantity: Int
+        :param quantity: the number of units to publish
+
+        :type timeout: Float
+        :param timeout: the number of seconds to wait for free space in the producer's queue
+
+        :rtype: Int
+        :return: the number of units published
+        """
+        # Check if producer_id is valid
+        if producer_id < 0 or producer_id >= len(self.stock) or quantity <= 0:
+            return 0
+
+        product_id = self.registry.intern(product)
+        stripe = self._stripe(product_id)
+        producer_lock = self.producer_locks[producer_id]
+        deadline = deadline_after(timeout, self.clock)
+
+        def free_space():
+            return self.capacity.free_space(producer_id,
+                                            self.total_producers_elements[producer_id])
+
+        while True:
+            # Acquire the lock for the product's stripe
+            with stripe.lock:
+                # Acquire the lock for the producer's queue and check if it is full
+                with producer_lock:
+                    published = self.capacity.acquire(
+                        producer_id, self.total_producers_elements[producer_id], quantity)
+                    if published > 0:
+                        self._restock(stripe, producer_id, product_id, published)
+                        if self.store is not None:
+                            self.store.append(PUBLISH, 0, product_id, producer_id, published)
+
+                if published > 0:
+                    # Serve the carts waiting for the product
+                    self._stocked(stripe, product_id)
+                    return published
+
+            # Wait for free space, holding only the lock of the producer's queue. The wait
+            # also ends at the earliest deadline of a cart, to expire it: the consumers
+            # waiting for its products may then take this producer's units. And it ends
+            # when the capacity policy may change the limits, to check them again
+            timeout = time_left(deadline, self.clock)
+            wake_up = [seconds for seconds in (self._next_expiry(), self.capacity.next_change())
+                       if seconds is not None]
+            wake_up = min(wake_up) if wake_up else None
+            with producer_lock:
+                self.capacity_waiting[producer_id] += 1
+                try:
+                    if wake_up is not None and (timeout is None or wake_up < timeout):
+                        # A cart expires or the limits change first: try again after it
+                        wait_for(self.capacity_conditions[producer_id],
+                                 lambda: free_space() > 0, wake_up, self.clock)
+                    elif not wait_for(self.capacity_conditions[producer_id],
+                                      lambda: free_space() > 0, timeout, self.clock):
+                        return 0
+                finally:
+                    self.capacity_waiting[producer_id] -= 1
+
+            self._expire_due()
+
+    def new_cart(self, reservation_ttl=None):
         """
         Creates a new cart for the consumer
 
+        :type reservation_ttl: Float
+        :param reservation_ttl: the time to live of the cart's reservation, the one of
+        the marketplace by default
+
         :returns an int representing the cart_id
         """
         # Log the call
-        self.logger.info("new_cart() called by %s", currentThread().getName())
+        log = self.sample_log("new_cart")
+        if log:
+            self.logger.info("new_cart() called")
+
+        # Give back the products of the carts that expired
+        self._expire_due()
 
         # Acquire the lock for the costumer's cart list
         self.consumers_carts_lock.acquire()
 
-        # Add a new cart in the costumer's cart list
-        self.consumers_carts.append([])
+        if self.free_carts:
+            # Reuse the slot of a released cart
+            slot = self.free_carts.pop()
+        else:
+            # Add the lock of the new cart and a new slot in the costumer's cart list
+            self.cart_locks.append(self._new_lock('cart'))
+            self.cart_generations.append(0)
+            self.cart_ttls.append(None)
+            self.cart_deadlines.append(None)
+            self.consumers_carts.append(None)
+            slot = len(self.consumers_carts) - 1
+
+        # Put an empty cart in the slot
+        self.consumers_carts[slot] = {}
+
+        # Tag the slot with its generation, so the ids of the previous carts are stale
+        cart_id = self.cart_generations[slot] << self.CART_SLOT_BITS | slot
 
-        # Get the length of the costumer's cart list
-        cart_id = len(self.consumers_carts) - 1
+        # Log the new cart
+        if self.store is not None:
+            self.store.append(NEW_CART, cart_id)
 
         # Release the lock for the costumer's cart list
         self.consumers_carts_lock.release()
 
+        # Start the reservation timeout of the cart
+        self._schedule_expiry(cart_id, reservation_ttl if reservation_ttl is not None
+                      else self.reservation_ttl)
+
         # Log the exit
-        self.logger.info("new_cart() exited by %s", currentThread().getName())
+        if log:
+            self.logger.info("new_cart() exited")
 
-        # Return the index of the new cart in the costumer's cart list
+        # Return the id of the new cart
         return cart_id
 
 
-    def add_to_cart(self, cart_id, product):
+    def add_to_cart(self, cart_id, product, timeout=0, quantity=None, priority=0):
         """
         Adds a product to the given cart. The method returns
 
@@ -183,165 +650,920 @@ class Marketplace:
         :type product: Product
         :param product: the product to add to cart
 
+        :type timeout: Float
+        :param timeout: the number of seconds to wait for the product to be published.
+        0 does not wait, None waits until the product is in stock
+
+        :type quantity: Int
+        :param quantity: the number of units to add, in a single critical section.
+        If it is given, the method returns the number of units added instead of True or False
+
+        :type priority: Int
+        :param priority: with fair waiting, the carts with a higher priority are served
+        before the ones that waited longer
+
         :returns True or False. If the caller receives False, it should wait and then try again
         """
         # Log the call with the parameters
-        self.logger.info("add_to_cart() called by %s with parameters: %s, %s",
-                         currentThread().getName(), str(cart_id), str(product))
+        log = self.sample_log("add_to_cart")
+        if log:
+            self.logger.info("add_to_cart() called with parameters: %s, %s", cart_id, product)
+
+        wanted = 1 if quantity is None else quantity
+        added = 0
+
+        # Give back the products of the carts that expired, they may be the ones wanted
+        self._expire_due()
+
+        # Check if the cart_id is valid. A product that was never published only gets an
+        # id if the caller waits for it, so a product that does not exist costs nothing
+        if self._cart_slot(cart_id) is not None and wanted > 0:
+            product_id = (self.registry.lookup(product) if timeout == 0
+                          else self.registry.intern(product))
+            if product_id is not None:
+                added = self._add_to_cart(cart_id, product_id, wanted, timeout, priority)
+
+        # Log the exit
+        if log:
+            self.logger.info("add_to_cart() exited")
+
+        if quantity is None:
+            return added == 1
+
+        return added
+
+    def _add_to_cart(self, cart_id, product_id, quantity, timeout, priority):
+        """
+        Moves up to quantity units of the product from the producers' queues to the cart,
+        waiting for the product for at most timeout seconds.
+
+        :type cart_id: Int
+        :param cart_id: id cart
+
+        :type product_id: Int
+        :param product_id: the id of the product to add to cart
+
+        :type quantity: Int
+        :param quantity: the number of units to add
+
+        :type timeout: Float
+        :param timeout: the number of seconds to wait for the product to be published
+
+        :type priority: Int
+        :param priority: the priority of the cart in the product's line, with fair waiting
+
+        :rtype: Int
+        :return: the number of units added
+        """
+        stripe = self._stripe(product_id)
+        slot = cart_id & self.CART_SLOT_MASK
+        deadline = deadline_after(timeout, self.clock)
+
+        while True:
+            # The wait also ends at the earliest deadline of a cart, to expire it: its
+            # products may be the ones wanted. It is read before taking any lock
+            wait = time_left(deadline, self.clock)
+            expiry = self._next_expiry()
+            expiring = expiry is not None and (wait is None or expiry < wait)
+            if expiring:
+                wait = expiry
+
+            # Acquire the lock for the cart. It stays held while waiting, because only the
+            # consumer that owns the cart uses it
+            with self.cart_locks[slot]:
+                # Check if the cart was released in the meantime
+                if self._cart_slot(cart_id) is None:
+                    return 0
+
+                # Acquire the lock for the product's stripe
+                with stripe.lock:
+                    if self.fair_waiting:
+                        # Wait in the product's line. The cart keeps its ticket if it
+                        # leaves it to expire the carts
+                        taken = self._wait_in_line(stripe, cart_id, product_id, quantity,
+                                                   wait, priority)
+                    else:
+                        # Check if the product is in stock and wait for it to be published
+                        taken = []
+                        if wait_for(stripe.condition, lambda: stripe.index.get(product_id),
+                                    wait, self.clock):
+                            # Take the product from the producers that have it in stock
+                            taken = self._take_for_cart(stripe, cart_id, product_id, quantity)
+
+                    # The cart was used, after the wait
+                    self._touch_cart(slot)
+
+                # Add it to cart, counting the units of every producer
+                lines = self.consumers_carts[slot].setdefault(product_id, {})
+                for producer_index, count in taken:
+                    lines[producer_index] = lines.get(producer_index, 0) + count
+
+            if taken or not expiring:
+                return sum(count for _, count in taken)
+
+            # A cart expires first: expire it, without holding any lock, and wait again
+            self._expire_due()
+
+    def _take_for_cart(self, stripe, cart_id, product_id, quantity):
+        """
+        Takes up to quantity units of the product for a cart, and logs them. The lock of
+        the stripe must be held by the caller; the cart is filled by the caller.
+
+        :type stripe: _StockStripe
+        :param stripe: the stripe of the product
+
+        :type cart_id: Int
+        :param cart_id: id cart
+
+        :type product_id: Int
+        :param product_id: the id of the product
+
+        :type quantity: Int
+        :param quantity: the number of units to take
+
+        :rtype: List
+        :return: a list of (producer id, number of units taken from it)
+        """
+        taken = self._take_stock(stripe, product_id, quantity)
+        if self.store is not None:
+            for producer_index, count in taken:
+                self.store.append(ADD_TO_CART, cart_id, product_id, producer_index, count)
+
+        return taken
+
+    def _wait_in_line(self, stripe, cart_id, product_id, quantity, timeout, priority):
+        """
+        Takes up to quantity units of the product for a cart with fair waiting. The
+        product is only in stock when nobody waits for it, so the units are taken at
+        once if there are some. Otherwise the cart joins the product's line, and the
+        thread that stocks the product takes the units for the carts at the head of it.
+        The locks of the cart and of the stripe must be held by the caller.
+
+        :type stripe: _StockStripe
+        :param stripe: the stripe of the product
+
+        :type cart_id: Int
+        :param cart_id: id cart
+
+        :type product_id: Int
+        :param product_id: the id of the product
+
+        :type quantity: Int
+        :param quantity: the number of units wanted
+
+        :type timeout: Float
+        :param timeout: the number of seconds to wait, None waits until the cart is served
+
+        :type priority: Int
+        :param priority: the priority of the cart
+
+        :rtype: List
+        :return: a list of (producer id, number of units taken from it), empty if the
+        timeout expired
+        """
+        slot = cart_id & self.CART_SLOT_MASK
+        if stripe.index.get(product_id):
+            self.cart_tickets.pop(slot, None)
+            return self._take_for_cart(stripe, cart_id, product_id, quantity)
+
+        if timeout == 0:
+            return []
+
+        # Join the line with the ticket of the last wait for the product, or a new one
+        ticket = self.cart_tickets.get(slot)
+        if ticket is None or ticket[0] != product_id:
+            ticket = self.cart_tickets[slot] = (product_id, next(self.tickets))
+
+        waiter = _Waiter(stripe.lock, cart_id, quantity)
+        entry = (-priority, ticket[1], waiter)
+        line = stripe.waiters.setdefault(product_id, [])
+        heapq.heappush(line, entry)
+
+        if wait_for(waiter.condition, lambda: waiter.taken is not None, timeout, self.clock):
+            self.cart_tickets.pop(slot, None)
+            return waiter.taken
+
+        # The timeout expired before the cart was served: leave the line
+        line.remove(entry)
+        heapq.heapify(line)
+        if not line:
+            del stripe.waiters[product_id]
+        return []
+
+    def _stocked(self, stripe, product_id):
+        """
+        Serves the carts waiting for a product that was stocked: with fair waiting the
+        units go to the carts at the head of its line, the highest priority and the
+        oldest ticket first, and the carts left racing for it are woken up. The lock of
+        the stripe must be held by the caller.
+
+        :type stripe: _StockStripe
+        :param stripe: the stripe of the product
+
+        :type product_id: Int
+        :param product_id: the id of the product
+        """
+        line = stripe.waiters.get(product_id)
+        while line and stripe.index.get(product_id):
+            _, _, waiter = heapq.heappop(line)
+            waiter.taken = self._take_for_cart(stripe, waiter.cart_id, product_id,
+                                               waiter.quantity)
+            waiter.condition.notify()
+
+        if line is not None and not line:
+            del stripe.waiters[product_id]
+
+        # Wake up the consumers waiting for stock
+        stripe.condition.notify_all()
+
+    def reserve(self, cart_id, items, timeout=0):
+        """
+        Adds several products to the given cart, all of them or none of them, so a
+        consumer never holds part of what it needs while waiting for the rest.
+
+        :type cart_id: Int
+        :param cart_id: id cart
+
+        :type items: List
+        :param items: a list of (product, quantity) to add to cart
+
+        :type timeout: Float
+        :param timeout: the number of seconds to wait for all the products to be in stock.
+        0 does not wait, None waits until they are
+
+        :returns True if every unit was added, False if none was
+        """
+        # Log the call with the parameters
+        log = self.sample_log("reserve")
+        if log:
+            self.logger.info("reserve() called with parameters: %s, %s", cart_id, items)
+
+        # Give back the products of the carts that expired, they may be the ones wanted
+        self._expire_due()
+
+        # Add up the quantities of every product. A product that was never published
+        # only gets an id if the caller waits for it, else it can not be reserved
+        wanted = {}
+        for product, quantity in items:
+            product_id = (self.registry.lookup(product) if timeout == 0
+                          else self.registry.intern(product))
+            if product_id is None:
+                wanted = None
+                break
+            wanted[product_id] = wanted.get(product_id, 0) + quantity
+
+        deadline = deadline_after(timeout, self.clock)
+        reserved = False
+        while wanted is not None and self._cart_slot(cart_id) is not None:
+            # Take every unit, or find a product that is missing
+            missing = self._reserve(cart_id, wanted)
+            if missing is None:
+                reserved = True
+                break
+
+            # Wait for the missing product, then try all of them again. The wait also
+            # ends at the earliest deadline of a cart, to expire it
+            wait = time_left(deadline, self.clock)
+            expiry = self._next_expiry()
+            expiring = expiry is not None and (wait is None or expiry < wait)
+            stripe = self._stripe(missing)
+            with stripe.lock:
+                if not wait_for(stripe.condition,
+                                lambda: self._in_stock(stripe, missing) >= wanted[missing],
+                                expiry if expiring else wait, self.clock) and not expiring:
+                    break
+
+            # The waiting cart is in use: move its deadline, then expire the others
+            if expiring:
+                slot = cart_id & self.CART_SLOT_MASK
+                with self.cart_locks[slot]:
+                    if self._cart_slot(cart_id) is not None:
+                        self._touch_cart(slot)
+                self._expire_due()
+
+        # Log the exit
+        if log:
+            self.logger.info("reserve() exited")
+
+        return reserved
+
+    def _reserve(self, cart_id, wanted):
+        """
+        Moves every wanted unit from the producers' queues to the cart if all of them
+        are in stock, or none of them. The locks of the stripes are taken in the order
+        of their indexes.
+
+        :type cart_id: Int
+        :param cart_id: id cart
+
+        :type wanted: Dict
+        :param wanted: product id -> number of units
+
+        :rtype: Int
+        :return: None if the units were added, else the id of a product that is missing.
+        A released cart is not missing anything
+        """
+        slot = cart_id & self.CART_SLOT_MASK
+        stripes = sorted({product_id % len(self.stock_stripes) for product_id in wanted})
+
+        # Acquire the lock for the cart
+        with self.cart_locks[slot]:
+            # Check if the cart was released in the meantime
+            if self._cart_slot(cart_id) is None:
+                return None
+
+            # The cart was used
+            self._touch_cart(slot)
+
+            # Acquire the locks for the products' stripes, in order
+            for index in stripes:
+                self.stock_stripes[index].lock.acquire()
+            try:
+                # Check that every product is in stock
+                for product_id, quantity in wanted.items():
+                    if self._in_stock(self._stripe(product_id), product_id) < quantity:
+                        return product_id
+
+                # Take every product from the producers that have it in stock
+                cart = self.consumers_carts[slot]
+                for product_id, quantity in wanted.items():
+                    taken = self._take_stock(self._stripe(product_id), product_id, quantity)
+                    lines = cart.setdefault(product_id, {})
+                    for producer_index, count in taken:
+                        lines[producer_index] = lines.get(producer_index, 0) + count
+                        if self.store is not None:
+                            self.store.append(ADD_TO_CART, cart_id, product_id, producer_index,
+                                              count)
+            finally:
+                for index in reversed(stripes):
+                    self.stock_stripes[index].lock.release()
+
+        return None
+
+    def _in_stock(self, stripe, product_id):
+        """
+        Returns the number of units of the product in all the producers' queues. The
+        lock of the stripe must be held by the caller.
+
+        :type stripe: _StockStripe
+        :param stripe: the stripe of the product
+
+        :type product_id: Int
+        :param product_id: the id of the product
+
+        :rtype: Int
+        :return: the number of units in stock
+        """
+        return sum(self.stock[producer_index][product_id]
+                   for producer_index in stripe.index.get(product_id, ()))
+
+    def remove_from_cart(self, cart_id, product, quantity=None):
+        """
+        Removes a product from cart.
+
+        :type cart_id: Int
+        :param cart_id: id cart
+
+        :type product: Product
+        :param product: the product to remove from cart
+
+        :type quantity: Int
+        :param quantity: the number of units to remove, in a single critical section.
+        If it is given, the method returns the number of units removed
+        """
+        # Log the call with the parameters
+        log = self.sample_log("remove_from_cart")
+        if log:
+            self.logger.info("remove_from_cart() called with parameters: %s, %s",
+                             cart_id, product)
+
+        wanted = 1 if quantity is None else quantity
+        removed = 0
+
+        # Check if the cart_id is valid and if the product was ever published
+        product_id = self.registry.lookup(product)
+        if self._cart_slot(cart_id) is not None and wanted > 0 and product_id is not None:
+            removed = self._remove_from_cart(cart_id, product_id, wanted)
+
+        # Log the exit
+        if log:
+            self.logger.info("remove_from_cart() exited")
+
+        if quantity is None:
+            return None
+
+        return removed
+
+    def _remove_from_cart(self, cart_id, product_id, quantity):
+        """
+        Moves up to quantity units of the product from the cart back to the queues of
+        the producers that published them.
+
+        :type cart_id: Int
+        :param cart_id: id cart
+
+        :type product_id: Int
+        :param product_id: the id of the product to remove from cart
+
+        :type quantity: Int
+        :param quantity: the number of units to remove
+
+        :rtype: Int
+        :return: the number of units removed
+        """
+        slot = cart_id & self.CART_SLOT_MASK
+
+        # Acquire the lock for the cart
+        with self.cart_locks[slot]:
+            # Check if the cart was released in the meantime
+            if self._cart_slot(cart_id) is None:
+                return 0
+
+            # The cart was used
+            self._touch_cart(slot)
+
+            # The product is not in the cart
+            cart = self.consumers_carts[slot]
+            lines = cart.get(product_id)
+            if lines is None:
+                return 0
+
+            # Take the first units of the product out of the cart, with their producers
+            returned = {}
+            for producer_index in list(lines):
+                count = min(quantity, lines[producer_index])
+                returned[producer_index] = count
+                quantity -= count
+
+                if count == lines[producer_index]:
+                    del lines[producer_index]
+                else:
+                    lines[producer_index] -= count
+
+                if quantity == 0:
+                    break
+
+            if not lines:
+                del cart[product_id]
+
+            # Log the units before they are back in stock, so they are never logged as
+            # taken by another cart before they are logged as returned
+            if self.store is not None:
+                for producer_index, count in returned.items():
+                    self.store.append(REMOVE_FROM_CART, cart_id, product_id, producer_index, count)
+
+            # Add the product back to the producers' queues
+            self._return_stock(product_id, returned)
+
+        return sum(returned.values())
+
+    def place_order(self, cart_id, name=None):
+        """
+        Return a list with all the products in the cart. The cart is released, so its
+        id can not be used anymore.
+
+        :type cart_id: Int
+        :param cart_id: id cart
+
+        :type name: str
+        :param name: the name of the consumer on the receipt, the name of the current
+        thread by default
+        """
+        # Log the call with the parameters
+        log = self.sample_log("place_order")
+        if log:
+            self.logger.info("place_order() called with parameters: %s", cart_id)
 
         # Check if the cart_id is valid
-        if cart_id < 0 or cart_id >= len(self.consumers_carts):
+        slot = self._cart_slot(cart_id)
+        if slot is None:
             return False
 
-        # Acquire the lock for the producers list
-        self.producers_lock.acquire()
+        # Acquire the lock for the cart
+        with self.cart_locks[slot]:
+            # Check if the cart was released in the meantime
+            if self._cart_slot(cart_id) is None:
+                return False
 
-        # Remember the index of the producer that has the product
-        producer_index = -1
-        product_index = -1
-
-        # Check if the product is in the producers list
-        for i in range(len(self.producers)):
-            for j in range(len(self.producers[i])):
-                if self.producers[i][j][0] == product and self.producers[i][j][1] > 0:
-                    # The product is in the producers list
-                    producer_index = i
-                    product_index = j
-                    break
+            # Get the cart and release it
+            cart = self.consumers_carts[slot]
+            self._release_cart(slot)
+            if self.store is not None:
+                self.store.append(PLACE_ORDER, cart_id)
+
+        # Make the slot available to new carts
+        self._free_cart(slot)
+
+        # Expand the cart into a [product, producer id] element for every unit and
+        # write the receipt, after releasing the lock
+        cart = self.expand_cart(cart)
+        self.order_sink.emit(name if name is not None else current_thread().name, cart)
+
+        # Log the exit
+        if log:
+            self.logger.info("place_order() exited")
+
+        # Return the cart
+        return cart
+
+    def abandon_cart(self, cart_id):
+        """
+        Puts every product in the cart back in its producer's queue and releases the
+        cart, so its id can not be used anymore.
+
+        :type cart_id: Int
+        :param cart_id: id cart
 
-        # Check if the product is in the producers list
-        if producer_index == -1:
-            # The product is not in the producers list
-            self.producers_lock.release()
+        :returns True, or False if the cart_id is not valid
+        """
+        # Log the call with the parameters
+        log = self.sample_log("abandon_cart")
+        if log:
+            self.logger.info("abandon_cart() called with parameters: %s", cart_id)
+
+        # Check if the cart_id is valid
+        slot = self._cart_slot(cart_id)
+        if slot is None:
             return False
 
         # Acquire the lock for the cart
-        self.consumers_carts_lock.acquire()
+        with self.cart_locks[slot]:
+            # Check if the cart was released in the meantime
+            if self._cart_slot(cart_id) is None:
+                return False
 
-        # Add it to cart
-        self.consumers_carts[cart_id].append([product, producer_index])
+            # Add the products back to the producers' queues and release the cart
+            self._abandon(cart_id, slot)
 
-        # Remove the product from the producer's queue
-        self.producers[producer_index][product_index][1] -= 1
+        # Make the slot available to new carts
+        self._free_cart(slot)
 
-        # Acquire the lock for the total number of elements a producer published
-        self.total_producers_elements_lock.acquire()
-        self.total_producers_elements[producer_index] -= 1
-        self.total_producers_elements_lock.release()
+        # Log the exit
+        if log:
+            self.logger.info("abandon_cart() exited")
 
-        # Release the lock for the cart
-        self.consumers_carts_lock.release()
+        return True
 
-        # Release the lock for the producers list
-        self.producers_lock.release()
+    def _abandon(self, cart_id, slot):
+        """
+        Puts every product in a cart back in its producer's queue and releases the cart.
+        The lock of the cart must be held by the caller.
+
+        :type cart_id: Int
+        :param cart_id: id cart
+
+        :type slot: Int
+        :param slot: the slot of the cart
+        """
+        # Log the abandoned cart before its products are back in stock
+        if self.store is not None:
+            self.store.append(ABANDON_CART, cart_id)
+
+        for product_id, lines in self.consumers_carts[slot].items():
+            self._return_stock(product_id, lines)
+        self._release_cart(slot)
+
+    def cart_alive(self, cart_id):
+        """
+        Returns if a cart can still be used: it was not placed, abandoned or expired.
+
+        :type cart_id: Int
+        :param cart_id: id cart
+
+        :rtype: bool
+        :return: True if the cart is live
+        """
+        return self._cart_slot(cart_id) is not None
+
+    def _schedule_expiry(self, cart_id, ttl):
+        """
+        Starts the reservation timeout of a new cart.
+
+        :type cart_id: Int
+        :param cart_id: id cart
+
+        :type ttl: Float
+        :param ttl: the time to live of the reservation, None never expires
+        """
+        slot = cart_id & self.CART_SLOT_MASK
+        self.cart_ttls[slot] = ttl
+        if ttl is None:
+            self.cart_deadlines[slot] = None
+            return
+
+        deadline = self.clock.monotonic() + ttl
+        self.cart_deadlines[slot] = deadline
+        with self.reservations_lock:
+            heapq.heappush(self.reservations, (deadline, cart_id))
+
+    def _touch_cart(self, slot):
+        """
+        Moves the deadline of a used cart later. The lock of the cart must be held by the caller.
+
+        :type slot: Int
+        :param slot: the slot of the cart
+        """
+        ttl = self.cart_ttls[slot]
+        if ttl is not None:
+            self.cart_deadlines[slot] = self.clock.monotonic() + ttl
+
+    def _expire_due(self):
+        """
+        Expires the carts if the earliest deadline passed. It is cheap when none did.
+        """
+        reservations = self.reservations
+        if reservations and reservations[0][0] <= self.clock.monotonic():
+            self.expire_reservations()
+
+    def _next_expiry(self):
+        """
+        Returns the number of seconds until the earliest deadline of a cart.
+
+        :rtype: Float
+        :return: the number of seconds, 0 if it passed, or None if no cart has a deadline
+        """
+        with self.reservations_lock:
+            earliest = self.reservations[0][0] if self.reservations else None
+        return time_left(earliest, self.clock)
+
+    def expire_reservations(self):
+        """
+        Puts the products of the carts that were not used for their time to live back
+        in their producers' queues, and releases the carts. A cart that is being used
+        is skipped: its lock is only tried, and it gets a later deadline when the
+        operation ends. new_cart(), add_to_cart(), reserve() and a publish waiting for
+        free space call this when a deadline passed.
+
+        :rtype: Int
+        :return: the number of expired carts
+        """
+        now = self.clock.monotonic()
+
+        # Take the entries that are due
+        with self.reservations_lock:
+            due = []
+            while self.reservations and self.reservations[0][0] <= now:
+                due.append(heapq.heappop(self.reservations)[1])
+
+        expired = 0
+        later = []
+        for cart_id in due:
+            # The cart was placed or abandoned
+            slot = self._cart_slot(cart_id)
+            if slot is None:
+                continue
+
+            # The cart is being used, check it again after its time to live
+            cart_lock = self.cart_locks[slot]
+            if not cart_lock.acquire(blocking=False):
+                later.append((now + self.cart_ttls[slot], cart_id))
+                continue
+
+            try:
+                # Check if the cart was released or used in the meantime
+                if self._cart_slot(cart_id) is None:
+                    continue
+                deadline = self.cart_deadlines[slot]
+                if deadline > now:
+                    later.append((deadline, cart_id))
+                    continue
+
+                self._abandon(cart_id, slot)
+            finally:
+                cart_lock.release()
+
+            # Make the slot available to new carts
+            self._free_cart(slot)
+            expired += 1
+
+        # Push the deadlines that moved later
+        if later:
+            with self.reservations_lock:
+                for entry in later:
+                    heapq.heappush(self.reservations, entry)
+
+        if expired:
+            with self.reservations_lock:
+                self.expired_carts += expired
+            if self.sample_log("expire_reservations"):
+                self.logger.info("expire_reservations() expired %s carts", expired)
+
+        return expired
+
+    def _cart_slot(self, cart_id):
+        """
+        Returns the slot of a live cart.
+
+        :type cart_id: Int
+        :param cart_id: id cart
+
+        :rtype: Int
+        :return: the slot of the cart, or None if the id is not valid or the cart was released
+        """
+        slot = cart_id & self.CART_SLOT_MASK
+        if (cart_id < 0 or slot >= len(self.consumers_carts)
+                or self.consumers_carts[slot] is None
+                or self.cart_generations[slot] != cart_id >> self.CART_SLOT_BITS):
+            return None
+
+        return slot
+
+    def _release_cart(self, slot):
+        """
+        Empties a cart's slot and moves it to the next generation, so the id of the
+        cart becomes stale. The lock of the cart must be held by the caller.
+
+        :type slot: Int
+        :param slot: the slot of the cart
+        """
+        self.consumers_carts[slot] = None
+        self.cart_generations[slot] += 1
+        self.cart_tickets.pop(slot, None)
+
+    def _free_cart(self, slot):
+        """
+        Adds a released slot to the free list, so new_cart() can reuse it.
+
+        :type slot: Int
+        :param slot: the slot of the cart
+        """
+        with self.consumers_carts_lock:
+            self.free_carts.append(slot)
+
+    def expand_cart(self, cart):
+        """
+        Returns the units of a cart, one by one.
 
-        # Log the exit
-        self.logger.info("add_to_cart() exited by %s", currentThread().getName())
+        :type cart: Dict
+        :param cart: product id -> {producer id: number of units}
 
-        return True
+        :rtype: List
+        :return: a [product, producer id] element for every unit in the cart
+        """
+        products = self.registry.products
+        return [[products[product_id], producer_index]
+                for product_id, lines in cart.items()
+                for producer_index, count in lines.items()
+                for _ in range(count)]
 
-    def remove_from_cart(self, cart_id, product):
+    def producer_queue(self, producer_id):
         """
-        Removes a product from cart.
+        Returns the products in the producer's queue.
 
-        :type cart_id: Int
-        :param cart_id: id cart
+        :type producer_id: Int
+        :param producer_id: producer id
 
-        :type product: Product
-        :param product: the product to remove from cart
+        :rtype: List
+        :return: a [product, quantity] list for every product the producer has in stock
         """
-        # Log the call with the parameters
-        self.logger.info("remove_from_cart() called by %s with parameters: %s, %s",
-                         currentThread().getName(), str(cart_id), str(product))
+        products = self.registry.products
+        with self.producer_locks[producer_id]:
+            return [[products[product_id], quantity]
+                    for product_id, quantity in enumerate(self.stock[producer_id]) if quantity]
 
-        if cart_id < 0 or cart_id >= len(self.consumers_carts):
-            return
+    def _return_stock(self, product_id, returned):
+        """
+        Adds units of the product taken out of a cart back to the queues of the producers
+        that published them.
 
-        # Acquire the lock for the cart
-        self.consumers_carts_lock.acquire()
+        :type product_id: Int
+        :param product_id: the id of the product
 
-        # Remember the index of the producer that has the product
-        producer_index = -1
+        :type returned: Dict
+        :param returned: producer id -> number of units
+        """
+        stripe = self._stripe(product_id)
 
-        # Remember index to delete from cart
-        remove_product_idx = -1
+        # Acquire the lock for the product's stripe
+        with stripe.lock:
+            raised = []
+            for producer_index, count in returned.items():
+                # Add the product to the producer's queue
+                with self.producer_locks[producer_index]:
+                    self._restock(stripe, producer_index, product_id, count)
+                    raised += self.capacity.changed(producer_index, count)
 
-        # Find the product in the cart
-        for i in range(len(self.consumers_carts[cart_id])):
-            if self.consumers_carts[cart_id][i][0] == product:
-                # The product is in the cart
-                producer_index = self.consumers_carts[cart_id][i][1]
-                remove_product_idx = i
-                break
+            # Wake up the producers whose limit grew
+            if raised:
+                self._wake_producers(raised)
 
-        # Acquire the lock for the producers list
-        self.producers_lock.acquire()
+            # Serve the carts waiting for the product
+            self._stocked(stripe, product_id)
 
-        # Add the product to the producer's queue
-        for i in range(len(self.producers[producer_index])):
-            if self.producers[producer_index][i][0] == product:
-                self.producers[producer_index][i][1] += 1
-                break
+    def _restock(self, stripe, producer_id, product_id, quantity):
+        """
+        Adds units of the product to the producer's queue. The locks of the stripe and
+        of the producer's queue must be held by the caller.
 
-        # Acquire the lock for the total number of elements a producer published
-        self.total_producers_elements_lock.acquire()
-        self.total_producers_elements[producer_index] += 1
-        self.total_producers_elements_lock.release()
+        :type stripe: _StockStripe
+        :param stripe: the stripe of the product
 
-        # Remove the product from the cart
-        del self.consumers_carts[cart_id][remove_product_idx]
+        :type producer_id: Int
+        :param producer_id: the producer that owns the queue
 
-        # Release the lock for the producers list
-        self.producers_lock.release()
+        :type product_id: Int
+        :param product_id: the id of the product
 
-        # Release the lock for the cart
-        self.consumers_carts_lock.release()
+        :type quantity: Int
+        :param quantity: the number of units to add
+        """
+        # Grow the producer's row if the product id is new to it
+        row = self.stock[producer_id]
+        if product_id >= len(row):
+            row.extend([0] * (product_id + 1 - len(row)))
 
-        # Log the exit
-        self.logger.info("remove_from_cart() exited by %s", currentThread().getName())
+        # Increase the quantity of the product in the producer's queue,
+        # together with the total number of elements the producer published
+        row[product_id] += quantity
+        self.total_producers_elements[producer_id] += quantity
 
-    def place_order(self, cart_id):
-        """
-        Return a list with all the products in the cart.
+        # The producer has the product in stock
+        stripe.index.setdefault(product_id, {})[producer_id] = None
+        self.allocation.stocked(product_id, producer_id, row[product_id])
 
-        :type cart_id: Int
-        :param cart_id: id cart
+    def _wake_producers(self, producer_ids=None):
         """
-        # Log the call with the parameters
-        self.logger.info("place_order() called by %s with parameters: %s",
-                         currentThread().getName(), str(cart_id))
-
-        # Check if the cart_id is valid
-        if cart_id < 0 or cart_id >= len(self.consumers_carts):
-            return False
+        Wakes up the producers waiting for free space in their queues.
 
-        # Acquire the lock for the cart
-        self.consumers_carts_lock.acquire()
+        :type producer_ids: List
+        :param producer_ids: the producers to wake up, all of them by default
+        """
+        if producer_ids is None:
+            producer_ids = range(len(self.capacity_waiting))
 
-        # Get the cart
-        cart = self.consumers_carts[cart_id]
+        for producer_id in set(producer_ids):
+            if self.capacity_waiting[producer_id]:
+                with self.producer_locks[producer_id]:
+                    self.capacity_conditions[producer_id].notify_all()
 
-        # Print the cart
-        for element in cart:
-            # Acquire print mutex
-            self.print_lock.acquire()
+    def _take_stock(self, stripe, product_id, quantity):
+        """
+        Removes up to quantity units of the product from the queues of the producers
+        that have it in stock. The lock of the stripe must be held by the caller.
 
-            print("{} bought {}".format(currentThread().getName(), element[0]))
+        :type stripe: _StockStripe
+        :param stripe: the stripe of the product
 
-            # Release print mutex
-            self.print_lock.release()
+        :type product_id: Int
+        :param product_id: the id of the product
 
-        # Empty the cart
-        self.consumers_carts[cart_id] = []
+        :type quantity: Int
+        :param quantity: the number of units to take
 
-        # Release the lock for the cart
-        self.consumers_carts_lock.release()
+        :rtype: List
+        :return: a list of (producer id, number of units taken from it)
+        """
+        taken = []
+        raised = []
+        holders = stripe.index.get(product_id, {})
+
+        # The holders are removed from the index as they run out of the product
+        while quantity > 0 and holders:
+            # Let the allocation policy choose the producer
+            producer_index = self.allocation.pick(product_id, holders, self.stock)
+            row = self.stock[producer_index]
+
+            # Acquire the lock for the producer's queue
+            with self.producer_locks[producer_index]:
+                # Remove the product from the producer's queue
+                count = min(quantity, row[product_id])
+                row[product_id] -= count
+                self.total_producers_elements[producer_index] -= count
+                raised += self.capacity.changed(producer_index, -count)
+
+                # The producer ran out of the product
+                if row[product_id] == 0:
+                    del holders[producer_index]
+                self.allocation.stocked(product_id, producer_index, row[product_id])
+
+                # Wake up the producer waiting for free space in its queue
+                self.capacity_conditions[producer_index].notify_all()
+
+            taken.append((producer_index, count))
+            quantity -= count
+
+        # With a shared total, the units taken free space for every producer
+        if taken and self.capacity.shared:
+            self._wake_producers()
+        elif raised:
+            self._wake_producers(raised)
+
+        if not holders:
+            stripe.index.pop(product_id, None)
+
+        return taken
+
+    def _stripe(self, product_id):
+        """
+        Returns the stripe of the inventory index that holds the product.
 
-        # Log the exit
-        self.logger.info("place_order() exited by %s", currentThread().getName())
+        :type product_id: Int
+        :param product_id: the id of the product
 
-        # Return the cart
-        return cart
+        :rtype: _StockStripe
+        :return: the stripe of the product
+        """
+        return self.stock_stripes[product_id % len(self.stock_stripes)]
 
 
 class TestProduct:
@@ -373,6 +1595,15 @@ class TestProduct:
         """
         return self.name == other.name and self.price == other.price
 
+    def __hash__(self):
+        """
+        Overwrite the hash, so the product can be used in the inventory index.
+
+        :rtype: int
+        :return: the hash of the product
+        """
+        return hash((self.name, self.price))
+
 class TestMarketplace(unittest.TestCase):
     """
     Test class for the Marketplace class.
@@ -418,7 +1649,7 @@ class TestMarketplace(unittest.TestCase):
         market.publish(producer_id, product)
 
         # Verify that the product was published successfully
-        self.assertEqual(market.producers[producer_id][0][0], product)
+        self.assertEqual(market.producer_queue(producer_id), [[product, 1]])
 
     def test_publish_max_queue_size(self):
         """
@@ -451,7 +1682,7 @@ class TestMarketplace(unittest.TestCase):
         cart_id = market.new_cart()
 
         # Verify that the cart was created successfully
-        self.assertEqual(market.consumers_carts[cart_id], [])
+        self.assertEqual(market.consumers_carts[cart_id], {})
 
     def test_multiple_new_carts(self):
         """
@@ -462,8 +1693,8 @@ class TestMarketplace(unittest.TestCase):
         cart_id2 = market.new_cart()
 
         # Verify that the carts were created successfully
-        self.assertEqual(market.consumers_carts[cart_id1], [])
-        self.assertEqual(market.consumers_carts[cart_id2], [])
+        self.assertEqual(market.consumers_carts[cart_id1], {})
+        self.assertEqual(market.consumers_carts[cart_id2], {})
 
     def test_add_to_cart(self):
         """
@@ -471,7 +1702,7 @@ class TestMarketplace(unittest.TestCase):
         """
         market = Marketplace(10)
 
-        # Add the product to market.producers
+        # Add the product to the producer's queue
         producer_id = market.register_producer()
         product = TestProduct("product1", 10)
         market.publish(producer_id, product)
@@ -511,7 +1742,7 @@ class TestMarketplace(unittest.TestCase):
         """
         market = Marketplace(10)
 
-        # Add the product to market.producers
+        # Add the product to the producer's queue
         producer_id = market.register_producer()
         product = TestProduct("product1", 10)
         market.publish(producer_id, product)
@@ -520,8 +1751,8 @@ class TestMarketplace(unittest.TestCase):
         market.add_to_cart(cart_id, product)
         market.remove_from_cart(cart_id, product)
 
-        # Verify that the product is now in the market.producers
-        self.assertEqual(market.producers[producer_id][0][0], product)
+        # Verify that the product is back in the producer's queue
+        self.assertEqual(market.producer_queue(producer_id), [[product, 1]])
 
     def test_remove_from_cart_invalid_cart(self):
         """
@@ -529,7 +1760,7 @@ class TestMarketplace(unittest.TestCase):
         """
         market = Marketplace(10)
 
-        # Add the product to market.producers
+        # Add the product to the producer's queue
         producer_id = market.register_producer()
         product = TestProduct("product1", 10)
         market.publish(producer_id, product)
@@ -539,7 +1770,725 @@ class TestMarketplace(unittest.TestCase):
         market.remove_from_cart(-1, product)
 
         # Verify that the product is stil in the cart
-        self.assertNotEqual(market.consumers_carts[cart_id], [])
+        self.assertNotEqual(market.consumers_carts[cart_id], {})
+
+    def test_add_to_cart_many_producers(self):
+        """
+        Tests adding a product that only the last registered producer has.
+        """
+        market = Marketplace(10)
+        producer_ids = [market.register_producer() for _ in range(50)]
+        product = TestProduct("product1", 10)
+        market.publish(producer_ids[-1], product)
+
+        cart_id = market.new_cart()
+
+        # Verify that the product was taken from the last producer
+        self.assertTrue(market.add_to_cart(cart_id, product))
+        self.assertEqual(market.expand_cart(market.consumers_carts[cart_id]),
+                         [[product, producer_ids[-1]]])
+        self.assertEqual(market.total_producers_elements[producer_ids[-1]], 0)
+
+        # Verify that the product is no longer in stock
+        self.assertFalse(market.add_to_cart(cart_id, product))
+
+    def test_remove_from_cart_restocks(self):
+        """
+        Tests that a removed product can be added to a cart again.
+        """
+        market = Marketplace(10)
+        producer_id = market.register_producer()
+        product = TestProduct("product1", 10)
+        market.publish(producer_id, product)
+
+        cart_id = market.new_cart()
+        market.add_to_cart(cart_id, product)
+        market.remove_from_cart(cart_id, product)
+
+        # Verify that the product is back in stock
+        self.assertEqual(market.producer_queue(producer_id), [[product, 1]])
+        self.assertTrue(market.add_to_cart(cart_id, product))
+
+    def test_add_to_cart_waits_for_publish(self):
+        """
+        Tests that add_to_cart() with a timeout returns as soon as the product is published.
+        """
+        market = Marketplace(10)
+        producer_id = market.register_producer()
+        product = TestProduct("product1", 10)
+        cart_id = market.new_cart()
+
+        results = []
+        consumer = Thread(target=lambda: results.append(
+            market.add_to_cart(cart_id, product, timeout=10)))
+        consumer.start()
+
+        market.publish(producer_id, product)
+        consumer.join(5)
+
+        # Verify that the waiting consumer got the product
+        self.assertEqual(results, [True])
+        self.assertEqual(market.expand_cart(market.consumers_carts[cart_id]),
+                         [[product, producer_id]])
+
+    def test_add_to_cart_wait_timeout(self):
+        """
+        Tests that add_to_cart() gives up after the timeout.
+        """
+        market = Marketplace(10)
+        cart_id = market.new_cart()
+        product = TestProduct("product1", 10)
+
+        # Verify that the product was not added
+        self.assertFalse(market.add_to_cart(cart_id, product, timeout=0.01))
+
+    def test_fair_waiting(self):
+        """
+        Tests that with fair waiting the published units go to the waiting carts in
+        order, the highest priority first, and that a cart keeps its place between waits.
+        """
+        market = Marketplace(10, order_sink=BufferSink(), fair_waiting=True)
+        producer_id = market.register_producer()
+        product = TestProduct("product1", 10)
+        product_id = market.registry.intern(product)
+        stripe = market._stripe(product_id)  # pylint: disable=protected-access
+        first, second, urgent = market.new_cart(), market.new_cart(), market.new_cart()
+
+        # The first cart waits and gives up, then the second one joins the line
+        self.assertFalse(market.add_to_cart(first, product, timeout=0.01))
+        self.assertNotIn(product_id, stripe.waiters)
+
+        served = []
+
+        def wait(cart_id, priority=0):
+            market.add_to_cart(cart_id, product, timeout=10, priority=priority)
+            served.append(cart_id)
+
+        threads = []
+        for cart_id, priority in ((second, 0), (first, 0), (urgent, 1)):
+            threads.append(Thread(target=wait, args=(cart_id, priority)))
+            threads[-1].start()
+            deadline = time.monotonic() + 5
+            while len(stripe.waiters.get(product_id, ())) < len(threads):
+                self.assertLess(time.monotonic(), deadline, "the cart never joined the line")
+                time.sleep(0.001)
+
+        # Verify that every unit went to the head of the line, and nothing is left in stock
+        for count in range(1, 4):
+            market.publish(producer_id, product)
+            deadline = time.monotonic() + 5
+            while len(served) < count:
+                self.assertLess(time.monotonic(), deadline, "no waiting cart was served")
+                time.sleep(0.001)
+        for thread in threads:
+            thread.join(5)
+            self.assertFalse(thread.is_alive())
+        self.assertEqual(served, [urgent, first, second])
+        self.assertEqual(market.producer_queue(producer_id), [])
+        self.assertEqual(stripe.waiters, {})
+
+        # Verify that a product in stock is taken at once, without a line
+        market.publish(producer_id, product)
+        self.assertEqual(market.add_to_cart(first, product, quantity=2), 1)
+
+    def test_reserve(self):
+        """
+        Tests that reserve() adds every product of the cart or none of them.
+        """
+        market = Marketplace(10, order_sink=BufferSink())
+        producer_id = market.register_producer()
+        tea = TestProduct("tea", 10)
+        coffee = TestProduct("coffee", 10)
+        market.publish_many(producer_id, tea, 2)
+
+        # Verify that nothing is taken while the coffee is missing
+        cart_id = market.new_cart()
+        self.assertFalse(market.reserve(cart_id, [(tea, 2), (coffee, 1)], timeout=0.01))
+        self.assertEqual(market.producer_queue(producer_id), [[tea, 2]])
+
+        # Verify that the reservation waits for the coffee to be published
+        results = []
+        consumer = Thread(target=lambda: results.append(
+            market.reserve(cart_id, [(tea, 1), (coffee, 1), (tea, 1)], timeout=10)))
+        consumer.start()
+        market.publish(producer_id, coffee)
+        consumer.join(5)
+
+        self.assertEqual(results, [True])
+        self.assertEqual(market.producer_queue(producer_id), [])
+        self.assertEqual(market.place_order(cart_id),
+                         [[tea, producer_id], [tea, producer_id], [coffee, producer_id]])
+
+    def test_consumer_all_or_nothing(self):
+        """
+        Tests that consumers reserving whole carts share scarce stock without holding parts of it.
+        """
+        from consumer import Consumer  # pylint: disable=import-outside-toplevel
+
+        sink = BufferSink()
+        market = Marketplace(10, order_sink=sink)
+        tea = TestProduct("tea", 10)
+        coffee = TestProduct("coffee", 10)
+        producer_id = market.register_producer()
+        market.publish_many(producer_id, tea, 4)
+        market.publish_many(producer_id, coffee, 4)
+
+        carts = [[{"type": "add", "product": tea, "quantity": 1},
+                  {"type": "add", "product": coffee, "quantity": 2},
+                  {"type": "remove", "product": coffee, "quantity": 1}]] * 2
+        consumers = [Consumer(carts, market, 0.01, all_or_nothing=True, name="cons{}".format(i))
+                     for i in range(2)]
+        for consumer in consumers:
+            consumer.start()
+        for consumer in consumers:
+            consumer.join(5)
+
+        # Verify that every cart was bought with the net quantities
+        self.assertFalse(any(consumer.is_alive() for consumer in consumers))
+        self.assertEqual(len(sink.lines), 8)
+        self.assertEqual(market.producer_queue(producer_id), [])
+
+    def test_publish_waits_for_capacity(self):
+        """
+        Tests that publish() with a timeout returns as soon as the queue has space.
+        """
+        market = Marketplace(1)
+        producer_id = market.register_producer()
+        product = TestProduct("product1", 10)
+        self.assertTrue(market.publish(producer_id, product))
+        self.assertFalse(market.publish(producer_id, product, timeout=0.01))
+
+        results = []
+        producer = Thread(target=lambda: results.append(
+            market.publish(producer_id, product, timeout=10)))
+        producer.start()
+
+        cart_id = market.new_cart()
+        market.add_to_cart(cart_id, product)
+        producer.join(5)
+
+        # Verify that the waiting producer published the product
+        self.assertEqual(results, [True])
+        self.assertEqual(market.total_producers_elements[producer_id], 1)
+
+    def test_concurrent_producers_and_consumers(self):
+        """
+        Tests that the queues stay consistent while many threads use the marketplace.
+        """
+        market = Marketplace(5)
+        products = [TestProduct("product{}".format(i), i) for i in range(4)]
+
+        def produce():
+            producer_id = market.register_producer()
+            for _ in range(20):
+                for product in products:
+                    market.publish(producer_id, product, timeout=10)
+
+        def consume():
+            cart_id = market.new_cart()
+            for _ in range(20):
+                for product in products:
+                    market.add_to_cart(cart_id, product, timeout=10)
+                market.remove_from_cart(cart_id, products[0])
+                market.add_to_cart(cart_id, products[0], timeout=10)
+            market.place_order(cart_id)
+
+        threads = [Thread(target=produce) for _ in range(4)]
+        threads += [Thread(target=consume) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(30)
+
+        # Verify that every published product was bought and the queues are empty
+        self.assertEqual(market.total_producers_elements, [0, 0, 0, 0])
+        for producer_id in range(4):
+            self.assertEqual(market.producer_queue(producer_id), [])
+
+    def test_products_are_interned(self):
+        """
+        Tests that equal products share one id and one column of the inventory matrix.
+        """
+        market = Marketplace(10)
+        producer_id = market.register_producer()
+        market.publish(producer_id, TestProduct("product1", 10))
+        market.publish(producer_id, TestProduct("product2", 10))
+        market.publish(producer_id, TestProduct("product1", 10))
+
+        # Verify that the two equal products got the same id
+        self.assertEqual(len(market.registry), 2)
+        self.assertEqual(list(market.stock[producer_id]), [2, 1])
+        self.assertEqual(market.producer_queue(producer_id),
+                         [[TestProduct("product1", 10), 2], [TestProduct("product2", 10), 1]])
+
+        # Verify that buying products that were never published, without waiting, adds none
+        cart_id = market.new_cart()
+        for index in range(3, 6):
+            unknown = TestProduct("product{}".format(index), 10)
+            self.assertFalse(market.add_to_cart(cart_id, unknown))
+            self.assertEqual(market.add_to_cart(cart_id, unknown, quantity=2), 0)
+            self.assertFalse(market.reserve(cart_id, [(TestProduct("product1", 10), 1),
+                                                      (unknown, 1)]))
+        self.assertEqual(len(market.registry), 2)
+        self.assertEqual(len(market.stock[producer_id]), 2)
+
+        # Verify that a product waited for gets an id
+        self.assertFalse(market.add_to_cart(cart_id, TestProduct("product3", 10), timeout=0.01))
+        self.assertEqual(len(market.registry), 3)
+
+    def test_allocation_policies(self):
+        """
+        Tests which producer the units are taken from with every allocation policy.
+        """
+        product = TestProduct("product1", 10)
+        expected = {FirstFit: [0, 1, 1], RoundRobin: [0, 1, 2], MostStocked: [2, 2, 1]}
+
+        for policy, producers in expected.items():
+            market = Marketplace(10, allocation=policy())
+            for quantity in (1, 2, 3):
+                market.publish_many(market.register_producer(), product, quantity)
+
+            # Verify the producer of every unit, one unit at a time
+            cart_id = market.new_cart()
+            for _ in range(3):
+                market.add_to_cart(cart_id, product)
+            self.assertEqual([producer for _, producer in market.place_order(cart_id)],
+                             producers, policy.__name__)
+
+    def test_first_fit_lowest_id(self):
+        """
+        Tests that first fit takes from the lowest producer id, whatever the order the
+        producers stocked the product in, and that oldest stock takes the first stocked.
+        """
+        product = TestProduct("product1", 10)
+        expected = {FirstFit: [0, 1, 2, 2], OldestStock: [2, 1, 0, 2]}
+
+        for policy, producers in expected.items():
+            market = Marketplace(10, allocation=policy(), order_sink=BufferSink())
+            producer_ids = [market.register_producer() for _ in range(3)]
+            for producer_id in reversed(producer_ids):
+                market.publish(producer_id, product)
+
+            # Find the producer of every unit; the first one to stock restocks after it ran out
+            cart_id = market.new_cart()
+            picks = []
+            for unit in range(4):
+                if unit == 3:
+                    market.publish(producer_ids[2], product)
+                before = list(market.total_producers_elements)
+                market.add_to_cart(cart_id, product)
+                picks.append(next(producer_id for producer_id in producer_ids
+                                  if market.total_producers_elements[producer_id]
+                                  < before[producer_id]))
+            self.assertEqual(picks, producers, policy.__name__)
+
+    def test_adaptive_capacity(self):
+        """
+        Tests that the adaptive capacity gives the total to the producer that sells.
+        """
+        clock = VirtualClock()
+        capacity = AdaptiveCapacity(10, interval=1, clock=clock)
+        market = Marketplace(10, order_sink=BufferSink(), capacity=capacity)
+        fast, slow = market.register_producer(), market.register_producer()
+        self.assertEqual(capacity.limits(), [10, 10])
+
+        product1 = TestProduct("product1", 10)
+        product2 = TestProduct("product2", 10)
+        self.assertEqual(market.publish_many(fast, product1, 10), 10)
+        self.assertEqual(market.publish_many(slow, product2, 10), 10)
+
+        # Sell 8 units of the fast producer
+        cart_id = market.new_cart()
+        self.assertEqual(market.add_to_cart(cart_id, product1, quantity=8), 8)
+
+        # Verify that the next split gives it all but the slow producer's minimum,
+        # and that it can only publish what the queues hold under the total
+        clock.now = 1.5
+        self.assertEqual(market.publish_many(fast, product1, 100), 8)
+        self.assertEqual(capacity.limits(), [19, 1])
+        self.assertFalse(market.publish(slow, product2))
+        self.assertEqual(sum(market.total_producers_elements), 20)
+
+        # Verify that the fast producer, blocked by the total only, is woken up by a
+        # sale from the slow producer's queue
+        results = []
+        publisher = Thread(target=lambda: results.append(
+            market.publish(fast, product1, timeout=None)), daemon=True)
+        publisher.start()
+        deadline = time.monotonic() + 5
+        while not market.capacity_waiting[fast]:
+            self.assertLess(time.monotonic(), deadline, "the producer never waited")
+            time.sleep(0.001)
+        self.assertTrue(market.add_to_cart(cart_id, product2))
+        publisher.join(5)
+        self.assertFalse(publisher.is_alive())
+        self.assertEqual(results, [True])
+
+        # Verify that the default capacity still gives every producer the same size
+        self.assertEqual(Marketplace(10).capacity.free_space(0, 4), 6)
+        self.assertIsInstance(Marketplace(10).capacity, FixedCapacity)
+
+    def test_adaptive_capacity_split_wakes_producer(self):
+        """
+        Tests that the adaptive capacity uses the marketplace's clock, and that a producer
+        waiting for free space is woken up by the split that raises its limit.
+        """
+        clock = VirtualClock()
+        self.assertIs(Marketplace(10, clock=clock, capacity=AdaptiveCapacity(10)).capacity.clock,
+                      clock)
+        given = AdaptiveCapacity(10, clock=clock)
+        self.assertIs(Marketplace(10, capacity=given).capacity.clock, clock)
+
+        capacity = AdaptiveCapacity(10, interval=0.2)
+        market = Marketplace(10, order_sink=BufferSink(), capacity=capacity)
+        fast, slow = market.register_producer(), market.register_producer()
+        product1 = TestProduct("product1", 10)
+        product2 = TestProduct("product2", 10)
+        market.publish_many(slow, product2, 2)
+
+        # The fast producer sells 8 units and fills its queue again, up to its limit
+        self.assertEqual(market.publish_many(fast, product1, 10), 10)
+        self.assertEqual(market.add_to_cart(market.new_cart(), product1, quantity=8), 8)
+        self.assertEqual(market.publish_many(fast, product1, 10), 8)
+
+        # Verify that the next split lets it publish, with nothing sold in the meantime
+        results = []
+        publisher = Thread(target=lambda: results.append(
+            market.publish(fast, product1, timeout=None)), daemon=True)
+        publisher.start()
+        publisher.join(5)
+        self.assertEqual(results, [True])
+        self.assertEqual(capacity.limits(), [19, 1])
+
+    def test_adaptive_capacity_bound(self):
+        """
+        Tests that concurrent producers never queue more than the total together.
+        """
+        peaks = [0]
+
+        class PeakCapacity(AdaptiveCapacity):
+            """
+            Adaptive capacity that records the most units queued at once.
+            """
+            def acquire(self, producer_id, queued, quantity):
+                acquired = super().acquire(producer_id, queued, quantity)
+                with self.lock:
+                    peaks[0] = max(peaks[0], self.queued)
+                return acquired
+
+        capacity = PeakCapacity(4, interval=0.001)
+        market = Marketplace(4, order_sink=BufferSink(), capacity=capacity)
+        product = TestProduct("product1", 10)
+        producer_ids = [market.register_producer() for _ in range(4)]
+
+        def produce(producer_id):
+            for _ in range(100):
+                market.publish(producer_id, product, timeout=None)
+
+        def consume():
+            for _ in range(200):
+                market.add_to_cart(market.new_cart(), product, timeout=None)
+
+        threads = [Thread(target=produce, args=(producer_id,), daemon=True)
+                   for producer_id in producer_ids]
+        threads += [Thread(target=consume, daemon=True) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(10)
+
+        # Verify that everything was sold and the total was never over 4 x 4 units
+        self.assertFalse(any(thread.is_alive() for thread in threads))
+        self.assertLessEqual(peaks[0], 16)
+        self.assertEqual(capacity.queued, 0)
+        self.assertEqual(market.total_producers_elements, [0, 0, 0, 0])
+
+    def test_recover_from_store(self):
+        """
+        Tests that a marketplace recovers its queues and carts from the log and the snapshot.
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            store = MarketplaceStore(directory, fsync=False)
+            market = Marketplace(10, store=store, order_sink=BufferSink())
+            producer_id = market.register_producer()
+            product1 = TestProduct("product1", 10)
+            product2 = TestProduct("product2", 10)
+            market.publish_many(producer_id, product1, 5)
+            market.publish(producer_id, product2)
+
+            cart_id1 = market.new_cart()
+            market.add_to_cart(cart_id1, product1, quantity=3)
+            market.place_order(cart_id1)
+            store.checkpoint()
+
+            cart_id2 = market.new_cart()
+            market.add_to_cart(cart_id2, product1, quantity=2)
+            market.remove_from_cart(cart_id2, product1)
+            market.add_to_cart(cart_id2, product2)
+            store.close()
+
+            # Verify that the queues and the live cart are back, and the placed cart is stale
+            recovered = Marketplace(10, store=MarketplaceStore(directory, fsync=False),
+                                    order_sink=BufferSink())
+            self.assertEqual(recovered.producer_queue(producer_id), [[product1, 1]])
+            self.assertEqual(recovered.total_producers_elements, [1])
+            self.assertFalse(recovered.add_to_cart(cart_id1, product1))
+            self.assertEqual(recovered.place_order(cart_id2),
+                             [[product1, producer_id], [product2, producer_id]])
+            recovered.store.close()
+
+    def test_virtual_clock_simulation(self):
+        """
+        Tests that a simulation of an hour of production runs in a moment and is reproducible.
+        """
+        # Imported here, because the producer and consumer import this module's clock
+        from consumer import Consumer  # pylint: disable=import-outside-toplevel
+        from producer import Producer  # pylint: disable=import-outside-toplevel
+
+        def simulate(seed):
+            clock = VirtualClock(seed)
+            sink = BufferSink()
+            market = Marketplace(2, order_sink=sink, clock=clock)
+            products = ["tea", "coffee"]
+            threads = [Producer([(product, 1, 60)], market, 30, name="prod{}".format(i))
+                       for i, product in enumerate(products)]
+            threads += [Consumer([[{"type": "add", "product": product, "quantity": 10}]],
+                                 market, 5, name="cons{}".format(i))
+                        for i, product in enumerate(products * 2)]
+            end = clock.run(threads, until=3600)
+            return end, sink.lines
+
+        start = time.perf_counter()
+        end, lines = simulate(1)
+
+        # Verify that the hour passed in virtual time only, and that the 40 units were bought
+        self.assertEqual(end, 3600)
+        self.assertLess(time.perf_counter() - start, 10)
+        self.assertEqual(len(lines), 40)
+
+        # Verify that the same seed gives the same receipts
+        self.assertEqual(simulate(1), (end, lines))
+
+    def test_publish_many(self):
+        """
+        Tests publishing more units than the queue has space for.
+        """
+        market = Marketplace(5)
+        producer_id = market.register_producer()
+        product = TestProduct("product1", 10)
+
+        # Verify that only the free space was filled
+        self.assertEqual(market.publish_many(producer_id, product, 3), 3)
+        self.assertEqual(market.publish_many(producer_id, product, 3), 2)
+        self.assertEqual(market.publish_many(producer_id, product, 3), 0)
+        self.assertEqual(market.producer_queue(producer_id), [[product, 5]])
+        self.assertEqual(market.total_producers_elements[producer_id], 5)
+
+    def test_add_to_cart_quantity(self):
+        """
+        Tests adding more units than one producer has, with partial fill.
+        """
+        market = Marketplace(5)
+        producer_id1 = market.register_producer()
+        producer_id2 = market.register_producer()
+        product = TestProduct("product1", 10)
+        market.publish_many(producer_id1, product, 2)
+        market.publish_many(producer_id2, product, 3)
+
+        cart_id = market.new_cart()
+
+        # Verify that the units were taken from both producers
+        self.assertEqual(market.add_to_cart(cart_id, product, quantity=4), 4)
+        self.assertEqual(market.add_to_cart(cart_id, product, quantity=4), 1)
+        self.assertEqual(market.add_to_cart(cart_id, product, quantity=4), 0)
+        self.assertEqual(market.consumers_carts[cart_id],
+                         {market.registry.lookup(product): {producer_id1: 2, producer_id2: 3}})
+        self.assertEqual(market.total_producers_elements, [0, 0])
+
+    def test_remove_from_cart_quantity(self):
+        """
+        Tests removing several units of a product at once.
+        """
+        market = Marketplace(5)
+        producer_id = market.register_producer()
+        product1 = TestProduct("product1", 10)
+        product2 = TestProduct("product2", 10)
+        market.publish_many(producer_id, product1, 3)
+        market.publish(producer_id, product2)
+
+        cart_id = market.new_cart()
+        market.add_to_cart(cart_id, product1, quantity=3)
+        market.add_to_cart(cart_id, product2)
+
+        # Verify that only the wanted units went back to the producer
+        self.assertEqual(market.remove_from_cart(cart_id, product1, quantity=2), 2)
+        self.assertEqual(market.expand_cart(market.consumers_carts[cart_id]),
+                         [[product1, producer_id], [product2, producer_id]])
+        self.assertEqual(market.total_producers_elements[producer_id], 2)
+        self.assertEqual(market.remove_from_cart(cart_id, product1, quantity=2), 1)
+
+    def test_remove_from_cart_across_producers(self):
+        """
+        Tests removing units that came from several producers from a large cart.
+        """
+        market = Marketplace(1000)
+        producer_id1 = market.register_producer()
+        producer_id2 = market.register_producer()
+        product = TestProduct("product1", 10)
+        market.publish_many(producer_id1, product, 600)
+        market.publish_many(producer_id2, product, 400)
+
+        cart_id = market.new_cart()
+        self.assertEqual(market.add_to_cart(cart_id, product, quantity=1000), 1000)
+
+        # Verify that the cart keeps one counted line per producer
+        product_id = market.registry.lookup(product)
+        self.assertEqual(market.consumers_carts[cart_id],
+                         {product_id: {producer_id1: 600, producer_id2: 400}})
+
+        # Verify that the units go back to their producers, the first producer first
+        self.assertEqual(market.remove_from_cart(cart_id, product, quantity=700), 700)
+        self.assertEqual(market.consumers_carts[cart_id], {product_id: {producer_id2: 300}})
+        self.assertEqual(market.total_producers_elements, [600, 100])
+
+        # Verify that the order expands into one element per unit
+        self.assertEqual(market.place_order(cart_id), [[product, producer_id2]] * 300)
+
+    def test_logging_handler_added_once(self):
+        """
+        Tests that creating several marketplaces does not duplicate the log handlers.
+        """
+        handlers = list(Marketplace(10).logger.handlers)
+        Marketplace(10)
+
+        # Verify that the second marketplace did not add a handler
+        self.assertEqual(Marketplace(10).logger.handlers, handlers)
+
+    def test_logging_mutable_arguments(self):
+        """
+        Tests that a record with a mutable argument is formatted before it is queued.
+        """
+        # pylint: disable=import-outside-toplevel
+        import queue
+        from marketplace_log import DeferredQueueHandler
+
+        records = queue.SimpleQueue()
+        handler = DeferredQueueHandler(records)
+        items = [("tea", 1)]
+        handler.handle(logging.LogRecord("marketplace", logging.INFO, __file__, 0,
+                                         "reserve() called with parameters: %s, %s",
+                                         (0, items), None))
+        handler.handle(logging.LogRecord("marketplace", logging.INFO, __file__, 0,
+                                         "new_cart() returned %s", (3,), None))
+        items.append(("coffee", 1))
+
+        # Verify that the list was formatted as it was, and the int was left for later
+        mutable, immutable = records.get(), records.get()
+        self.assertEqual(mutable.getMessage(),
+                         "reserve() called with parameters: 0, [('tea', 1)]")
+        self.assertEqual(immutable.args, (3,))
+
+    def test_logging_sampling(self):
+        """
+        Tests that only the sampled fraction of the calls is logged.
+        """
+        market = Marketplace(10, log_sampling={"add_to_cart": 0.25, "new_cart": 0})
+
+        # Verify that every fourth add_to_cart() and no new_cart() is logged
+        logged = [market.sample_log("add_to_cart") for _ in range(8)]
+        self.assertEqual(logged.count(True), 2)
+        self.assertFalse(market.sample_log("new_cart"))
+        self.assertTrue(market.sample_log("publish"))
+
+        # Verify that nothing is logged when the level is disabled
+        market.logger.setLevel(logging.WARNING)
+        self.assertFalse(market.sample_log("publish"))
+        market.logger.setLevel(logging.INFO)
+
+    def test_place_order_sink(self):
+        """
+        Tests that the receipt of an order is written to the order sink.
+        """
+        sink = BufferSink()
+        market = Marketplace(10, order_sink=sink)
+        producer_id = market.register_producer()
+        product = TestProduct("product1", 10)
+        market.publish_many(producer_id, product, 2)
+
+        cart_id = market.new_cart()
+        market.add_to_cart(cart_id, product, quantity=2)
+        market.place_order(cart_id)
+
+        # Verify that a line was written for every product
+        name = current_thread().name
+        self.assertEqual(sink.lines, ["{} bought {}".format(name, product)] * 2)
+
+    def test_batched_file_sink(self):
+        """
+        Tests that the batched file sink writes full batches and the rest when closed.
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "orders.txt")
+            sink = BatchedFileSink(path, max_lines=3, interval=60)
+
+            sink.emit("cons0", [["product1", 0], ["product2", 0]])
+            with open(path) as orders:
+                self.assertEqual(orders.read(), "")
+
+            # Verify that the batch is written when it is full
+            sink.emit("cons1", [["product3", 1]])
+            with open(path) as orders:
+                self.assertEqual(len(orders.read().splitlines()), 3)
+
+            # Verify that the rest is written on close
+            sink.emit("cons2", [["product4", 1]])
+            sink.close()
+            with open(path) as orders:
+                self.assertEqual(orders.read().splitlines()[-1], "cons2 bought product4")
+
+    def test_stats(self):
+        """
+        Tests the metrics of the methods, the rejections and the inventory.
+        """
+        market = Marketplace(1, metrics=True)
+        producer_id = market.register_producer()
+        product = TestProduct("product1", 10)
+        market.publish(producer_id, product)
+        market.publish(producer_id, product)
+        market.publish(producer_id, product, timeout=0.01)
+
+        cart_id = market.new_cart()
+        market.add_to_cart(cart_id, product)
+        market.add_to_cart(cart_id, product)
+
+        stats = market.stats()
+
+        # Verify the calls, the rejections and the timeouts
+        self.assertEqual(stats['methods']['publish']['calls'], 3)
+        self.assertEqual(stats['methods']['publish']['rejected'], 2)
+        self.assertEqual(stats['methods']['publish']['timed_out'], 1)
+        self.assertEqual(stats['methods']['add_to_cart']['rejected'], 1)
+        self.assertEqual(stats['methods']['register_producer']['rejected'], 0)
+        self.assertGreaterEqual(stats['methods']['publish']['latency']['max_us'], 10000)
+
+        # Verify the locks and the inventory
+        self.assertEqual(stats['locks']['cart']['wait']['count'], 2)
+        self.assertIn('hold', stats['locks']['producer'])
+        self.assertEqual(stats['inventory'], [0])
+
+    def test_stats_disabled(self):
+        """
+        Tests that without metrics the methods and locks are not wrapped.
+        """
+        market = Marketplace(1)
+        market.register_producer()
+
+        # Verify that the methods are the class methods, the retries are not counted
+        # and only the inventory is reported
+        self.assertNotIn('publish', vars(market))
+        market.count_retry('producer')
+        self.assertEqual(market.stats(), {'methods': {}, 'locks': {}, 'retries': {},
+                                          'inventory': [0], 'expired_carts': 0})
 
     def test_place_order(self):
         """
@@ -547,19 +2496,164 @@ class TestMarketplace(unittest.TestCase):
         """
         market = Marketplace(10)
 
-        # Add the product to market.producers
+        # Add the product to the producer's queue
         producer_id = market.register_producer()
         product = TestProduct("product1", 10)
         market.publish(producer_id, product)
 
         cart_id = market.new_cart()
         market.add_to_cart(cart_id, product)
-        products = market.consumers_carts[cart_id]
 
         test_products = market.place_order(cart_id)
 
-        # Verify that the order was placed successfully
-        self.assertEqual(test_products, products)
+        # Verify that the order was placed successfully and the cart was released
+        self.assertEqual(test_products, [[product, producer_id]])
+        self.assertIsNone(market.consumers_carts[cart_id])
+        self.assertFalse(market.place_order(cart_id))
+
+    def test_cart_ids_are_recycled(self):
+        """
+        Tests that placed carts are reused with a new generation and their ids go stale.
+        """
+        market = Marketplace(10, order_sink=BufferSink())
+        producer_id = market.register_producer()
+        product = TestProduct("product1", 10)
+        market.publish_many(producer_id, product, 2)
+
+        cart_id1 = market.new_cart()
+        market.add_to_cart(cart_id1, product)
+        market.place_order(cart_id1)
+        cart_id2 = market.new_cart()
+
+        # Verify that the slot was reused with the next generation
+        self.assertEqual(len(market.consumers_carts), 1)
+        self.assertNotEqual(cart_id1, cart_id2)
+        self.assertEqual(cart_id1 & Marketplace.CART_SLOT_MASK,
+                         cart_id2 & Marketplace.CART_SLOT_MASK)
+
+        # Verify that the stale id is rejected and the new cart is empty
+        self.assertFalse(market.add_to_cart(cart_id1, product))
+        self.assertEqual(market.remove_from_cart(cart_id1, product, quantity=1), 0)
+        self.assertFalse(market.place_order(cart_id1))
+        self.assertTrue(market.add_to_cart(cart_id2, product))
+        self.assertEqual(market.place_order(cart_id2), [[product, producer_id]])
+
+    def test_abandon_cart(self):
+        """
+        Tests that an abandoned cart gives its products back and is released.
+        """
+        market = Marketplace(10)
+        producer_id = market.register_producer()
+        product = TestProduct("product1", 10)
+        market.publish_many(producer_id, product, 3)
+
+        cart_id = market.new_cart()
+        market.add_to_cart(cart_id, product, quantity=3)
+
+        # Verify that the products are back in stock and the id is stale
+        self.assertTrue(market.abandon_cart(cart_id))
+        self.assertEqual(market.producer_queue(producer_id), [[product, 3]])
+        self.assertFalse(market.abandon_cart(cart_id))
+        self.assertEqual(market.free_carts, [0])
+
+    def test_reservation_ttl(self):
+        """
+        Tests that a cart unused for its time to live gives its products back.
+        """
+        clock = VirtualClock()
+        market = Marketplace(10, order_sink=BufferSink(), clock=clock, reservation_ttl=5)
+        producer_id = market.register_producer()
+        product = TestProduct("product1", 10)
+        market.publish_many(producer_id, product, 3)
+
+        stalled = market.new_cart()
+        used = market.new_cart()
+        patient = market.new_cart(reservation_ttl=50)
+        self.assertEqual(market.add_to_cart(stalled, product, quantity=2), 2)
+        self.assertEqual(market.add_to_cart(patient, product, quantity=1), 1)
+
+        # Verify that a used cart gets a later deadline
+        clock.now = 4
+        self.assertFalse(market.add_to_cart(used, product))
+
+        # Verify that the stalled cart expired and its products went back to the queue
+        clock.now = 6
+        self.assertEqual(market.add_to_cart(used, product, quantity=2), 2)
+        self.assertFalse(market.cart_alive(stalled))
+        self.assertTrue(market.cart_alive(used))
+        self.assertEqual(market.stats()['expired_carts'], 1)
+
+        # Verify that a cart with a longer time to live is still live
+        clock.now = 20
+        self.assertEqual(market.expire_reservations(), 1)
+        self.assertFalse(market.cart_alive(used))
+        self.assertEqual(market.place_order(patient), [[product, producer_id]])
+        self.assertEqual(market.producer_queue(producer_id), [[product, 2]])
+
+    def test_publish_expires_reservations(self):
+        """
+        Tests that a producer waiting for free space expires the carts by itself.
+        """
+        clock = VirtualClock()
+        market = Marketplace(1, order_sink=BufferSink(), clock=clock, reservation_ttl=5)
+        stalled_producer = market.register_producer()
+        producer_id = market.register_producer()
+        product = TestProduct("product1", 10)
+
+        # A stalled cart holds a unit, and the producer's queue is full
+        market.publish(stalled_producer, product)
+        stalled = market.new_cart()
+        self.assertTrue(market.add_to_cart(stalled, product))
+        market.publish(producer_id, product)
+        results = {}
+
+        def consume():
+            # Wait for two units: the producer's one and the one in the stalled cart
+            cart_id = market.new_cart(reservation_ttl=100)
+            results['reserved'] = market.reserve(cart_id, [(product, 2)], timeout=None)
+
+        def produce():
+            # Wait for free space, until the consumer takes the producer's unit
+            results['published'] = market.publish_many(producer_id, product, 1, timeout=None)
+
+        threads = [Thread(target=clock.session, args=(function,))
+                   for function in (consume, produce)]
+
+        # Verify that the expiry, run by the producer, served the consumer and the producer
+        self.assertLess(clock.run(threads, until=50), 50)
+        self.assertEqual(results, {'reserved': True, 'published': 1})
+        self.assertEqual(market.stats()['expired_carts'], 1)
+        self.assertFalse(market.cart_alive(stalled))
+
+    def test_waiting_cart_expires_reservations(self):
+        """
+        Tests that a cart waiting for a product with no timeout gets it from a cart that
+        expires, without being expired itself while it waits.
+        """
+        for fair_waiting in (False, True):
+            with self.subTest(fair_waiting=fair_waiting):
+                clock = VirtualClock()
+                market = Marketplace(10, order_sink=BufferSink(), clock=clock,
+                                     reservation_ttl=5, fair_waiting=fair_waiting)
+                producer_id = market.register_producer()
+                product = TestProduct("product1", 10)
+                market.publish(producer_id, product)
+                stalled = market.new_cart()
+                self.assertTrue(market.add_to_cart(stalled, product))
+                results = []
+
+                def consume():
+                    # The waiting cart's time to live is shorter than the stalled cart's
+                    cart_id = market.new_cart(reservation_ttl=2)
+                    results.append(market.add_to_cart(cart_id, product, timeout=None))
+                    results.append(market.cart_alive(cart_id))
+
+                # Verify that the waiting cart, alone, expired the stalled one and got the unit
+                self.assertLess(clock.run([Thread(target=clock.session, args=(consume,))],
+                                          until=50), 50)
+                self.assertEqual(results, [True, True])
+                self.assertEqual(market.stats()['expired_carts'], 1)
+                self.assertFalse(market.cart_alive(stalled))
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,146 @@
+"""
+This module sets up the logging of the Marketplace, away from the threads that use it.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+
+import atexit
+import logging
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+import os
+import queue
+from threading import Lock
+
+# The lock for setting up the logging
+SETUP_LOCK = Lock()
+
+# The process that set up the logging, the handler of the marketplace logger and the
+# listener that writes the records
+SETUP_PID = None
+SETUP_HANDLER = None
+SETUP_LISTENER = None
+
+
+class DeferredQueueHandler(QueueHandler):
+    """
+    Queue handler that leaves the formatting of the message to the writer thread.
+    Most arguments of the marketplace logs are ints and frozen products, so they can
+    be formatted later. A record with a mutable argument, like the list of items
+    of reserve(), is formatted at once, so the caller can not change it before it
+    is written.
+    """
+    def prepare(self, record):
+        """
+        Returns the record without formatting it on the caller's thread, unless one
+        of its arguments is mutable. The immutable arguments are the hashable ones.
+
+        :type record: logging.LogRecord
+        :param record: the record
+
+        :rtype: logging.LogRecord
+        :return: the record to put in the queue
+        """
+        if record.args:
+            try:
+                hash(record.args)
+            except TypeError:
+                record.msg = record.getMessage()
+                record.args = None
+
+        return record
+
+
+def setup_logging(filename='marketplace.log'):
+    """
+    Sets up the 'marketplace' logger, once per process. The records are put in a
+    queue and written to a rotating file by a background thread.
+
+    :type filename: str
+    :param filename: the file the records are written to
+
+    :rtype: logging.Logger
+    :return: the marketplace logger
+    """
+    global SETUP_PID, SETUP_HANDLER, SETUP_LISTENER  # pylint: disable=global-statement
+
+    logger = logging.getLogger('marketplace')
+
+    with SETUP_LOCK:
+        # A forked process inherits the handler, but not the writer thread
+        if SETUP_PID == os.getpid():
+            return logger
+
+        if SETUP_HANDLER is not None:
+            logger.removeHandler(SETUP_HANDLER)
+
+        # Set the writer format
+        handler = RotatingFileHandler(filename)
+        formatter = logging.Formatter(
+            '%(asctime)s UTC/GMT - %(levelname)s - %(threadName)s - %(message)s')
+        handler.setFormatter(formatter)
+
+        # Start the writer thread
+        records = queue.SimpleQueue()
+        SETUP_LISTENER = QueueListener(records, handler)
+        SETUP_LISTENER.start()
+        atexit.register(SETUP_LISTENER.stop)
+
+        # Add the queue handler to the logger
+        SETUP_HANDLER = DeferredQueueHandler(records)
+        logger.addHandler(SETUP_HANDLER)
+        SETUP_PID = os.getpid()
+
+    return logger
+
+
+class CallSampler:
+    """
+    Class that decides which marketplace calls are logged. Nothing is logged when the
+    INFO level is disabled, and a method with a sampling rate r only has a fraction r
+    of its calls logged.
+    """
+    def __init__(self, logger, rates=None):
+        """
+        Constructor
+
+        :type logger: logging.Logger
+        :param logger: the logger
+
+        :type rates: Dict
+        :param rates: method name -> fraction of the calls to log, between 0 and 1.
+        The methods that are missing are always logged
+        """
+        self.logger = logger
+        self.rates = dict(rates or {})
+
+        # The fraction of a call accumulated by every sampled method
+        self.credits = dict.fromkeys(self.rates, 0.0)
+
+    def __call__(self, method):
+        """
+        Returns if a call of the method should be logged.
+
+        :type method: str
+        :param method: the name of the method
+
+        :rtype: bool
+        :return: True if the call should be logged
+        """
+        if not self.logger.isEnabledFor(logging.INFO):
+            return False
+
+        rate = self.rates.get(method)
+        if rate is None:
+            return True
+
+        # Every call adds rate to the method's credit, and a call is logged every
+        # time the credit reaches 1. Losing an update to a race only skips a log
+        credit = self.credits[method] + rate
+        if credit >= 1:
+            self.credits[method] = credit - 1
+            return True
+
+        self.credits[method] = credit
+        return False
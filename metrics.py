@@ -0,0 +1,282 @@
+"""
+This module offers the optional metrics of the Marketplace.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+
+import functools
+import threading
+from threading import Lock
+import time
+
+
+class Histogram:
+    """
+    Class that represents a latency histogram with power of two buckets in microseconds:
+    bucket i counts the durations d with 2^(i-1) <= d < 2^i microseconds.
+    """
+    BUCKETS = 48
+
+    def __init__(self):
+        """
+        Constructor
+        """
+        self.buckets = [0] * self.BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        """
+        Records a duration.
+
+        :type seconds: Float
+        :param seconds: the duration
+        """
+        self.buckets[min(int(seconds * 1e6).bit_length(), self.BUCKETS - 1)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def merge(self, other):
+        """
+        Adds the durations recorded by another histogram.
+
+        :type other: Histogram
+        :param other: the other histogram
+        """
+        for index, count in enumerate(other.buckets):
+            self.buckets[index] += count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, fraction):
+        """
+        Returns the upper bound of the bucket that holds a percentile, in microseconds.
+
+        :type fraction: Float
+        :param fraction: the percentile, between 0 and 1
+
+        :rtype: Float
+        :return: the percentile
+        """
+        rank = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= rank:
+                return min(float(1 << index), self.max * 1e6)
+
+        return self.max * 1e6
+
+    def summary(self):
+        """
+        Returns the count, mean, percentiles and maximum of the durations, in microseconds.
+
+        :rtype: Dict
+        :return: the summary
+        """
+        return {
+            'count': self.count,
+            'mean_us': self.total / self.count * 1e6 if self.count else 0.0,
+            'p50_us': self.percentile(0.50),
+            'p99_us': self.percentile(0.99),
+            'max_us': self.max * 1e6,
+        }
+
+
+class MarketplaceMetrics:
+    """
+    Class that collects the metrics of a Marketplace: the latency of every method, how
+    often its calls are rejected or time out, and how long its locks are waited for and
+    held. Every thread records in its own histograms, which are merged by snapshot(),
+    so recording needs no lock.
+    """
+    def __init__(self):
+        """
+        Constructor
+        """
+        self.local = threading.local()
+        self.shards_lock = Lock()
+        self.shards = []
+
+    def _shard(self):
+        """
+        Returns the histograms and counters of the current thread.
+
+        :rtype: Dict
+        :return: key -> Histogram or count
+        """
+        shard = getattr(self.local, 'shard', None)
+        if shard is None:
+            shard = self.local.shard = {}
+            with self.shards_lock:
+                self.shards.append(shard)
+
+        return shard
+
+    def record(self, key, seconds):
+        """
+        Records a duration.
+
+        :type key: Tuple
+        :param key: what was measured, like ('method', 'publish') or ('lock_wait', 'cart')
+
+        :type seconds: Float
+        :param seconds: the duration
+        """
+        shard = self._shard()
+        histogram = shard.get(key)
+        if histogram is None:
+            histogram = shard[key] = Histogram()
+        histogram.add(seconds)
+
+    def count(self, key):
+        """
+        Increments a counter.
+
+        :type key: Tuple
+        :param key: what is counted, like ('rejected', 'publish')
+        """
+        shard = self._shard()
+        shard[key] = shard.get(key, 0) + 1
+
+    def timed(self, method, function, rejectable=False):
+        """
+        Returns the method of the marketplace, measured. If the method is rejectable, a
+        call that returns False or 0 is counted as rejected, and as timed out if it
+        waited before giving up.
+
+        :type method: str
+        :param method: the name of the method
+
+        :type function: Callable
+        :param function: the method
+
+        :type rejectable: bool
+        :param rejectable: if False or 0 means that the call was rejected
+
+        :rtype: Callable
+        :return: the measured method
+        """
+        @functools.wraps(function)
+        def measured(*args, **kwargs):
+            start = time.perf_counter()
+            result = function(*args, **kwargs)
+            self.record(('method', method), time.perf_counter() - start)
+
+            if rejectable and (result is False or result == 0):
+                self.count(('rejected', method))
+                if kwargs.get('timeout', 0) != 0:
+                    self.count(('timed_out', method))
+
+            return result
+
+        return measured
+
+    def lock(self, kind):
+        """
+        Returns a new lock whose wait and hold times are measured.
+
+        :type kind: str
+        :param kind: the kind of lock, like 'cart' or 'producer'
+
+        :rtype: TimedLock
+        :return: the lock
+        """
+        return TimedLock(self, kind)
+
+    def snapshot(self):
+        """
+        Returns the metrics recorded by all the threads.
+
+        :rtype: Dict
+        :return: {'methods': {method: {calls, rejected, timed_out, latency}},
+        'locks': {kind: {wait, hold}}, 'retries': {kind: count}}
+        """
+        histograms = {}
+        counters = {}
+        with self.shards_lock:
+            shards = list(self.shards)
+
+        for shard in shards:
+            for key, value in list(shard.items()):
+                if isinstance(value, Histogram):
+                    histograms.setdefault(key, Histogram()).merge(value)
+                else:
+                    counters[key] = counters.get(key, 0) + value
+
+        methods = {}
+        locks = {}
+        for (category, name), histogram in sorted(histograms.items()):
+            if category == 'method':
+                methods[name] = {
+                    'calls': histogram.count,
+                    'rejected': counters.get(('rejected', name), 0),
+                    'timed_out': counters.get(('timed_out', name), 0),
+                    'latency': histogram.summary(),
+                }
+            else:
+                locks.setdefault(name, {})[category[len('lock_'):]] = histogram.summary()
+
+        retries = {name: value for (category, name), value in sorted(counters.items())
+                   if category == 'retry'}
+
+        return {'methods': methods, 'locks': locks, 'retries': retries}
+
+
+class TimedLock:
+    """
+    Class that represents a lock whose wait and hold times are recorded. It can be used
+    like a threading.Lock, also as the lock of a Condition.
+    """
+    def __init__(self, metrics, kind):
+        """
+        Constructor
+
+        :type metrics: MarketplaceMetrics
+        :param metrics: where the times are recorded
+
+        :type kind: str
+        :param kind: the kind of lock
+        """
+        self.lock = Lock()
+        self.metrics = metrics
+        self.wait_key = ('lock_wait', kind)
+        self.hold_key = ('lock_hold', kind)
+        self.acquired_at = 0.0
+
+    def acquire(self, blocking=True, timeout=-1):
+        """
+        Acquires the lock, recording how long it was waited for.
+        """
+        start = time.perf_counter()
+        acquired = self.lock.acquire(blocking, timeout)
+        if acquired:
+            self.acquired_at = time.perf_counter()
+            self.metrics.record(self.wait_key, self.acquired_at - start)
+
+        return acquired
+
+    def release(self):
+        """
+        Releases the lock, recording how long it was held.
+        """
+        self.metrics.record(self.hold_key, time.perf_counter() - self.acquired_at)
+        self.lock.release()
+
+    def locked(self):
+        """
+        Returns if the lock is held.
+        """
+        return self.lock.locked()
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *args):
+        self.release()
@@ -0,0 +1,157 @@
+"""
+This module offers the sinks where the Marketplace writes the placed orders.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+
+import sys
+from threading import Event, Lock, Thread
+
+
+class OrderSink:
+    """
+    Class that represents where the receipts of the placed orders go. The marketplace
+    calls emit() after releasing its locks.
+    """
+    def emit(self, name, cart):
+        """
+        Writes the receipt of an order.
+
+        :type name: str
+        :param name: the name of the consumer that placed the order
+
+        :type cart: List
+        :param cart: the [product, producer id] elements of the order
+        """
+        if cart:
+            self.write("".join("{} bought {}\n".format(name, element[0]) for element in cart))
+
+    def write(self, text):
+        """
+        Writes formatted receipt lines.
+
+        :type text: str
+        :param text: one or more lines, each ending with a new line
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """
+        Writes whatever is left and frees the sink.
+        """
+
+
+class StdoutSink(OrderSink):
+    """
+    Sink that prints the receipts, one write for every order.
+    """
+    def __init__(self):
+        """
+        Constructor
+        """
+        # Initialize print lock
+        self.print_lock = Lock()
+
+    def write(self, text):
+        # Acquire print mutex
+        with self.print_lock:
+            sys.stdout.write(text)
+
+
+class BufferSink(OrderSink):
+    """
+    Sink that keeps the receipt lines in memory.
+    """
+    def __init__(self):
+        """
+        Constructor
+        """
+        self.lock = Lock()
+        self.lines = []
+
+    def write(self, text):
+        with self.lock:
+            self.lines.extend(text.splitlines())
+
+
+class NullSink(OrderSink):
+    """
+    Sink that drops the receipts without formatting them.
+    """
+    def emit(self, name, cart):
+        pass
+
+    def write(self, text):
+        pass
+
+
+class BatchedFileSink(OrderSink):
+    """
+    Sink that appends the receipts to a file in batches. A batch is written when it
+    has max_lines lines, or by a background thread every interval seconds.
+    """
+    def __init__(self, path, max_lines=1000, interval=1.0):
+        """
+        Constructor
+
+        :type path: str
+        :param path: the file the receipts are appended to
+
+        :type max_lines: Int
+        :param max_lines: the number of lines that triggers a write
+
+        :type interval: Float
+        :param interval: the maximum number of seconds a line waits to be written
+        """
+        self.file = open(path, 'a')  # pylint: disable=consider-using-with
+        self.max_lines = max_lines
+        self.interval = interval
+
+        # Initialize the batch of lines that are not written yet
+        self.lock = Lock()
+        self.batch = []
+        self.batch_lines = 0
+
+        # Start the thread that writes the batch every interval
+        self.closed = Event()
+        self.flusher = Thread(target=self._flush_periodically, daemon=True)
+        self.flusher.start()
+
+    def write(self, text):
+        with self.lock:
+            self.batch.append(text)
+            self.batch_lines += text.count("\n")
+            if self.batch_lines >= self.max_lines:
+                self._flush()
+
+    def flush(self):
+        """
+        Writes the current batch to the file.
+        """
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        """
+        Writes the current batch to the file. The lock must be held by the caller.
+        """
+        if self.batch:
+            self.file.write("".join(self.batch))
+            self.file.flush()
+            self.batch = []
+            self.batch_lines = 0
+
+    def _flush_periodically(self):
+        """
+        Writes the batch every interval, until the sink is closed.
+        """
+        while not self.closed.wait(self.interval):
+            self.flush()
+
+    def close(self):
+        self.closed.set()
+        self.flusher.join()
+        self.flush()
+        self.file.close()
@@ -0,0 +1,359 @@
+"""
+This module offers the optional write-ahead log and snapshots of the Marketplace.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+
+from array import array
+import mmap
+import os
+import pickle
+import struct
+from threading import Event, Lock, Thread
+
+# The kinds of records
+REGISTER_PRODUCER = 1
+PRODUCT = 2
+PUBLISH = 3
+NEW_CART = 4
+ADD_TO_CART = 5
+REMOVE_FROM_CART = 6
+PLACE_ORDER = 7
+ABANDON_CART = 8
+
+# A record: kind, cart id, product id, producer id, quantity. A PRODUCT record is
+# followed by the pickled product, and its quantity is the length of the pickle
+RECORD = struct.Struct('<Bqiii')
+
+# The snapshot header: magic, first segment that is not in the snapshot, payload length
+SNAPSHOT_MAGIC = b'MKTSNAP1'
+SNAPSHOT_HEADER = struct.Struct('<8sQQ')
+
+
+class MarketplaceState:
+    """
+    Class that rebuilds the state of a Marketplace from its records: the products,
+    the inventory matrix and the live carts.
+    """
+    # Must match Marketplace.CART_SLOT_BITS
+    CART_SLOT_BITS = 32
+
+    def __init__(self):
+        """
+        Constructor
+        """
+        self.products = []
+        self.stock = []
+        self.carts = {}
+        self.cart_generations = []
+
+    def apply(self, kind, cart_id, product_id, producer_id, quantity, payload=None):
+        """
+        Applies a record.
+
+        :type kind: Int
+        :param kind: the kind of record
+
+        :type payload: bytes
+        :param payload: the pickled product of a PRODUCT record
+        """
+        if kind == REGISTER_PRODUCER:
+            self.stock.append(array('i'))
+        elif kind == PRODUCT:
+            self.products.append(pickle.loads(payload))
+        elif kind == PUBLISH:
+            self._move(producer_id, product_id, quantity)
+        elif kind == NEW_CART:
+            slot = cart_id & ((1 << self.CART_SLOT_BITS) - 1)
+            while len(self.cart_generations) <= slot:
+                self.cart_generations.append(0)
+            self.cart_generations[slot] = cart_id >> self.CART_SLOT_BITS
+            self.carts[cart_id] = {}
+        elif kind == ADD_TO_CART:
+            self._move(producer_id, product_id, -quantity)
+            lines = self.carts[cart_id].setdefault(product_id, {})
+            lines[producer_id] = lines.get(producer_id, 0) + quantity
+        elif kind == REMOVE_FROM_CART:
+            self._move(producer_id, product_id, quantity)
+            lines = self.carts[cart_id][product_id]
+            lines[producer_id] -= quantity
+            if lines[producer_id] == 0:
+                del lines[producer_id]
+            if not lines:
+                del self.carts[cart_id][product_id]
+        elif kind in (PLACE_ORDER, ABANDON_CART):
+            cart = self.carts.pop(cart_id)
+            if kind == ABANDON_CART:
+                for line_product_id, lines in cart.items():
+                    for line_producer_id, count in lines.items():
+                        self._move(line_producer_id, line_product_id, count)
+            self.cart_generations[cart_id & ((1 << self.CART_SLOT_BITS) - 1)] += 1
+
+    def _move(self, producer_id, product_id, quantity):
+        """
+        Adds units of a product to a producer's row, or removes them if quantity is negative.
+        """
+        row = self.stock[producer_id]
+        if product_id >= len(row):
+            row.extend([0] * (product_id + 1 - len(row)))
+        row[product_id] += quantity
+
+    def replay(self, data):
+        """
+        Applies the records of a log segment. A record cut by a crash ends the replay.
+
+        :type data: bytes
+        :param data: the content of the segment
+
+        :rtype: Int
+        :return: the number of records applied
+        """
+        offset = 0
+        records = 0
+        while offset + RECORD.size <= len(data):
+            kind, cart_id, product_id, producer_id, quantity = RECORD.unpack_from(data, offset)
+            end = offset + RECORD.size
+            payload = None
+            if kind == PRODUCT:
+                payload = data[end:end + quantity]
+                end += quantity
+                if end > len(data):
+                    break
+
+            self.apply(kind, cart_id, product_id, producer_id, quantity, payload)
+            offset = end
+            records += 1
+
+        return records
+
+
+class MarketplaceStore:
+    """
+    Class that makes the state of a Marketplace durable. The operations append fixed
+    size binary records to an in-memory buffer, and a background thread writes the
+    buffer to the current log segment every interval (group commit), so a crash
+    loses at most the last interval. When the segment grows over checkpoint_bytes, it
+    is closed and the closed segments are folded into a snapshot, written through a
+    memory-mapped file, and deleted. Recovery loads the snapshot and replays the
+    segments that are left.
+    """
+    def __init__(self, directory, interval=0.005, fsync=True, checkpoint_bytes=16 << 20):
+        """
+        Constructor
+
+        :type directory: str
+        :param directory: where the log segments and the snapshot are kept
+
+        :type interval: Float
+        :param interval: the maximum number of seconds a record waits to be written
+
+        :type fsync: bool
+        :param fsync: if every write is followed by an fsync
+
+        :type checkpoint_bytes: Int
+        :param checkpoint_bytes: the size of a segment that triggers a checkpoint
+        """
+        self.directory = directory
+        self.interval = interval
+        self.fsync = fsync
+        self.checkpoint_bytes = checkpoint_bytes
+        os.makedirs(directory, exist_ok=True)
+
+        # Initialize the buffer of the records that are not written yet
+        self.lock = Lock()
+        self.buffer = bytearray()
+
+        # Initialize the lock for writing and switching the segments, and the lock
+        # for checkpoints
+        self.write_lock = Lock()
+        self.checkpoint_lock = Lock()
+
+        # Initialize the state of the snapshot and the segments that are not in it
+        self.state = MarketplaceState()
+        self.snapshot_segment = 0
+        self.segment = None
+        self.file = None
+        self.written = 0
+
+        self.closed = Event()
+        self.flusher = None
+
+    def _path(self, segment):
+        """
+        Returns the path of a log segment.
+        """
+        return os.path.join(self.directory, "wal-{:08d}.log".format(segment))
+
+    def _segments(self):
+        """
+        Returns the numbers of the log segments on disk, in order.
+        """
+        return sorted(int(name[4:12]) for name in os.listdir(self.directory)
+                      if name.startswith("wal-") and name.endswith(".log"))
+
+    def recover(self):
+        """
+        Loads the snapshot and replays the log segments after it.
+
+        :rtype: MarketplaceState
+        :return: the recovered state. It is a copy, the store keeps its own
+        """
+        path = os.path.join(self.directory, "snapshot.bin")
+        if os.path.exists(path):
+            with open(path, 'rb') as snapshot, \
+                    mmap.mmap(snapshot.fileno(), 0, access=mmap.ACCESS_READ) as view:
+                magic, self.snapshot_segment, length = SNAPSHOT_HEADER.unpack_from(view)
+                if magic != SNAPSHOT_MAGIC:
+                    raise ValueError("{} is not a marketplace snapshot".format(path))
+                self.state = pickle.loads(view[SNAPSHOT_HEADER.size:SNAPSHOT_HEADER.size + length])
+
+        state = pickle.loads(pickle.dumps(self.state))
+        for segment in self._segments():
+            if segment >= self.snapshot_segment:
+                with open(self._path(segment), 'rb') as log:
+                    state.replay(log.read())
+
+        return state
+
+    def open(self):
+        """
+        Starts a new log segment and the thread that writes the records.
+        """
+        segments = self._segments()
+        self._start_segment(max(segments + [self.snapshot_segment - 1]) + 1)
+
+        self.flusher = Thread(target=self._flush_periodically, daemon=True)
+        self.flusher.start()
+
+    def _start_segment(self, segment):
+        """
+        Closes the current log segment and opens a new one. The write lock must be held
+        by the caller, unless the thread that writes the records is not running.
+        """
+        if self.file is not None:
+            self.file.close()
+
+        self.segment = segment
+        self.file = open(self._path(segment), 'ab')  # pylint: disable=consider-using-with
+        self.written = 0
+
+    def append(self, kind, cart_id=0, product_id=0, producer_id=0, quantity=0):
+        """
+        Adds a record to the buffer.
+
+        :type kind: Int
+        :param kind: the kind of record
+        """
+        record = RECORD.pack(kind, cart_id, product_id, producer_id, quantity)
+        with self.lock:
+            self.buffer += record
+
+    def append_product(self, product_id, product):
+        """
+        Adds the record of a product that got a new id.
+
+        :type product_id: Int
+        :param product_id: the id of the product
+
+        :type product: Product
+        :param product: the product
+        """
+        payload = pickle.dumps(product)
+        record = RECORD.pack(PRODUCT, 0, product_id, 0, len(payload)) + payload
+        with self.lock:
+            self.buffer += record
+
+    def flush(self):
+        """
+        Writes the buffered records to the current log segment.
+        """
+        with self.write_lock:
+            self._flush()
+
+    def _flush(self):
+        """
+        Writes the buffered records. The write lock must be held by the caller.
+        """
+        with self.lock:
+            data = self.buffer
+            self.buffer = bytearray()
+
+        if data:
+            self.file.write(data)
+            self.file.flush()
+            if self.fsync:
+                os.fsync(self.file.fileno())
+            self.written += len(data)
+
+    def _flush_periodically(self):
+        """
+        Writes the buffer every interval and checkpoints the large segments, until
+        the store is closed.
+        """
+        while not self.closed.wait(self.interval):
+            self.flush()
+            if self.written >= self.checkpoint_bytes:
+                self.checkpoint()
+
+    def checkpoint(self):
+        """
+        Closes the current log segment, folds the closed segments into the snapshot
+        and deletes them.
+        """
+        with self.checkpoint_lock:
+            # Switch to a new segment, after writing the buffer to the old one
+            with self.write_lock:
+                self._flush()
+                last = self.segment
+                self._start_segment(last + 1)
+
+            # Fold the closed segments into the state of the snapshot
+            folded = [segment for segment in self._segments()
+                      if self.snapshot_segment <= segment <= last]
+            for segment in folded:
+                with open(self._path(segment), 'rb') as log:
+                    self.state.replay(log.read())
+
+            self._write_snapshot(last + 1)
+            self.snapshot_segment = last + 1
+
+            for segment in folded:
+                os.remove(self._path(segment))
+
+    def _write_snapshot(self, segment):
+        """
+        Writes the state to the snapshot file through a memory map, then renames it over
+        the previous snapshot.
+
+        :type segment: Int
+        :param segment: the first segment that is not in the snapshot
+        """
+        payload = pickle.dumps(self.state, protocol=pickle.HIGHEST_PROTOCOL)
+        size = SNAPSHOT_HEADER.size + len(payload)
+        path = os.path.join(self.directory, "snapshot.bin")
+        temporary = path + ".tmp"
+
+        with open(temporary, 'w+b') as snapshot:
+            snapshot.truncate(size)
+            with mmap.mmap(snapshot.fileno(), size) as view:
+                SNAPSHOT_HEADER.pack_into(view, 0, SNAPSHOT_MAGIC, segment, len(payload))
+                view[SNAPSHOT_HEADER.size:size] = payload
+                view.flush()
+            if self.fsync:
+                os.fsync(snapshot.fileno())
+
+        os.replace(temporary, path)
+
+    def close(self):
+        """
+        Writes the buffered records and stops the thread that writes them.
+        """
+        self.closed.set()
+        if self.flusher is not None:
+            self.flusher.join()
+        if self.file is not None:
+            self.flush()
+            self.file.close()
+            self.file = None
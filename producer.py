@@ -6,20 +6,27 @@ Assignment 1
 March 2021
 """
 
-from threading import Thread
+import heapq
+import itertools
+import logging
+from threading import Condition, Thread
 import time
+import unittest
+
+from clock import REAL_CLOCK
 
 class Producer(Thread):
     """
     Class that represents a producer.
     """
 
-    def __init__(self, products, marketplace, republish_wait_time, **kwargs):
+    def __init__(self, products, marketplace, republish_wait_time, clock=None, **kwargs):
         """
         Constructor.
 
         @type products: List()
-        @param products: a list of products that the producer will produce
+        @param products: a list of products that the producer will produce. It is
+        iterated again every round, so it can be a ProductionStream (workload.py)
 
         @type marketplace: Marketplace
         @param marketplace: a reference to the marketplace
@@ -28,6 +35,9 @@ class Producer(Thread):
         @param republish_wait_time: the number of seconds that a producer must
         wait until the marketplace becomes available
 
+        @type clock: RealClock
+        @param clock: the clock the producer sleeps on, the marketplace's clock by default
+
         @type kwargs:
         @param kwargs: other arguments that are passed to the Thread's __init__()
         """
@@ -35,16 +45,395 @@ class Producer(Thread):
         self.products = products
         self.marketplace = marketplace
         self.republish_wait_time = republish_wait_time
+        self.clock = clock if clock is not None else getattr(marketplace, 'clock', REAL_CLOCK)
+        self.stopped = False
+
+        # Only a local Marketplace counts the retries in its stats()
+        self.count_retry = getattr(marketplace, 'count_retry', lambda kind: None)
+
+    def stop(self):
+        """
+        Makes the producer return, at the latest after republish_wait_time.
+        """
+        self.stopped = True
 
     def run(self):
+        self.clock.session(self.produce)
+
+    def produce(self):
+        """
+        Publishes the products until the producer is stopped.
+        """
         producer_id = self.marketplace.register_producer()
-        while True:
+        while not self.stopped:
             for (product, quantity, sleep_time) in self.products:
-                while quantity > 0:
-                    ret = self.marketplace.publish(producer_id, product)
-
-                    if ret:
-                        time.sleep(sleep_time)
-                        quantity -= 1
-                    else:
-                        time.sleep(self.republish_wait_time)
+                while quantity > 0 and not self.stopped:
+                    # Without a production time, the whole quantity can be published at once
+                    batch = quantity if sleep_time == 0 else 1
+
+                    # Wait at most republish_wait_time for free space in the queue
+                    published = self.marketplace.publish_many(producer_id, product, batch,
+                                                              timeout=self.republish_wait_time)
+
+                    # The rest of the batch is published on the next iteration
+                    if published < batch and not self.stopped:
+                        self.count_retry('producer')
+
+                    if published > 0:
+                        self.clock.sleep(sleep_time)
+                        quantity -= published
+
+
+class _VirtualProducer:
+    """
+    Class that represents a producer driven by a ProducerScheduler: where it is in
+    its list of products, like the loops of Producer.run.
+    """
+    def __init__(self, producer_id, products):
+        """
+        Constructor
+
+        :type producer_id: Int
+        :param producer_id: the id given by the marketplace
+
+        :type products: List
+        :param products: the (product, quantity, sleep time) tuples of the producer
+        """
+        self.producer_id = producer_id
+        self.products = products
+        self.index = -1
+        self.quantity = 0
+
+    def next_product(self):
+        """
+        Moves to the next product with units to publish, starting over after the last
+        one. The products with no units are skipped, like in Producer.run.
+
+        :rtype: bool
+        :return: False if no product has units to publish
+        """
+        for _ in range(len(self.products)):
+            self.index = (self.index + 1) % len(self.products)
+            self.quantity = self.products[self.index][1]
+            if self.quantity > 0:
+                return True
+
+        return False
+
+
+class _SchedulerThread(Thread):
+    """
+    Thread that publishes for its virtual producers when they are due. It keeps a
+    min heap of (due time, sequence number, virtual producer).
+    """
+    def __init__(self, marketplace, republish_wait_time, clock, **kwargs):
+        """
+        Constructor
+
+        :type marketplace: Marketplace
+        :param marketplace: a reference to the marketplace
+
+        :type republish_wait_time: Time
+        :param republish_wait_time: the number of seconds a producer waits when its
+        queue is full
+
+        :type clock: RealClock
+        :param clock: the clock the producers are due on
+
+        :type kwargs:
+        :param kwargs: other arguments that are passed to the Thread's __init__()
+        """
+        Thread.__init__(self, **kwargs)
+        self.marketplace = marketplace
+        self.republish_wait_time = republish_wait_time
+        self.clock = clock
+        self.count_retry = getattr(marketplace, 'count_retry', lambda kind: None)
+
+        # Initialize the heap, the condition used to wait for the next due producer
+        # and the sequence that orders the producers due at the same time
+        self.heap = []
+        self.condition = Condition()
+        self.sequence = itertools.count()
+        self.stopped = False
+
+    def schedule(self, producer, due):
+        """
+        Adds a virtual producer to the heap.
+
+        :type producer: _VirtualProducer
+        :param producer: the virtual producer
+
+        :type due: Float
+        :param due: when it should publish, as a monotonic() value of the clock
+        """
+        with self.condition:
+            heapq.heappush(self.heap, (due, next(self.sequence), producer))
+            if self.heap[0][2] is producer:
+                self.condition.notify()
+
+    def stop(self):
+        """
+        Makes the thread return, without publishing what is still due.
+        """
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+
+    def run(self):
+        self.clock.session(self.publish_due)
+
+    def publish_due(self):
+        """
+        Publishes for the producers as they become due, until the thread is stopped.
+        """
+        def head():
+            return self.heap[0][:2] if self.heap else None
+
+        while True:
+            # Wait for the first producer to be due, or for an earlier one to be added
+            with self.condition:
+                while not self.stopped:
+                    now = self.clock.monotonic()
+                    if self.heap and self.heap[0][0] <= now:
+                        break
+                    first = head()
+                    self.clock.wait_for(self.condition,
+                                        lambda first=first: self.stopped or head() != first,
+                                        self.heap[0][0] - now if self.heap else None)
+
+                if self.stopped:
+                    return
+
+                # Take every producer that is due
+                due = []
+                while self.heap and self.heap[0][0] <= now:
+                    due.append(heapq.heappop(self.heap)[2])
+
+            for producer in due:
+                self.schedule(producer, self._publish(producer))
+
+    def start_producer(self, producer):
+        """
+        Schedules a new virtual producer right away, unless it has nothing to publish.
+
+        :type producer: _VirtualProducer
+        :param producer: the virtual producer
+        """
+        if producer.next_product():
+            self.schedule(producer, self.clock.monotonic())
+
+    def _publish(self, producer):
+        """
+        Publishes the next units of a virtual producer, without waiting.
+
+        :type producer: _VirtualProducer
+        :param producer: the virtual producer
+
+        :rtype: Float
+        :return: when the producer is due again
+        """
+        product, _, sleep_time = producer.products[producer.index]
+
+        # Without a production time, the whole quantity can be published at once
+        batch = producer.quantity if sleep_time == 0 else 1
+        published = self.marketplace.publish_many(producer.producer_id, product, batch)
+        if published < batch:
+            self.count_retry('producer')
+
+        # The queue is full, try again after republish_wait_time
+        if published == 0:
+            return self.clock.monotonic() + self.republish_wait_time
+
+        producer.quantity -= published
+        if producer.quantity <= 0:
+            # Move to the next product, and start over after the last one
+            producer.next_product()
+
+        # Sleep the production time of the published units
+        return self.clock.monotonic() + sleep_time
+
+
+class ProducerScheduler:
+    """
+    Class that drives many producers from a few threads, instead of one thread for
+    every Producer. Every producer publishes its (product, quantity, sleep time)
+    tuples in a loop, like Producer.run, but it sleeps in a heap instead of a thread.
+    A producer whose queue is full tries again after republish_wait_time.
+    """
+    def __init__(self, marketplace, republish_wait_time, threads=1, name="scheduler",
+                 clock=None):
+        """
+        Constructor
+
+        :type marketplace: Marketplace
+        :param marketplace: a reference to the marketplace
+
+        :type republish_wait_time: Time
+        :param republish_wait_time: the number of seconds a producer waits when its
+        queue is full
+
+        :type threads: Int
+        :param threads: the number of threads that publish
+
+        :type name: str
+        :param name: the prefix of the names of the threads
+
+        :type clock: RealClock
+        :param clock: the clock the producers sleep on, the marketplace's clock by default.
+        With a VirtualClock, the threads are run by clock.run() instead of start()
+        """
+        self.marketplace = marketplace
+        self.clock = clock if clock is not None else getattr(marketplace, 'clock', REAL_CLOCK)
+        self.threads = [_SchedulerThread(marketplace, republish_wait_time, self.clock,
+                                         name="{}{}".format(name, index), daemon=True)
+                        for index in range(threads)]
+        self.producers = 0
+
+    def add(self, products):
+        """
+        Registers a new producer, that starts publishing right away if the scheduler
+        is running.
+
+        :type products: List
+        :param products: the (product, quantity, sleep time) tuples of the producer
+
+        :rtype: Int
+        :return: the id of the producer
+        """
+        producer = _VirtualProducer(self.marketplace.register_producer(), list(products))
+
+        # Spread the producers over the threads
+        self.threads[self.producers % len(self.threads)].start_producer(producer)
+        self.producers += 1
+
+        return producer.producer_id
+
+    def start(self):
+        """
+        Starts the threads.
+        """
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self, timeout=None):
+        """
+        Stops the threads and waits for them to return.
+
+        :type timeout: Float
+        :param timeout: the maximum number of seconds to wait for every thread
+        """
+        for thread in self.threads:
+            thread.stop()
+        for thread in self.threads:
+            if thread.is_alive():
+                thread.join(timeout)
+
+
+class TestProducerScheduler(unittest.TestCase):
+    """
+    Class that tests the ProducerScheduler.
+    """
+    def setUp(self):
+        """
+        Setup the test.
+        """
+        # Imported here, so the producer does not depend on the marketplace module
+        from marketplace import Marketplace  # pylint: disable=import-outside-toplevel
+        self.marketplace = Marketplace(3, log_level=logging.WARNING)
+
+    def test_publishes_like_producer(self):
+        """
+        Tests that the producers publish their products in order until their queues fill.
+        """
+        scheduler = ProducerScheduler(self.marketplace, 0.001, threads=2)
+        producer_ids = [scheduler.add([("tea", 2, 0.001), ("coffee", 1, 0)]) for _ in range(10)]
+        scheduler.start()
+
+        deadline = time.monotonic() + 5
+        while (time.monotonic() < deadline and
+               any(self.marketplace.total_producers_elements[producer_id] < 3
+                   for producer_id in producer_ids)):
+            time.sleep(0.01)
+        scheduler.stop(5)
+
+        # Verify that every queue filled with 2 teas, then 1 coffee
+        for producer_id in producer_ids:
+            self.assertEqual(self.marketplace.producer_queue(producer_id),
+                             [["tea", 2], ["coffee", 1]])
+        self.assertFalse(any(thread.is_alive() for thread in scheduler.threads))
+
+    def test_stop_before_due(self):
+        """
+        Tests that stopping does not wait for a producer that sleeps.
+        """
+        scheduler = ProducerScheduler(self.marketplace, 0.001)
+        producer_id = scheduler.add([("tea", 1, 60)])
+        scheduler.start()
+        time.sleep(0.05)
+
+        start = time.monotonic()
+        scheduler.stop(5)
+
+        # Verify that the first unit was published and the thread returned right away
+        self.assertEqual(self.marketplace.total_producers_elements[producer_id], 1)
+        self.assertLess(time.monotonic() - start, 1)
+
+    def test_skips_zero_quantities(self):
+        """
+        Tests that the products with no units are skipped, with and without a sleep time.
+        """
+        scheduler = ProducerScheduler(self.marketplace, 0.001)
+        producer_id = scheduler.add([("tea", 0, 0), ("coffee", 2, 0.001), ("milk", 0, 0.001)])
+        idle_id = scheduler.add([("tea", 0, 0)])
+        scheduler.start()
+
+        deadline = time.monotonic() + 5
+        while (time.monotonic() < deadline and
+               self.marketplace.total_producers_elements[producer_id] < 3):
+            time.sleep(0.01)
+        scheduler.stop(5)
+
+        # Verify that only coffee was published, and the idle producer was never scheduled
+        self.assertEqual(self.marketplace.producer_queue(producer_id), [["coffee", 3]])
+        self.assertEqual(self.marketplace.producer_queue(idle_id), [])
+        self.assertFalse(any(thread.is_alive() for thread in scheduler.threads))
+
+    def test_virtual_clock(self):
+        """
+        Tests that the producers are due on the marketplace's clock.
+        """
+        # pylint: disable=import-outside-toplevel
+        from clock import VirtualClock
+        from marketplace import Marketplace
+
+        clock = VirtualClock()
+        market = Marketplace(100, log_level=logging.WARNING, clock=clock)
+        scheduler = ProducerScheduler(market, 1)
+        producer_id = scheduler.add([("tea", 1, 10)])
+
+        # Verify that one unit was published every 10 virtual seconds
+        self.assertEqual(clock.run(scheduler.threads, until=35), 35)
+        self.assertEqual(market.producer_queue(producer_id), [["tea", 4]])
+
+    def test_counts_retries(self):
+        """
+        Tests that the marketplace counts the retries of a Producer whose queue is full.
+        """
+        # pylint: disable=import-outside-toplevel
+        from clock import VirtualClock
+        from marketplace import Marketplace
+
+        clock = VirtualClock()
+        market = Marketplace(1, log_level=logging.WARNING, clock=clock, metrics=True)
+        producer = Producer([("tea", 2, 0)], market, 1, name="prod1")
+
+        def stop():
+            clock.sleep(5.5)
+            producer.stop()
+
+        stopper = Thread(target=clock.session, args=(stop,))
+
+        # Verify the retry after the partial publish_many(), then one every second until
+        # the producer is stopped
+        self.assertEqual(clock.run([producer, stopper], until=10), 6)
+        self.assertEqual(market.stats()['retries'], {'producer': 6})
@@ -0,0 +1,74 @@
+"""
+This module interns the Products to small integer ids.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+
+from threading import Lock
+
+
+class ProductRegistry:
+    """
+    Class that gives every distinct product a small integer id, starting from 0.
+    The marketplace indexes its inventory by these ids instead of comparing products.
+    """
+    def __init__(self):
+        """
+        Constructor
+        """
+        # Initialize the lock for adding products
+        self.lock = Lock()
+
+        # Initialize product -> id, id -> product and id -> hash of the product
+        self.ids = {}
+        self.products = []
+        self.hashes = []
+
+        # Initialize the function called with (id, product) for every new product
+        self.on_new = None
+
+    def intern(self, product):
+        """
+        Returns the id of the product, giving it a new id if it was never seen.
+
+        :type product: Product
+        :param product: the product
+
+        :rtype: Int
+        :return: the id of the product
+        """
+        product_id = self.ids.get(product)
+        if product_id is None:
+            with self.lock:
+                product_id = self.ids.get(product)
+                if product_id is None:
+                    product_id = len(self.products)
+                    self.products.append(product)
+                    self.hashes.append(hash(product))
+                    if self.on_new is not None:
+                        self.on_new(product_id, product)
+
+                    # Added last, so a product that can be found is complete
+                    self.ids[product] = product_id
+
+        return product_id
+
+    def lookup(self, product):
+        """
+        Returns the id of the product, without giving it one.
+
+        :type product: Product
+        :param product: the product
+
+        :rtype: Int
+        :return: the id of the product, or None if it was never seen
+        """
+        return self.ids.get(product)
+
+    def __len__(self):
+        """
+        Returns the number of products.
+        """
+        return len(self.products)
@@ -0,0 +1,784 @@
+"""
+This module serves a Marketplace on a socket, and offers the client that uses it.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+
+import itertools
+import json
+import logging
+import os
+import shutil
+import socket
+import struct
+import tempfile
+from threading import Event, Lock, Thread, current_thread, local
+import unittest
+
+from workload import PRODUCT_TYPES, product_spec
+
+# The methods that can be called, by their code in the frames
+METHODS = ('register_producer', 'publish', 'publish_many', 'new_cart', 'add_to_cart',
+           'reserve', 'remove_from_cart', 'place_order', 'abandon_cart', 'cart_alive',
+           'producer_queue')
+
+# The methods that may wait when they are called with a timeout, and the position of
+# the timeout in their arguments
+WAITING_METHODS = {'publish': 2, 'publish_many': 3, 'add_to_cart': 2, 'reserve': 2}
+
+# A frame: length of the payload, request id, method code (request) or status
+# (response), followed by the encoded arguments or result
+FRAME = struct.Struct('<IIB')
+
+# The statuses of a response
+OK = 0
+ERROR = 1
+
+# The number of bytes read from a socket at once
+READ_SIZE = 1 << 16
+
+# The exceptions raised again by the client by their name, any other is a RuntimeError
+ERRORS = {error.__name__: error for error in (TypeError, ValueError, KeyError, IndexError,
+                                              RuntimeError, ConnectionError)}
+
+
+def _encode(value):
+    """
+    Turns a value into JSON types. Only None, bools, numbers, strings, lists, tuples,
+    dicts with string keys, the products of product.py and exceptions can be sent, so
+    a peer can not make the other side build any other object.
+
+    :type value: object
+    :param value: the value
+
+    :rtype: object
+    :return: the JSON value. Tuples, dicts, products and exceptions are tagged objects
+
+    :raises TypeError: if the value can not be sent
+    """
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, list):
+        return [_encode(item) for item in value]
+    if isinstance(value, tuple):
+        return {'tuple': [_encode(item) for item in value]}
+    if isinstance(value, dict) and all(isinstance(key, str) for key in value):
+        return {'dict': {key: _encode(item) for key, item in value.items()}}
+    if PRODUCT_TYPES.get(type(value).__name__) is type(value):
+        return {'product': product_spec(value)}
+    if isinstance(value, Exception):
+        return {'error': [type(value).__name__, str(value)]}
+
+    raise TypeError("{} can not be sent to the marketplace".format(type(value).__name__))
+
+
+def _decode(value):
+    """
+    Turns a JSON value made by _encode() back into the value.
+
+    :type value: object
+    :param value: the JSON value
+
+    :rtype: object
+    :return: the value
+
+    :raises ValueError: if the JSON value was not made by _encode()
+    """
+    if isinstance(value, list):
+        return [_decode(item) for item in value]
+    if not isinstance(value, dict):
+        return value
+    if len(value) != 1:
+        raise ValueError("unknown object")
+
+    (tag, content), = value.items()
+    try:
+        if tag == 'tuple':
+            return tuple(_decode(item) for item in content)
+        if tag == 'dict':
+            return {key: _decode(item) for key, item in content.items()}
+        if tag == 'product':
+            fields = dict(content)
+            return PRODUCT_TYPES[fields.pop('product_type')](**fields)
+        if tag == 'error':
+            name, message = content
+            return ERRORS.get(name, RuntimeError)(message)
+    except (AttributeError, KeyError, TypeError) as error:
+        raise ValueError("malformed {}: {}".format(tag, error)) from None
+
+    raise ValueError("unknown object {!r}".format(tag))
+
+
+def _dumps(value):
+    """
+    Returns the payload of a frame.
+
+    :type value: object
+    :param value: the arguments or the result
+
+    :rtype: bytes
+    :return: the payload
+    """
+    return json.dumps(_encode(value), separators=(',', ':')).encode('utf-8')
+
+
+def _loads(payload):
+    """
+    Returns the value of the payload of a frame.
+
+    :type payload: bytes
+    :param payload: the payload
+
+    :rtype: object
+    :return: the arguments or the result
+
+    :raises ValueError: if the payload was not made by _dumps()
+    """
+    return _decode(json.loads(payload))
+
+
+def _connect(address):
+    """
+    Opens a socket to a server.
+
+    :type address: str or Tuple
+    :param address: the path of a Unix socket, or a (host, port) TCP address
+
+    :rtype: socket
+    :return: the connected socket
+    """
+    if isinstance(address, str):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    else:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.connect(address)
+    return sock
+
+
+def _read_frames(sock, handle):
+    """
+    Reads frames from a socket until it is closed. All the frames that arrived
+    together are handled before the next read.
+
+    :type sock: socket
+    :param sock: the socket
+
+    :type handle: Callable
+    :param handle: called with the list of (request id, code or status, payload) of
+    every read
+    """
+    buffer = bytearray()
+    while True:
+        try:
+            data = sock.recv(READ_SIZE)
+        except OSError:
+            return
+        if not data:
+            return
+        buffer += data
+
+        # Split the complete frames, the rest waits for the next read
+        frames = []
+        offset = 0
+        while offset + FRAME.size <= len(buffer):
+            length, request_id, code = FRAME.unpack_from(buffer, offset)
+            end = offset + FRAME.size + length
+            if end > len(buffer):
+                break
+            frames.append((request_id, code, bytes(buffer[offset + FRAME.size:end])))
+            offset = end
+        del buffer[:offset]
+
+        if frames:
+            handle(frames)
+
+
+class MarketplaceServer:
+    """
+    Class that serves a Marketplace on a Unix or TCP socket. Every connection has a
+    thread that reads the requests. The requests that arrived together run in order,
+    and their responses are sent with one write. A request that may wait (a publish
+    or an add with a timeout) runs on its own thread, so it does not hold back the
+    requests behind it, and its response is sent when it is done.
+    """
+    def __init__(self, marketplace, address):
+        """
+        Constructor
+
+        :type marketplace: Marketplace
+        :param marketplace: the marketplace to serve
+
+        :type address: str or Tuple
+        :param address: the path of a Unix socket, or a (host, port) TCP address. Port 0
+        picks a free port
+        """
+        self.marketplace = marketplace
+
+        if isinstance(address, str):
+            self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(address)
+        self.listener.listen()
+        self.address = self.listener.getsockname()
+
+        # Initialize the open connections
+        self.lock = Lock()
+        self.connections = []
+        self.closed = False
+        self.acceptor = None
+
+    def start(self):
+        """
+        Starts accepting connections.
+
+        :rtype: MarketplaceServer
+        :return: the server
+        """
+        self.acceptor = Thread(target=self._accept, name="rpc-accept", daemon=True)
+        self.acceptor.start()
+        return self
+
+    def _accept(self):
+        """
+        Accepts connections until the server is closed.
+        """
+        while True:
+            try:
+                sock, _ = self.listener.accept()
+            except OSError:
+                return
+
+            if sock.family == socket.AF_INET:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            with self.lock:
+                if self.closed:
+                    sock.close()
+                    return
+                self.connections.append(sock)
+
+            write_lock = Lock()
+            Thread(target=_read_frames,
+                   args=(sock, lambda frames, sock=sock, write_lock=write_lock:
+                         self._handle(sock, write_lock, frames)),
+                   name="rpc-connection", daemon=True).start()
+
+    def _handle(self, sock, write_lock, frames):
+        """
+        Runs the requests read together and sends their responses.
+
+        :type sock: socket
+        :param sock: the connection
+
+        :type write_lock: Lock
+        :param write_lock: the lock for writing to the connection
+
+        :type frames: List
+        :param frames: the (request id, method code, encoded arguments) of the requests
+        """
+        responses = bytearray()
+        for request_id, code, payload in frames:
+            # A request that can not be read is answered with the error
+            try:
+                args, kwargs = _loads(payload)
+                method = METHODS[code]
+                if not isinstance(args, tuple) or not isinstance(kwargs, dict):
+                    raise ValueError("malformed arguments")
+            except (ValueError, IndexError, TypeError) as error:
+                responses += self._response(request_id, ERROR, error)
+                continue
+
+            # A request that may wait gets its own thread
+            if method in WAITING_METHODS and self._timeout(method, args, kwargs) != 0:
+                Thread(target=self._run_alone,
+                       args=(sock, write_lock, request_id, method, args, kwargs),
+                       daemon=True).start()
+            else:
+                responses += self._run(request_id, method, args, kwargs)
+
+        if responses:
+            self._send(sock, write_lock, responses)
+
+    @staticmethod
+    def _timeout(method, args, kwargs):
+        """
+        Returns the timeout a request that may wait was called with.
+
+        :rtype: Float
+        :return: the timeout, 0 by default
+        """
+        position = WAITING_METHODS[method]
+        if len(args) > position:
+            return args[position]
+        return kwargs.get('timeout', 0)
+
+    def _run(self, request_id, method, args, kwargs):
+        """
+        Calls a method of the marketplace.
+
+        :rtype: bytes
+        :return: the response frame, with the result or the exception raised
+        """
+        try:
+            status, result = OK, getattr(self.marketplace, method)(*args, **kwargs)
+        except Exception as error:  # pylint: disable=broad-except
+            status, result = ERROR, error
+
+        return self._response(request_id, status, result)
+
+    @staticmethod
+    def _response(request_id, status, result):
+        """
+        Returns a response frame.
+
+        :rtype: bytes
+        :return: the frame, with the result, or the exception if it can not be sent
+        """
+        try:
+            payload = _dumps(result)
+        except TypeError as error:
+            status, payload = ERROR, _dumps(error)
+        return FRAME.pack(len(payload), request_id, status) + payload
+
+    def _run_alone(self, sock, write_lock, request_id, method, args, kwargs):
+        """
+        Calls a method of the marketplace that may wait, and sends its response.
+        """
+        self._send(sock, write_lock, self._run(request_id, method, args, kwargs))
+
+    @staticmethod
+    def _send(sock, write_lock, data):
+        """
+        Writes responses to a connection. A connection closed by the client is ignored.
+        """
+        with write_lock:
+            try:
+                sock.sendall(data)
+            except OSError:
+                pass
+
+    def close(self):
+        """
+        Stops accepting connections and closes the open ones.
+        """
+        with self.lock:
+            self.closed = True
+            connections = self.connections
+            self.connections = []
+
+        try:
+            self.listener.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.listener.close()
+        for sock in connections:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            sock.close()
+
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.remove(self.address)
+
+
+class _Call:
+    """
+    Class that represents a request waiting for its response.
+    """
+    def __init__(self):
+        """
+        Constructor
+        """
+        self.done = Event()
+        self.status = None
+        self.result = None
+
+
+class _ClientConnection:
+    """
+    Class that represents a connection of a MarketplaceClient. The calls of every
+    thread are written to a shared buffer, and the first caller that finds nobody
+    writing sends the whole buffer, so the calls made at the same time share a write.
+    A reader thread matches the responses with the calls by their request id.
+    """
+    def __init__(self, address):
+        """
+        Constructor
+
+        :type address: str or Tuple
+        :param address: the address of the server
+        """
+        self.sock = _connect(address)
+
+        # Initialize the buffer of the requests not sent yet and the calls waiting
+        self.lock = Lock()
+        self.outgoing = bytearray()
+        self.sending = False
+        self.calls = {}
+        self.request_ids = itertools.count()
+        self.closed = False
+
+        self.reader = Thread(target=self._read, name="rpc-reader", daemon=True)
+        self.reader.start()
+
+    def call(self, code, args, kwargs):
+        """
+        Sends a request and waits for its response.
+
+        :type code: Int
+        :param code: the code of the method
+
+        :rtype: object
+        :return: the result of the method
+
+        :raises: the exception raised by the method
+        """
+        payload = _dumps((args, kwargs))
+        pending = _Call()
+
+        with self.lock:
+            if self.closed:
+                raise ConnectionError("the connection to the marketplace was closed")
+            request_id = next(self.request_ids) & 0xFFFFFFFF
+            self.calls[request_id] = pending
+            self.outgoing += FRAME.pack(len(payload), request_id, code)
+            self.outgoing += payload
+
+            # Another caller is writing, it sends this request too
+            send = not self.sending
+            self.sending = True
+
+        try:
+            while send:
+                with self.lock:
+                    data = self.outgoing
+                    self.outgoing = bytearray()
+                    if not data:
+                        self.sending = False
+                        break
+                self.sock.sendall(data)
+        except OSError as error:
+            # The requests can not be sent: close the connection and fail every call
+            with self.lock:
+                self.sending = False
+            self._fail_calls(ConnectionError(
+                "the connection to the marketplace was lost: {}".format(error)))
+            self.close()
+
+        pending.done.wait()
+        if pending.status == ERROR:
+            raise pending.result
+        return pending.result
+
+    def _read(self):
+        """
+        Reads the responses until the connection is closed, then fails the calls still
+        waiting.
+        """
+        try:
+            _read_frames(self.sock, self._complete)
+        finally:
+            self._fail_calls(ConnectionError("the connection to the marketplace was closed"))
+
+    def _fail_calls(self, error):
+        """
+        Marks the connection closed and fails the calls still waiting.
+
+        :type error: Exception
+        :param error: the exception the calls raise
+        """
+        with self.lock:
+            self.closed = True
+            calls = self.calls
+            self.calls = {}
+        for pending in calls.values():
+            pending.status = ERROR
+            pending.result = error
+            pending.done.set()
+
+    def _complete(self, frames):
+        """
+        Hands the responses to the calls waiting for them. A response to no call is
+        dropped, and a response that can not be decoded fails its call.
+
+        :type frames: List
+        :param frames: the (request id, status, encoded result) of the responses
+        """
+        for request_id, status, payload in frames:
+            with self.lock:
+                pending = self.calls.pop(request_id, None)
+            if pending is None:
+                continue
+
+            try:
+                result = _loads(payload)
+            except (ValueError, IndexError, TypeError) as error:
+                status, result = ERROR, error
+            if status == ERROR and not isinstance(result, Exception):
+                result = ValueError("the error of the response is not an exception")
+            pending.status = status
+            pending.result = result
+            pending.done.set()
+
+    def close(self):
+        """
+        Closes the connection.
+        """
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+def _remote(method):
+    """
+    Returns a MarketplaceClient method that calls the method of the remote marketplace.
+
+    :type method: str
+    :param method: the name of the method
+
+    :rtype: Callable
+    :return: the client method
+    """
+    code = METHODS.index(method)
+
+    def call(self, *args, **kwargs):
+        return self._connection().call(code, args, kwargs)  # pylint: disable=protected-access
+
+    call.__name__ = method
+    call.__doc__ = "Calls {}() of the remote marketplace.".format(method)
+    return call
+
+
+class MarketplaceClient:
+    """
+    Class that uses a Marketplace served by a MarketplaceServer, with the same methods,
+    so Producer and Consumer can use it unchanged. It keeps a pool of connections, and
+    every thread always uses the same one, so its calls stay in order; the calls of the
+    threads that share a connection are pipelined on it.
+    """
+    def __init__(self, address, connections=4):
+        """
+        Constructor
+
+        :type address: str or Tuple
+        :param address: the path of a Unix socket, or a (host, port) TCP address
+
+        :type connections: Int
+        :param connections: the number of connections of the pool
+        """
+        self.address = address
+        self.connections = [_ClientConnection(address) for _ in range(connections)]
+
+        # Initialize the connection of every thread, given in turn
+        self.local = local()
+        self.next_connection = itertools.count()
+
+    def _connection(self):
+        """
+        Returns the connection of the current thread.
+        """
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = self.local.connection = \
+                self.connections[next(self.next_connection) % len(self.connections)]
+        return connection
+
+    def place_order(self, cart_id, name=None):
+        """
+        Calls place_order() of the remote marketplace. The receipt has the name of the
+        current thread, not the one of the server's thread.
+        """
+        return self._connection().call(METHODS.index('place_order'), (cart_id,),
+                                       {'name': name if name is not None
+                                                else current_thread().name})
+
+    def close(self):
+        """
+        Closes the connections.
+        """
+        for connection in self.connections:
+            connection.close()
+
+
+for _method in METHODS:
+    if not hasattr(MarketplaceClient, _method):
+        setattr(MarketplaceClient, _method, _remote(_method))
+
+
+class TestMarketplaceRpc(unittest.TestCase):
+    """
+    Class that tests the MarketplaceServer and the MarketplaceClient.
+    """
+    def setUp(self):
+        """
+        Setup the test.
+        """
+        # pylint: disable=import-outside-toplevel
+        from marketplace import Marketplace
+        from order_sink import BufferSink
+
+        self.directory = tempfile.mkdtemp()
+        self.sink = BufferSink()
+        self.marketplace = Marketplace(5, log_level=logging.WARNING, order_sink=self.sink)
+        self.server = MarketplaceServer(self.marketplace,
+                                        os.path.join(self.directory, "market.sock")).start()
+        self.client = MarketplaceClient(self.server.address, connections=2)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.close()
+        shutil.rmtree(self.directory)
+
+    def test_methods(self):
+        """
+        Tests the methods of the remote marketplace and the errors they raise.
+        """
+        client = self.client
+        producer_id = client.register_producer()
+        self.assertEqual(client.publish_many(producer_id, "tea", 7), 5)
+        self.assertFalse(client.publish(producer_id, "tea"))
+
+        cart_id = client.new_cart()
+        self.assertEqual(client.add_to_cart(cart_id, "tea", quantity=3), 3)
+        self.assertEqual(client.remove_from_cart(cart_id, "tea", quantity=1), 1)
+        self.assertEqual(client.producer_queue(producer_id), [["tea", 3]])
+        self.assertEqual(client.place_order(cart_id), [["tea", producer_id]] * 2)
+        self.assertEqual(self.sink.lines, ["MainThread bought tea"] * 2)
+
+        # Verify that an exception raised by the server is raised by the client
+        with self.assertRaises(TypeError):
+            client.remove_from_cart(cart_id, ["tea"])
+
+    def test_restricted_codec(self):
+        """
+        Tests that only plain values and products are sent, and that anything else in
+        a request is refused without being built.
+        """
+        from product import Tea  # pylint: disable=import-outside-toplevel
+
+        tea = Tea("Linden", 9, "Herbal")
+        items = ([(tea, 2)], {'timeout': 0.5, 'name': None})
+        self.assertEqual(_loads(_dumps(items)), items)
+        self.assertIsInstance(_loads(_dumps(items))[0][0][0], Tea)
+
+        with self.assertRaises(TypeError):
+            _dumps(object())
+        for payload in (b'{"class": "os.system"}', b'{"product": {"product_type": "str"}}',
+                        b'not json'):
+            with self.assertRaises(ValueError):
+                _loads(payload)
+
+        # Verify that the server answers a forged request with an error
+        sock = _connect(self.server.address)
+        try:
+            payload = b'{"reduce": ["os.system", ["true"]]}'
+            sock.sendall(FRAME.pack(len(payload), 7, METHODS.index('new_cart')) + payload)
+            frames = []
+            _read_frames(sock, lambda read: frames.extend(read) or sock.shutdown(socket.SHUT_RD))
+            (request_id, status, result), = frames
+            self.assertEqual((request_id, status), (7, ERROR))
+            self.assertIsInstance(_loads(result), ValueError)
+        finally:
+            sock.close()
+
+    def test_waiting_call_does_not_block_others(self):
+        """
+        Tests that a call waiting for stock does not hold back the calls behind it.
+        """
+        client = MarketplaceClient(self.server.address, connections=1)
+        try:
+            cart_id = client.new_cart()
+            results = []
+            consumer = Thread(target=lambda: results.append(
+                client.add_to_cart(cart_id, "coffee", timeout=10)))
+            consumer.start()
+
+            producer_id = client.register_producer()
+            self.assertTrue(client.publish(producer_id, "coffee"))
+            consumer.join(5)
+            self.assertEqual(results, [True])
+        finally:
+            client.close()
+
+    def test_broken_connection(self):
+        """
+        Tests that the calls fail instead of waiting forever when the responses can not
+        be read, or the requests can not be sent.
+        """
+        path = os.path.join(self.directory, "fake.sock")
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(path)
+        listener.listen(1)
+
+        def answer():
+            # Answer the first request with an unknown id, then with a broken result
+            sock, _ = listener.accept()
+            frames = []
+            _read_frames(sock, lambda read: frames.extend(read) or sock.shutdown(socket.SHUT_RD))
+            request_id = frames[0][0]
+            sock.sendall(FRAME.pack(1, request_id + 1, OK) + b'1'
+                         + FRAME.pack(3, request_id, OK) + b'{"a')
+            sock.close()
+
+        server = Thread(target=answer)
+        server.start()
+        connection = _ClientConnection(path)
+        try:
+            with self.assertRaises(ValueError):
+                connection.call(METHODS.index('new_cart'), (), {})
+            server.join(5)
+            connection.reader.join(5)
+            with self.assertRaises(ConnectionError):
+                connection.call(METHODS.index('new_cart'), (), {})
+        finally:
+            connection.close()
+            listener.close()
+
+        # Verify that a request that can not be sent fails every call of the connection
+        connection = _ClientConnection(self.server.address)
+        try:
+            connection.sock.shutdown(socket.SHUT_WR)
+            with self.assertRaises(ConnectionError):
+                connection.call(METHODS.index('new_cart'), (), {})
+            self.assertFalse(connection.sending)
+            with self.assertRaises(ConnectionError):
+                connection.call(METHODS.index('new_cart'), (), {})
+        finally:
+            connection.close()
+
+    def test_producer_and_consumer(self):
+        """
+        Tests that Producers and Consumers run unchanged against the remote marketplace.
+        """
+        # pylint: disable=import-outside-toplevel
+        from consumer import Consumer
+        from producer import Producer
+
+        producers = [Producer([("tea", 2, 0)], self.client, 0.01, daemon=True),
+                     Producer([("coffee", 1, 0)], self.client, 0.01, daemon=True)]
+        carts = [[{"type": "add", "product": "tea", "quantity": 2},
+                  {"type": "add", "product": "coffee", "quantity": 1},
+                  {"type": "remove", "product": "tea", "quantity": 1}]] * 5
+        consumers = [Consumer(carts, self.client, 0.01, name="cons{}".format(i))
+                     for i in range(3)]
+        for thread in producers + consumers:
+            thread.start()
+        for thread in consumers:
+            thread.join(10)
+
+        # The producers publish forever: stop them before the client is closed
+        for producer in producers:
+            producer.stop()
+        for producer in producers:
+            producer.join(5)
+
+        self.assertFalse(any(thread.is_alive() for thread in consumers + producers))
+        self.assertEqual(len(self.sink.lines), 30)
+        self.assertEqual(sum(line.startswith("cons1 ") for line in self.sink.lines), 10)
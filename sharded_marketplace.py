@@ -0,0 +1,793 @@
+"""
+This module represents the sharded Marketplace, whose inventory is split across
+several independent Marketplaces.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+
+import logging
+from multiprocessing.managers import BaseManager
+from threading import Condition, Lock, Thread, current_thread
+import time
+import unittest
+
+from capacity import CapacityPolicy
+from clock import REAL_CLOCK, VirtualClock
+from marketplace import Marketplace, deadline_after, time_left, wait_for
+from order_sink import BufferSink, NullSink, StdoutSink
+from product_registry import ProductRegistry
+
+
+def _new_shard(queue_size_per_producer, log_level, shard_kwargs):
+    """
+    Creates the Marketplace of a shard. The shards write no receipts, the
+    ShardedMarketplace writes them for the whole order.
+
+    :type queue_size_per_producer: Int
+    :param queue_size_per_producer: the maximum size of a producer's queue in the shard
+
+    :type log_level: Int
+    :param log_level: the level of the shard's logger
+
+    :type shard_kwargs: Dict
+    :param shard_kwargs: other arguments of the shard's Marketplace
+
+    :rtype: Marketplace
+    :return: the shard
+    """
+    return Marketplace(queue_size_per_producer, log_level=log_level, order_sink=NullSink(),
+                       **shard_kwargs)
+
+
+class _ProducerBudget(CapacityPolicy):
+    """
+    Policy shared by the shards of a ShardedMarketplace, so a producer has one queue
+    of queue_size_per_producer units for all of them. Publishing in any shard takes
+    from the producer's budget, and the units taken into a cart give it back, like the
+    units that go back to a queue take from it again.
+    """
+    def __init__(self, queue_size_per_producer):
+        """
+        Constructor
+
+        :type queue_size_per_producer: Int
+        :param queue_size_per_producer: the maximum number of units a producer has
+        queued in all the shards
+        """
+        self.queue_size_per_producer = queue_size_per_producer
+
+        # Initialize the condition the ShardedMarketplace waits on for free space, and
+        # the units every producer has queued in all the shards
+        self.condition = Condition()
+        self.queued = []
+
+    def registered(self, producer_id):
+        # Every shard registers the producer, with the same id
+        with self.condition:
+            while len(self.queued) <= producer_id:
+                self.queued.append(0)
+
+    def acquire(self, producer_id, queued, quantity):
+        with self.condition:
+            acquired = max(0, min(quantity, self._free_space(producer_id)))
+            self.queued[producer_id] += acquired
+            return acquired
+
+    def free_space(self, producer_id, queued):
+        with self.condition:
+            return self._free_space(producer_id)
+
+    def changed(self, producer_id, quantity):
+        with self.condition:
+            self.queued[producer_id] += quantity
+
+            # Wake up the producers waiting for free space in the ShardedMarketplace
+            if quantity < 0:
+                self.condition.notify_all()
+            return []
+
+    def limits(self):
+        return [self.queue_size_per_producer] * len(self.queued)
+
+    def _free_space(self, producer_id):
+        """
+        Returns the number of units the producer can publish in all the shards. The
+        lock must be held by the caller.
+
+        :type producer_id: Int
+        :param producer_id: the producer
+
+        :rtype: Int
+        :return: the number of units, 0 or less if the queue is full
+        """
+        return self.queue_size_per_producer - self.queued[producer_id]
+
+
+class _ShardManager(BaseManager):
+    """
+    Manager whose server process holds the Marketplace of one shard.
+    """
+
+
+_ShardManager.register('Shard', _new_shard)
+
+
+class ShardedMarketplace:
+    """
+    Class that represents a Marketplace whose inventory is split across shards, each
+    of them an independent Marketplace with its own locks, so no lock is shared by
+    two shards. It has the same methods as the Marketplace.
+
+    A product lives in the shard given by its hash, so all the units of a product, of
+    every producer, are in the same shard. A producer is registered in every shard,
+    with the same id, and has one queue of queue_size_per_producer units for all of
+    them: the shards share one capacity policy, so a producer of a single product can
+    fill its whole queue in that product's shard, and never has more than
+    queue_size_per_producer units queued in all.
+
+    A cart starts in its home shard, chosen in turn, and its id is the cart id in the
+    home shard times the number of shards, plus the home shard. The cart gets a
+    part in another shard when a product of that shard is first added to it, and
+    place_order() places every part and writes one receipt for all of them. The parts
+    of a cart that expired in its home shard are abandoned when the cart is next used,
+    and new_cart() sweeps the ones of the carts nobody uses again.
+
+    With processes=True, every shard runs in its own server process, so the shards
+    use several cores; the products are pickled on every call. The shards can not
+    share a policy then, so every shard holds up to queue_size_per_producer // shards
+    units of a producer, and queue_size_per_producer must be at least the number of
+    shards.
+    """
+    def __init__(self, queue_size_per_producer, shards=4, processes=False,
+                 log_level=logging.INFO, order_sink=None, **shard_kwargs):
+        """
+        Constructor
+
+        :type queue_size_per_producer: Int
+        :param queue_size_per_producer: the maximum size of a producer's queue, for all the
+        shards together
+
+        :type shards: Int
+        :param shards: the number of shards
+
+        :type processes: bool
+        :param processes: if every shard runs in its own process
+
+        :type log_level: Int
+        :param log_level: the level of the shards' loggers
+
+        :type order_sink: OrderSink
+        :param order_sink: where the placed orders are written, stdout by default
+
+        :type shard_kwargs:
+        :param shard_kwargs: other arguments of the shards' Marketplaces, but the capacity
+        """
+        if processes and queue_size_per_producer < shards:
+            raise ValueError("the queue of a producer must hold at least one unit per shard")
+
+        # Initialize the shards, and the managers of their processes. The shards in this
+        # process share the budget of every producer, the others get their share of it
+        self.budget = None
+        self.managers = []
+        self.shards = []
+        for _ in range(shards):
+            if processes:
+                manager = _ShardManager()
+                manager.start()  # pylint: disable=consider-using-with
+                self.managers.append(manager)
+                self.shards.append(manager.Shard(queue_size_per_producer // shards, log_level,
+                                                 shard_kwargs))
+            else:
+                if self.budget is None:
+                    self.budget = _ProducerBudget(queue_size_per_producer)
+                self.shards.append(_new_shard(queue_size_per_producer, log_level,
+                                              dict(shard_kwargs, capacity=self.budget)))
+
+        # Initialize the clock of the reservation deadlines, the one of the shards
+        self.clock = shard_kwargs.get('clock') or REAL_CLOCK
+
+        # Initialize the registry that remembers the hash of every product
+        self.registry = ProductRegistry()
+
+        # Initialize the lock for registering producers
+        self.producers_lock = Lock()
+
+        # Initialize the home shard of the next cart, the parts of the carts in the
+        # shards that are not their home: cart id -> {shard: cart id in the shard}, and
+        # the time to live of the carts that were given one: cart id -> seconds
+        self.carts_lock = Lock()
+        self.next_home = 0
+        self.cart_parts = {}
+        self.cart_ttls = {}
+
+        # Initialize the number of carts with parts or times to live that makes
+        # new_cart() sweep the ones of the dead carts
+        self.sweep_at = 64
+
+        # Initialize the sink of the placed orders
+        self.order_sink = order_sink if order_sink is not None else StdoutSink()
+
+    def close(self):
+        """
+        Stops the processes of the shards.
+        """
+        for manager in self.managers:
+            manager.shutdown()
+        self.managers = []
+
+    def _shard_of(self, product, intern=False):
+        """
+        Returns the index of the shard that holds a product.
+
+        :type product: Product
+        :param product: the product
+
+        :type intern: bool
+        :param intern: if the hash of a product never seen is remembered. Only publish
+        does it, so looking for products that do not exist costs no memory
+
+        :rtype: Int
+        :return: the index of the shard
+        """
+        product_id = (self.registry.intern(product) if intern
+                      else self.registry.lookup(product))
+        if product_id is None:
+            return hash(product) % len(self.shards)
+
+        return self.registry.hashes[product_id] % len(self.shards)
+
+    def _home(self, cart_id):
+        """
+        Returns the home shard of a cart and the id of the cart in it.
+
+        :type cart_id: Int
+        :param cart_id: id cart
+
+        :rtype: Tuple
+        :return: (index of the shard, cart id in the shard), or None if the id is not valid
+        """
+        if cart_id < 0:
+            return None
+
+        return cart_id % len(self.shards), cart_id // len(self.shards)
+
+    def _part(self, cart_id, shard, create):
+        """
+        Returns the id of a cart's part in a shard.
+
+        :type cart_id: Int
+        :param cart_id: id cart
+
+        :type shard: Int
+        :param shard: the index of the shard
+
+        :type create: bool
+        :param create: if the part is created when the cart has none in the shard
+
+        :rtype: Int
+        :return: the cart id in the shard, or None if the cart has no part there or
+        the id is not valid
+        """
+        home = self._home(cart_id)
+        if home is None:
+            return None
+        if home[0] == shard:
+            return home[1]
+
+        parts = self.cart_parts.get(cart_id)
+        part = None if parts is None else parts.get(shard)
+        if part is not None or not create:
+            return part
+
+        # Create the part without holding the lock, and keep the first one if the
+        # cart's owner created one at the same time
+        if not self.shards[home[0]].cart_alive(home[1]):
+            self._drop_parts(cart_id)
+            return None
+        part = self.shards[shard].new_cart(self.cart_ttls.get(cart_id))
+        with self.carts_lock:
+            kept = self.cart_parts.setdefault(cart_id, {}).setdefault(shard, part)
+        if kept != part:
+            self.shards[shard].abandon_cart(part)
+
+        return kept
+
+    def register_producer(self):
+        """
+        Returns an id for the producer that calls this. The producer gets the same id
+        in every shard.
+        """
+        with self.producers_lock:
+            producer_ids = {shard.register_producer() for shard in self.shards}
+
+        return producer_ids.pop()
+
+    def publish(self, producer_id, product, timeout=0):
+        """
+        Adds the product provided by the producer to the marketplace, in the shard of
+        the product.
+
+        :type producer_id: Int
+        :param producer_id: producer id
+
+        :type product: Product
+        :param product: the Product that will be published in the Marketplace
+
+        :type timeout: Float
+        :param timeout: the number of seconds to wait for free space in the queue
+
+        :returns True or False. If the caller receives False, it should wait and then try again.
+        """
+        return self.publish_many(producer_id, product, 1, timeout) == 1
+
+    def publish_many(self, producer_id, product, quantity, timeout=0):
+        """
+        Adds up to quantity units of the product to the marketplace, in the shard of
+        the product. The units taken from the producer's queue in any shard free space,
+        so the wait for it is done here, on the shared budget, and not in the shard.
+
+        :rtype: Int
+        :return: the number of units published
+        """
+        shard = self.shards[self._shard_of(product, intern=True)]
+        if self.budget is None:
+            return shard.publish_many(producer_id, product, quantity, timeout)
+
+        deadline = deadline_after(timeout, self.clock)
+        budget = self.budget
+        while True:
+            published = shard.publish_many(producer_id, product, quantity)
+            if published or quantity <= 0 or not 0 <= producer_id < len(budget.queued):
+                return published
+
+            # Wait for free space in the producer's queue, in any shard
+            with budget.condition:
+                if not wait_for(budget.condition,
+                                lambda: budget.free_space(producer_id, 0) > 0,
+                                time_left(deadline, self.clock), self.clock):
+                    return 0
+
+    def new_cart(self, reservation_ttl=None):
+        """
+        Creates a new cart for the consumer, in the next home shard.
+
+        :type reservation_ttl: Float
+        :param reservation_ttl: the time to live of the cart and of its parts, the one of
+        the shards if None
+
+        :returns an int representing the cart_id
+        """
+        with self.carts_lock:
+            home = self.next_home
+            self.next_home = (home + 1) % len(self.shards)
+            sweep = len(self.cart_parts) + len(self.cart_ttls) >= self.sweep_at
+
+        if sweep:
+            self._sweep_parts()
+
+        cart_id = self.shards[home].new_cart(reservation_ttl) * len(self.shards) + home
+        if reservation_ttl is not None:
+            with self.carts_lock:
+                self.cart_ttls[cart_id] = reservation_ttl
+
+        return cart_id
+
+    def _sweep_parts(self):
+        """
+        Abandons the parts of the carts that expired in their home shard, and forgets
+        their times to live. The next sweep is when there are twice as many carts with
+        parts or times to live as are left.
+        """
+        for shard in self.shards:
+            shard.expire_reservations()
+
+        with self.carts_lock:
+            cart_ids = set(self.cart_parts) | set(self.cart_ttls)
+        for cart_id in cart_ids:
+            home, home_id = self._home(cart_id)
+            if not self.shards[home].cart_alive(home_id):
+                self._drop_parts(cart_id)
+
+        with self.carts_lock:
+            self.sweep_at = max(64, 2 * (len(self.cart_parts) + len(self.cart_ttls)))
+
+    def add_to_cart(self, cart_id, product, timeout=0, quantity=None, priority=0):
+        """
+        Adds a product to the given cart, in the shard of the product.
+
+        :returns True or False, or the number of units added if quantity is given
+        """
+        shard = self._shard_of(product)
+        part = self._part(cart_id, shard, create=True)
+        if part is None:
+            return False if quantity is None else 0
+
+        return self.shards[shard].add_to_cart(part, product, timeout, quantity, priority)
+
+    def reserve(self, cart_id, items, timeout=0):
+        """
+        Adds several products to the given cart, all of them or none of them. Every
+        shard reserves its products at once, without waiting; if one of them can not,
+        the products reserved in the other shards are removed. Then only that shard
+        waits for its products, with what is left of the timeout, while no other shard
+        holds anything, and the others are tried again after it.
+
+        :type items: List
+        :param items: a list of (product, quantity) to add to cart
+
+        :returns True if every unit was added, False if none was
+        """
+        by_shard = {}
+        for product, quantity in items:
+            by_shard.setdefault(self._shard_of(product), []).append((product, quantity))
+
+        deadline = deadline_after(timeout, self.clock)
+        waited = None
+        while True:
+            # The shard that could not reserve last time goes first, and waits
+            order = sorted(by_shard, key=lambda shard: shard != waited)
+            reserved = []
+            missing = None
+            for shard in order:
+                part = self._part(cart_id, shard, create=True)
+                if part is None:
+                    missing = shard
+                    break
+                wait = time_left(deadline, self.clock) if shard == waited else 0
+                if not self.shards[shard].reserve(part, by_shard[shard], wait):
+                    missing = shard
+                    break
+                reserved.append((shard, part))
+
+            if missing is None:
+                return True
+
+            # Give back what the other shards reserved
+            for previous, previous_part in reserved:
+                for product, quantity in by_shard[previous]:
+                    self.shards[previous].remove_from_cart(previous_part, product,
+                                                           quantity=quantity)
+
+            # The cart is dead, the waiting shard timed out or there is no time to wait
+            if part is None or missing == waited or time_left(deadline, self.clock) == 0:
+                return False
+            waited = missing
+
+    def remove_from_cart(self, cart_id, product, quantity=None):
+        """
+        Removes a product from cart, in the shard of the product.
+
+        :returns None, or the number of units removed if quantity is given
+        """
+        shard = self._shard_of(product)
+        part = self._part(cart_id, shard, create=False)
+        if part is None:
+            return None if quantity is None else 0
+
+        return self.shards[shard].remove_from_cart(part, product, quantity)
+
+    def _drop_parts(self, cart_id):
+        """
+        Abandons the parts of a cart that is dead in its home shard.
+
+        :type cart_id: Int
+        :param cart_id: id cart
+        """
+        for shard, part in self._take_parts(cart_id)[1:]:
+            self.shards[shard].abandon_cart(part)
+
+    def _take_parts(self, cart_id):
+        """
+        Forgets the parts of a cart, and its time to live.
+
+        :rtype: List
+        :return: a (shard, cart id in the shard) for every part, the home one first
+        """
+        with self.carts_lock:
+            parts = self.cart_parts.pop(cart_id, {})
+            self.cart_ttls.pop(cart_id, None)
+
+        return [self._home(cart_id)] + list(parts.items())
+
+    def place_order(self, cart_id, name=None):
+        """
+        Places every part of the cart, and writes one receipt for all of them.
+
+        :type name: str
+        :param name: the name of the consumer on the receipt, the name of the current
+        thread by default
+
+        :returns the [product, producer id] elements of the cart, or False if the
+        cart_id is not valid
+        """
+        home = self._home(cart_id)
+        if home is None:
+            return False
+        if not self.shards[home[0]].cart_alive(home[1]):
+            self._drop_parts(cart_id)
+            return False
+
+        cart = []
+        for shard, part in self._take_parts(cart_id):
+            placed = self.shards[shard].place_order(part)
+            if placed is not False:
+                cart += placed
+
+        self.order_sink.emit(name if name is not None else current_thread().name, cart)
+        return cart
+
+    def abandon_cart(self, cart_id):
+        """
+        Puts every product in the cart back in its producer's queue, in every shard.
+
+        :returns True, or False if the cart_id is not valid
+        """
+        home = self._home(cart_id)
+        if home is None:
+            return False
+        if not self.shards[home[0]].cart_alive(home[1]):
+            self._drop_parts(cart_id)
+            return False
+
+        for shard, part in self._take_parts(cart_id):
+            self.shards[shard].abandon_cart(part)
+
+        return True
+
+    def cart_alive(self, cart_id):
+        """
+        Returns if a cart can still be used.
+
+        :rtype: bool
+        :return: True if the cart is live in its home shard
+        """
+        home = self._home(cart_id)
+        if home is None:
+            return False
+        if not self.shards[home[0]].cart_alive(home[1]):
+            self._drop_parts(cart_id)
+            return False
+
+        return True
+
+    def producer_queue(self, producer_id):
+        """
+        Returns the products in the producer's queues of all the shards.
+
+        :rtype: List
+        :return: a [product, quantity] list for every product the producer has in stock
+        """
+        queue = []
+        for shard in self.shards:
+            queue += shard.producer_queue(producer_id)
+
+        return queue
+
+
+class TestShardedMarketplace(unittest.TestCase):
+    """
+    Test class for the ShardedMarketplace class.
+    """
+    def setUp(self):
+        """
+        Setup the test.
+        """
+        self.sink = BufferSink()
+        self.marketplace = ShardedMarketplace(300, shards=3, log_level=logging.WARNING,
+                                              order_sink=self.sink)
+        self.products = ["product{}".format(index) for index in range(30)]
+
+    def test_products_are_spread(self):
+        """
+        Tests that every product lives in one shard and that all the shards are used.
+        """
+        market = self.marketplace
+        producer_id = market.register_producer()
+        for product in self.products:
+            self.assertTrue(market.publish(producer_id, product))
+
+        shards = {product: [index for index, shard in enumerate(market.shards)
+                            if shard.producer_queue(producer_id).count([product, 1])]
+                  for product in self.products}
+        self.assertTrue(all(len(found) == 1 for found in shards.values()))
+        self.assertEqual(len({found[0] for found in shards.values()}), 3)
+
+    def test_cart_across_shards(self):
+        """
+        Tests that a cart with products of every shard is placed as one order.
+        """
+        market = self.marketplace
+        producer_id = market.register_producer()
+        for product in self.products:
+            market.publish_many(producer_id, product, 2)
+
+        cart_ids = [market.new_cart() for _ in range(3)]
+        self.assertEqual([cart_id % 3 for cart_id in cart_ids], [0, 1, 2])
+
+        cart_id = cart_ids[1]
+        for product in self.products:
+            self.assertEqual(market.add_to_cart(cart_id, product, quantity=2), 2)
+        self.assertEqual(market.remove_from_cart(cart_id, self.products[0], quantity=1), 1)
+
+        order = market.place_order(cart_id, name="cons1")
+        self.assertEqual(sorted(element[0] for element in order),
+                         sorted(self.products * 2)[1:])
+        self.assertEqual(len(self.sink.lines), 59)
+        self.assertFalse(market.cart_alive(cart_id))
+        self.assertFalse(market.add_to_cart(cart_id, self.products[0]))
+        self.assertEqual(market.producer_queue(producer_id), [[self.products[0], 1]])
+
+    def test_reserve_across_shards(self):
+        """
+        Tests that a reservation missing a product in one shard gives back the others.
+        """
+        market = self.marketplace
+        producer_id = market.register_producer()
+        for product in self.products[1:]:
+            market.publish(producer_id, product)
+
+        cart_id = market.new_cart()
+        items = [(product, 1) for product in self.products]
+        self.assertFalse(market.reserve(cart_id, items))
+        self.assertEqual(len(market.producer_queue(producer_id)), 29)
+
+        market.publish(producer_id, self.products[0])
+        self.assertTrue(market.reserve(cart_id, items))
+        self.assertEqual(market.producer_queue(producer_id), [])
+        self.assertEqual(len(market.place_order(cart_id)), 30)
+
+    def test_reserve_waits_holding_nothing(self):
+        """
+        Tests that a reservation waits for the missing shard without holding the units
+        of the others, and that its timeout is for the whole reservation.
+        """
+        # pylint: disable=protected-access
+        market = self.marketplace
+        producer_id = market.register_producer()
+        by_shard = {}
+        for product in self.products:
+            by_shard.setdefault(market._shard_of(product), product)
+        present, missing, absent = by_shard[0], by_shard[1], by_shard[2]
+        market.publish(producer_id, present)
+
+        results = []
+        cart_id = market.new_cart()
+        waiter = Thread(target=lambda: results.append(
+            market.reserve(cart_id, [(present, 1), (missing, 1)], timeout=10)))
+        waiter.start()
+
+        # Verify that the present product stays in stock while the reservation waits
+        time.sleep(0.05)
+        self.assertEqual(market.producer_queue(producer_id), [[present, 1]])
+        market.publish(producer_id, missing)
+        waiter.join(5)
+        self.assertEqual(results, [True])
+        self.assertEqual(market.producer_queue(producer_id), [])
+
+        # Verify that a reservation that can not be done gives up after its timeout
+        market.publish(producer_id, present)
+        start = time.monotonic()
+        self.assertFalse(market.reserve(market.new_cart(),
+                                        [(present, 1), (missing, 1), (absent, 1)], 0.2))
+        self.assertLess(time.monotonic() - start, 0.35)
+        self.assertEqual(market.producer_queue(producer_id), [[present, 1]])
+
+    def test_queue_split_between_shards(self):
+        """
+        Tests that a producer's queue limit is for all the shards together.
+        """
+        market = ShardedMarketplace(6, shards=3, log_level=logging.WARNING,
+                                    order_sink=self.sink)
+        producer_id = market.register_producer()
+        published = sum(market.publish_many(producer_id, product, 10)
+                        for product in self.products)
+        self.assertEqual(published, 6)
+
+    def test_single_product_fills_queue(self):
+        """
+        Tests that a producer of a single product fills its whole queue in one shard,
+        and that a unit taken in one shard frees space for a publish waiting in another.
+        """
+        # pylint: disable=protected-access
+        market = ShardedMarketplace(6, shards=3, log_level=logging.WARNING,
+                                    order_sink=self.sink)
+        producer_id = market.register_producer()
+        sold = self.products[0]
+        other = next(product for product in self.products
+                     if market._shard_of(product) != market._shard_of(sold))
+        self.assertEqual(market.publish_many(producer_id, sold, 10), 6)
+        self.assertFalse(market.publish(producer_id, other))
+
+        results = []
+        waiter = Thread(target=lambda: results.append(
+            market.publish(producer_id, other, timeout=10)))
+        waiter.start()
+        self.assertTrue(market.add_to_cart(market.new_cart(), sold))
+        waiter.join(5)
+        self.assertEqual(results, [True])
+        self.assertEqual(market.budget.limits(), [6])
+
+        # Verify that the shards in processes can not split a queue smaller than them
+        with self.assertRaises(ValueError):
+            ShardedMarketplace(2, shards=3, processes=True)
+
+    def test_cart_time_to_live(self):
+        """
+        Tests that the time to live given to new_cart() is the one of every part of the cart.
+        """
+        # pylint: disable=protected-access
+        clock = VirtualClock()
+        market = ShardedMarketplace(300, shards=3, log_level=logging.WARNING,
+                                    order_sink=self.sink, clock=clock)
+        producer_id = market.register_producer()
+        cart_id = market.new_cart(reservation_ttl=5)
+        product = next(product for product in self.products
+                       if market._shard_of(product) != cart_id % 3)
+        market.publish(producer_id, product)
+        self.assertTrue(market.add_to_cart(cart_id, product))
+
+        # Verify that the part expires with the cart, and that the time to live is forgotten
+        clock.now = 10
+        self.assertEqual(market.shards[market._shard_of(product)].expire_reservations(), 1)
+        self.assertEqual(market.shards[cart_id % 3].expire_reservations(), 1)
+        self.assertEqual(market.producer_queue(producer_id), [[product, 1]])
+        self.assertFalse(market.cart_alive(cart_id))
+        self.assertEqual(market.cart_ttls, {})
+
+    def test_expired_cart_parts(self):
+        """
+        Tests that the parts of a cart that expired in its home shard are abandoned,
+        when the cart is used and by the sweep of new_cart().
+        """
+        # pylint: disable=protected-access
+        clock = VirtualClock()
+        market = ShardedMarketplace(300, shards=3, log_level=logging.WARNING,
+                                    order_sink=self.sink, clock=clock, reservation_ttl=5)
+        producer_id = market.register_producer()
+        for product in self.products:
+            market.publish_many(producer_id, product, 2)
+
+        cart_ids = [market.new_cart() for _ in range(2)]
+        for cart_id in cart_ids:
+            home = cart_id % 3
+            product = next(product for product in self.products
+                           if market._shard_of(product) != home)
+            self.assertTrue(market.add_to_cart(cart_id, product))
+        self.assertEqual(len(market.cart_parts), 2)
+
+        # Verify that the first cart's parts go when it is found dead, the second's by the sweep
+        clock.now = 10
+        home_product = next(product for product in self.products
+                            if market._shard_of(product) == cart_ids[0] % 3)
+        self.assertFalse(market.add_to_cart(cart_ids[0], home_product))
+        self.assertFalse(market.cart_alive(cart_ids[0]))
+        self.assertEqual(list(market.cart_parts), [cart_ids[1]])
+        market.sweep_at = 1
+        market.new_cart()
+        self.assertEqual(market.cart_parts, {})
+        self.assertEqual(sum(quantity for _, quantity in market.producer_queue(producer_id)), 60)
+
+    def test_shard_processes(self):
+        """
+        Tests the shards running in their own processes.
+        """
+        market = ShardedMarketplace(20, shards=2, processes=True, log_level=logging.WARNING,
+                                    order_sink=self.sink)
+        try:
+            producer_id = market.register_producer()
+            cart_id = market.new_cart()
+            for product in self.products[:4]:
+                self.assertEqual(market.publish_many(producer_id, product, 2), 2)
+                self.assertTrue(market.add_to_cart(cart_id, product))
+
+            self.assertEqual(sorted(element[0] for element in market.place_order(cart_id)),
+                             self.products[:4])
+            self.assertEqual(len(market.producer_queue(producer_id)), 4)
+        finally:
+            market.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
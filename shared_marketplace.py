@@ -0,0 +1,646 @@
+"""
+This module represents the multi-process Marketplace, with its inventory in shared memory.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+
+import itertools
+import multiprocessing
+from multiprocessing import shared_memory
+import os
+from threading import Lock
+import unittest
+
+from consumer import Consumer
+from marketplace import deadline_after, time_left, wait_for
+from order_sink import StdoutSink
+from producer import Producer
+
+# The size in bytes of a counter in the shared memory block
+COUNTER_SIZE = 8
+
+# The number of producers in a word of a holders bitmap
+WORD_BITS = COUNTER_SIZE * 8
+
+
+class SharedMarketplace:
+    """
+    Class that represents a Marketplace whose inventory can be used by several processes.
+
+    The products are interned to integer ids when the marketplace is created, so the
+    operations only move integers through shared memory and never pickle a product.
+    The shared memory block holds, as 64 bit counters:
+
+        [producers registered]
+        [total_producers_elements, one per producer]
+        [units in stock of each product, over all producers]
+        [units in stock, one row per producer and one column per product]
+        [holders bitmap of each product, one bit per producer that has it in stock]
+
+    Like the Marketplace, the products are split in stripes, and the locks are always
+    acquired in the order stock stripe lock -> producer lock. The locks are
+    multiprocessing locks, so the marketplace must be handed to the other processes
+    when they are created (as a Process argument or a Pool initializer argument).
+
+    The carts are private to the process that created them: only the inventory is shared.
+    A cart is released when its order is placed.
+    """
+    def __init__(self, queue_size_per_producer, products, max_producers=64, stock_stripes=16,
+                 order_sink_factory=StdoutSink):
+        """
+        Constructor
+
+        :type queue_size_per_producer: Int
+        :param queue_size_per_producer: the maximum size of a queue associated with each producer
+
+        :type products: List
+        :param products: every product that can be published in the marketplace
+
+        :type max_producers: Int
+        :param max_producers: the maximum number of producers that can register
+
+        :type stock_stripes: Int
+        :param stock_stripes: the number of independently locked stripes of the inventory
+
+        :type order_sink_factory: Callable
+        :param order_sink_factory: creates the OrderSink of every process, where the orders
+        placed by that process are written
+        """
+        # Initialize the Marketplace
+        self.queue_size_per_producer = queue_size_per_producer
+        self.max_producers = max_producers
+        self.order_sink_factory = order_sink_factory
+
+        # Intern the products: id -> product and product -> id
+        self.catalog = list(dict.fromkeys(products))
+        self.product_ids = {product: product_id for product_id, product
+                            in enumerate(self.catalog)}
+
+        # Create the shared memory block, filled with zeros
+        self.holder_words = (max_producers + WORD_BITS - 1) // WORD_BITS
+        counters = (1 + max_producers + len(self.catalog) + max_producers * len(self.catalog)
+                    + len(self.catalog) * self.holder_words)
+        self.shm = shared_memory.SharedMemory(create=True, size=counters * COUNTER_SIZE)
+        self.shm.buf[:] = bytes(len(self.shm.buf))
+
+        # Remember the process that owns the block. With fork, the other processes
+        # receive this object without pickling it
+        self.owner_pid = os.getpid()
+
+        # Initialize the lock for registering producers
+        self.producers_lock = multiprocessing.Lock()
+
+        # Initialize the lock of every producer's queue and the condition used to wait
+        # for free space in it
+        self.producer_locks = [multiprocessing.Lock() for _ in range(max_producers)]
+        self.capacity_conditions = [multiprocessing.Condition(lock)
+                                    for lock in self.producer_locks]
+
+        # Initialize the lock of every stripe and the condition used to wait for its products
+        self.stripe_locks = [multiprocessing.Lock() for _ in range(stock_stripes)]
+        self.stock_conditions = [multiprocessing.Condition(lock) for lock in self.stripe_locks]
+
+        self._attach()
+
+    def _attach(self):
+        """
+        Initializes the views of the shared memory block and the carts of this process.
+        """
+        counters = self.shm.buf.cast('q')
+        products = len(self.catalog)
+        holders = 1 + self.max_producers + products + self.max_producers * products
+
+        # Split the shared memory block in its parts. The bitmaps are unsigned
+        self.producers_count = counters[0:1]
+        self.total_producers_elements = counters[1:1 + self.max_producers]
+        self.available = counters[1 + self.max_producers:1 + self.max_producers + products]
+        self.stock = counters[1 + self.max_producers + products:holders]
+        self.counters = counters
+        self.words = self.shm.buf.cast('Q')
+        self.holders = self.words[holders:]
+
+        # Initialize the sink of the orders placed by this process
+        self.order_sink = self.order_sink_factory()
+
+        # Initialize the live carts of this process and their locks, by cart id
+        self.consumers_carts = {}
+        self.cart_locks = {}
+        self.cart_ids = itertools.count()
+        self.consumers_carts_lock = Lock()
+
+    def __getstate__(self):
+        """
+        Returns what is sent to another process: the name of the shared memory block,
+        the locks and the catalog, but not the carts.
+        """
+        state = dict(self.__dict__)
+        for name in ('shm', 'counters', 'producers_count', 'total_producers_elements',
+                     'available', 'stock', 'words', 'holders', 'consumers_carts', 'cart_locks',
+                     'cart_ids', 'consumers_carts_lock', 'order_sink'):
+            del state[name]
+        state['shm_name'] = self.shm.name
+        return state
+
+    def __setstate__(self, state):
+        """
+        Attaches to the shared memory block in another process.
+        """
+        shm_name = state.pop('shm_name')
+        self.__dict__.update(state)
+        self.shm = shared_memory.SharedMemory(name=shm_name)
+        self._attach()
+
+    def close(self):
+        """
+        Detaches this process from the shared memory block. The process that created
+        the marketplace also frees the block.
+        """
+        for view in (self.producers_count, self.total_producers_elements, self.available,
+                     self.stock, self.counters, self.holders, self.words):
+            view.release()
+        self.shm.close()
+        self.order_sink.close()
+
+        if os.getpid() == self.owner_pid:
+            self.shm.unlink()
+
+    def register_producer(self):
+        """
+        Returns an id for the producer that calls this.
+        """
+        # Acquire the lock for registering producers
+        with self.producers_lock:
+            producer_id = self.producers_count[0]
+            if producer_id >= self.max_producers:
+                raise ValueError("no more than {} producers can register"
+                                 .format(self.max_producers))
+
+            self.producers_count[0] = producer_id + 1
+
+        return producer_id
+
+    def publish(self, producer_id, product, timeout=0):
+        """
+        Adds the product provided by the producer to the marketplace
+
+        :type producer_id: Int
+        :param producer_id: producer id
+
+        :type product: Product
+        :param product: the Product that will be published in the Marketplace
+
+        :type timeout: Float
+        :param timeout: the number of seconds to wait for free space in the producer's queue.
+        0 does not wait, None waits until there is space
+
+        :returns True or False. If the caller receives False, it should wait and then try again.
+        """
+        return self.publish_many(producer_id, product, 1, timeout) == 1
+
+    def publish_many(self, producer_id, product, quantity, timeout=0):
+        """
+        Adds up to quantity units of the product provided by the producer to the marketplace.
+
+        :type producer_id: Int
+        :param producer_id: producer id
+
+        :type product: Product
+        :param product: the Product that will be published in the Marketplace
+
+        :type quantity: Int
+        :param quantity: the number of units to publish
+
+        :type timeout: Float
+        :param timeout: the number of seconds to wait for free space in the producer's queue.
+        0 does not wait, None waits until there is space
+
+        :returns the number of units published
+        """
+        product_id = self.product_ids.get(product)
+
+        # Check if producer_id and the product are valid
+        if (product_id is None or producer_id < 0 or producer_id >= self.producers_count[0]
+                or quantity <= 0):
+            return 0
+
+        stripe = product_id % len(self.stripe_locks)
+        producer_lock = self.producer_locks[producer_id]
+        deadline = deadline_after(timeout)
+
+        def free_space():
+            return self.queue_size_per_producer - self.total_producers_elements[producer_id]
+
+        while True:
+            # Acquire the lock for the product's stripe and for the producer's queue
+            with self.stripe_locks[stripe], producer_lock:
+                published = min(quantity, free_space())
+                if published > 0:
+                    self._move(producer_id, product_id, published)
+
+                    # Wake up the consumers waiting for stock
+                    self.stock_conditions[stripe].notify_all()
+                    return published
+
+            # Wait for free space, holding only the lock of the producer's queue
+            with producer_lock:
+                if not wait_for(self.capacity_conditions[producer_id],
+                                lambda: free_space() > 0, time_left(deadline)):
+                    return 0
+
+    def new_cart(self):
+        """
+        Creates a new cart for the consumer, private to this process
+
+        :returns an int representing the cart_id
+        """
+        # Acquire the lock for the costumer's cart list
+        with self.consumers_carts_lock:
+            cart_id = next(self.cart_ids)
+            self.cart_locks[cart_id] = Lock()
+            self.consumers_carts[cart_id] = {}
+            return cart_id
+
+    def add_to_cart(self, cart_id, product, timeout=0, quantity=None):
+        """
+        Adds a product to the given cart.
+
+        :type cart_id: Int
+        :param cart_id: id cart
+
+        :type product: Product
+        :param product: the product to add to cart
+
+        :type timeout: Float
+        :param timeout: the number of seconds to wait for the product to be published.
+        0 does not wait, None waits until the product is in stock
+
+        :type quantity: Int
+        :param quantity: the number of units to add. If it is given, the method returns
+        the number of units added instead of True or False
+
+        :returns True or False. If the caller receives False, it should wait and then try again
+        """
+        wanted = 1 if quantity is None else quantity
+        product_id = self.product_ids.get(product)
+        added = 0
+
+        # Check if the cart_id and the product are valid
+        if cart_id in self.consumers_carts and product_id is not None and wanted > 0:
+            added = self._add_to_cart(cart_id, product_id, wanted, timeout)
+
+        if quantity is None:
+            return added == 1
+
+        return added
+
+    def _add_to_cart(self, cart_id, product_id, quantity, timeout):
+        """
+        Moves up to quantity units of the product from the producers' queues to the cart.
+
+        :type cart_id: Int
+        :param cart_id: id cart
+
+        :type product_id: Int
+        :param product_id: the id of the product
+
+        :type quantity: Int
+        :param quantity: the number of units to add
+
+        :type timeout: Float
+        :param timeout: the number of seconds to wait for the product to be published
+
+        :rtype: Int
+        :return: the number of units added
+        """
+        stripe = product_id % len(self.stripe_locks)
+        taken = []
+        cart_lock = self.cart_locks.get(cart_id)
+        if cart_lock is None:
+            return 0
+
+        # Acquire the lock for the cart and for the product's stripe
+        with cart_lock, self.stripe_locks[stripe]:
+            # Check if the cart was placed in the meantime
+            if cart_id not in self.consumers_carts:
+                return 0
+
+            # Check if the product is in stock and wait for it to be published
+            if not wait_for(self.stock_conditions[stripe],
+                            lambda: self.available[product_id] > 0, timeout):
+                return 0
+
+            # Take the product from the producers that have it in stock, the lowest id
+            # first, without looking at the others
+            row_size = len(self.catalog)
+            for producer_index in self._holders(product_id):
+                if quantity == 0:
+                    break
+
+                count = min(quantity, self.stock[producer_index * row_size + product_id])
+
+                # Acquire the lock for the producer's queue
+                with self.producer_locks[producer_index]:
+                    self._move(producer_index, product_id, -count)
+
+                    # Wake up the producer waiting for free space in its queue
+                    self.capacity_conditions[producer_index].notify_all()
+
+                taken.append((producer_index, count))
+                quantity -= count
+
+            # Add it to cart, counting the units of every producer
+            lines = self.consumers_carts[cart_id].setdefault(product_id, {})
+            for producer_index, count in taken:
+                lines[producer_index] = lines.get(producer_index, 0) + count
+
+        return sum(count for _, count in taken)
+
+    def remove_from_cart(self, cart_id, product, quantity=None):
+        """
+        Removes a product from cart.
+
+        :type cart_id: Int
+        :param cart_id: id cart
+
+        :type product: Product
+        :param product: the product to remove from cart
+
+        :type quantity: Int
+        :param quantity: the number of units to remove. If it is given, the method returns
+        the number of units removed
+        """
+        wanted = 1 if quantity is None else quantity
+        product_id = self.product_ids.get(product)
+        removed = 0
+
+        # Check if the cart_id and the product are valid
+        cart_lock = self.cart_locks.get(cart_id)
+        if cart_lock is not None and product_id is not None and wanted > 0:
+            stripe = product_id % len(self.stripe_locks)
+
+            # Acquire the lock for the cart
+            with cart_lock:
+                cart = self.consumers_carts.get(cart_id, {})
+                lines = cart.get(product_id, {})
+
+                # Take the first units of the product out of the cart, with their producers
+                returned = {}
+                for producer_index in list(lines):
+                    count = min(wanted - removed, lines[producer_index])
+                    returned[producer_index] = count
+                    removed += count
+
+                    if count == lines[producer_index]:
+                        del lines[producer_index]
+                    else:
+                        lines[producer_index] -= count
+
+                    if removed == wanted:
+                        break
+
+                if not lines:
+                    cart.pop(product_id, None)
+
+                # Add the product back to the producers' queues
+                if returned:
+                    with self.stripe_locks[stripe]:
+                        for producer_index, count in returned.items():
+                            with self.producer_locks[producer_index]:
+                                self._move(producer_index, product_id, count)
+
+                        # Wake up the consumers waiting for stock
+                        self.stock_conditions[stripe].notify_all()
+
+        if quantity is None:
+            return None
+
+        return removed
+
+    def place_order(self, cart_id):
+        """
+        Return a list with all the products in the cart, and releases the cart.
+
+        :type cart_id: Int
+        :param cart_id: id cart
+        """
+        # Check if the cart_id is valid
+        cart_lock = self.cart_locks.get(cart_id)
+        if cart_lock is None:
+            return False
+
+        # Acquire the lock for the cart, and release the cart
+        with cart_lock:
+            lines_by_product = self.consumers_carts.pop(cart_id, None)
+            if lines_by_product is None:
+                return False
+            with self.consumers_carts_lock:
+                del self.cart_locks[cart_id]
+
+            cart = [[self.catalog[product_id], producer_index]
+                    for product_id, lines in lines_by_product.items()
+                    for producer_index, count in lines.items()
+                    for _ in range(count)]
+
+        # Write the receipt, after releasing the lock
+        self.order_sink.emit(multiprocessing.current_process().name, cart)
+
+        return cart
+
+    def cart_alive(self, cart_id):
+        """
+        Returns if a cart can be used. The carts of this marketplace never expire, they
+        are only released by place_order().
+
+        :type cart_id: Int
+        :param cart_id: id cart
+
+        :rtype: bool
+        :return: True if the cart_id is valid and its order was not placed
+        """
+        return cart_id in self.consumers_carts
+
+    def _holders(self, product_id):
+        """
+        Returns the producers that have the product in stock, from its holders bitmap.
+        The lock of the product's stripe must be held by the caller.
+
+        :type product_id: Int
+        :param product_id: the id of the product
+
+        :rtype: Iterator
+        :return: the producer ids, the lowest first
+        """
+        first = product_id * self.holder_words
+        for index in range(self.holder_words):
+            word = self.holders[first + index]
+            while word:
+                lowest = word & -word
+                yield index * WORD_BITS + lowest.bit_length() - 1
+                word ^= lowest
+
+    def _move(self, producer_id, product_id, quantity):
+        """
+        Adds units of the product to the producer's queue, or removes them if quantity
+        is negative. The locks of the stripe and of the producer's queue must be held by
+        the caller.
+
+        :type producer_id: Int
+        :param producer_id: the producer that owns the queue
+
+        :type product_id: Int
+        :param product_id: the id of the product
+
+        :type quantity: Int
+        :param quantity: the number of units to add
+        """
+        index = producer_id * len(self.catalog) + product_id
+        before = self.stock[index]
+        self.stock[index] = before + quantity
+        self.available[product_id] += quantity
+        self.total_producers_elements[producer_id] += quantity
+
+        # Flip the producer's bit when it gets the product or runs out of it
+        if (before > 0) != (before + quantity > 0):
+            word = product_id * self.holder_words + producer_id // WORD_BITS
+            self.holders[word] ^= 1 << producer_id % WORD_BITS
+
+
+# The marketplace of a pool worker, set by attach_worker()
+WORKER_MARKETPLACE = None
+
+
+def attach_worker(marketplace):
+    """
+    Pool initializer that remembers the marketplace in a worker process.
+
+    :type marketplace: SharedMarketplace
+    :param marketplace: the marketplace received when the worker was created
+    """
+    global WORKER_MARKETPLACE  # pylint: disable=global-statement
+    WORKER_MARKETPLACE = marketplace
+
+
+def run_consumer(carts, retry_wait_time):
+    """
+    Runs a Consumer's carts in a pool worker, against the worker's marketplace.
+
+    :type carts: List
+    :param carts: a list of add and remove operations
+
+    :type retry_wait_time: Time
+    :param retry_wait_time: the number of seconds that a consumer must wait
+    until the Marketplace becomes available
+    """
+    name = multiprocessing.current_process().name
+    Consumer(carts, WORKER_MARKETPLACE, retry_wait_time, name=name).run()
+
+
+def run_producer(marketplace, products, republish_wait_time):
+    """
+    Runs a Producer forever in the current process. It is meant as the target of a Process.
+
+    :type marketplace: SharedMarketplace
+    :param marketplace: the marketplace
+
+    :type products: List()
+    :param products: a list of products that the producer will produce
+
+    :type republish_wait_time: Time
+    :param republish_wait_time: the number of seconds that a producer must
+    wait until the marketplace becomes available
+    """
+    Producer(products, marketplace, republish_wait_time).run()
+
+
+class TestSharedMarketplace(unittest.TestCase):
+    """
+    Test class for the SharedMarketplace class.
+    """
+    def setUp(self):
+        """
+        Setup the test.
+        """
+        self.marketplace = SharedMarketplace(3, ["product1", "product2"], max_producers=4)
+
+    def tearDown(self):
+        """
+        Frees the shared memory.
+        """
+        self.marketplace.close()
+
+    def test_publish_and_add_to_cart(self):
+        """
+        Tests publishing and adding to a cart, with the queue limit.
+        """
+        market = self.marketplace
+        producer_id = market.register_producer()
+
+        self.assertEqual(market.publish_many(producer_id, "product1", 5), 3)
+        self.assertFalse(market.publish(producer_id, "product2"))
+        self.assertFalse(market.publish(producer_id, "unknown"))
+
+        cart_id = market.new_cart()
+        self.assertEqual(market.add_to_cart(cart_id, "product1", quantity=2), 2)
+        self.assertEqual(market.total_producers_elements[producer_id], 1)
+
+        market.remove_from_cart(cart_id, "product1")
+        self.assertEqual(market.place_order(cart_id), [["product1", producer_id]])
+        self.assertEqual(market.available[0], 2)
+
+    def test_holders_and_released_carts(self):
+        """
+        Tests that the units are taken from the holders of the product, the lowest id
+        first, and that a placed cart is released.
+        """
+        # pylint: disable=protected-access
+        market = SharedMarketplace(3, ["product1", "product2"], max_producers=130)
+        try:
+            producer_ids = [market.register_producer() for _ in range(130)]
+            for producer_id in (129, 65):
+                market.publish(producer_ids[producer_id], "product1")
+            self.assertEqual(list(market._holders(0)), [65, 129])
+
+            cart_id = market.new_cart()
+            self.assertEqual(market.add_to_cart(cart_id, "product1", quantity=3), 2)
+            self.assertEqual(list(market.holders), [0] * 6)
+            self.assertEqual(market.place_order(cart_id), [["product1", 65], ["product1", 129]])
+
+            # Verify that the placed cart can not be used again and is forgotten
+            self.assertFalse(market.cart_alive(cart_id))
+            self.assertFalse(market.add_to_cart(cart_id, "product1"))
+            self.assertFalse(market.place_order(cart_id))
+            self.assertEqual((market.consumers_carts, market.cart_locks), ({}, {}))
+        finally:
+            market.close()
+
+    def test_other_process(self):
+        """
+        Tests that a product published by another process can be added to a cart.
+        """
+        market = self.marketplace
+        process = multiprocessing.Process(target=_publish_one, args=(market,))
+        process.start()
+
+        cart_id = market.new_cart()
+        self.assertTrue(market.add_to_cart(cart_id, "product2", timeout=10))
+        process.join(10)
+
+        self.assertEqual(market.total_producers_elements[0], 0)
+
+
+def _publish_one(marketplace):
+    """
+    Publishes one product2 from another process.
+
+    :type marketplace: SharedMarketplace
+    :param marketplace: the marketplace
+    """
+    producer_id = marketplace.register_producer()
+    marketplace.publish(producer_id, "product2")
+    marketplace.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,325 @@
+"""
+This module offers the streaming loaders of the JSON lines workload files.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+
+import dataclasses
+import json
+import os
+import shutil
+import tempfile
+from threading import Lock
+import unittest
+
+from product import Coffee, Product, Tea
+
+# The product classes by the name written in the files
+PRODUCT_TYPES = {'Product': Product, 'Tea': Tea, 'Coffee': Coffee}
+
+
+def product_spec(product):
+    """
+    Returns the fields of a product, as written in the workload files.
+
+    :type product: Product
+    :param product: the product
+
+    :rtype: Dict
+    :return: the product type and the fields of the product
+    """
+    spec = {'product_type': type(product).__name__}
+    spec.update(dataclasses.asdict(product))
+    return spec
+
+
+class ProductCache:
+    """
+    Class that turns the products of the workload files into Product objects. Equal
+    products are built once and shared, and the products defined by an id line are
+    found by their id. One cache can be shared by all the streams of a workload.
+    """
+    def __init__(self):
+        """
+        Constructor
+        """
+        # Initialize the lock for adding products
+        self.lock = Lock()
+
+        # Initialize id -> product and fields -> product
+        self.by_id = {}
+        self.by_spec = {}
+
+    def define(self, product_id, spec):
+        """
+        Gives an id to a product.
+
+        :type product_id: str
+        :param product_id: the id used by the other lines
+
+        :type spec: Dict
+        :param spec: the product type and the fields of the product
+        """
+        product = self.intern(spec)
+        with self.lock:
+            self.by_id[product_id] = product
+
+    def intern(self, spec):
+        """
+        Returns the product with the given fields, building it if it was never seen.
+
+        :type spec: Dict
+        :param spec: the product type and the fields of the product
+
+        :rtype: Product
+        :return: the product
+        """
+        key = tuple(sorted((name, value) for name, value in spec.items() if name != 'id'))
+        product = self.by_spec.get(key)
+        if product is None:
+            with self.lock:
+                product = self.by_spec.get(key)
+                if product is None:
+                    fields = {name: value for name, value in key if name != 'product_type'}
+                    product = PRODUCT_TYPES[spec['product_type']](**fields)
+                    self.by_spec[key] = product
+
+        return product
+
+    def get(self, reference):
+        """
+        Returns the product a line refers to.
+
+        :type reference: str or Dict
+        :param reference: the id of a defined product, or the fields of a product
+
+        :rtype: Product
+        :return: the product
+        """
+        if isinstance(reference, dict):
+            return self.intern(reference)
+
+        try:
+            return self.by_id[reference]
+        except KeyError:
+            raise KeyError("product {!r} is used before it is defined".format(reference)) from None
+
+
+class _JsonLinesStream:
+    """
+    Class that reads a JSON lines file one line at a time, every time it is iterated.
+    A line with an id and a product_type defines a product; the other lines are
+    turned into items by _parse().
+    """
+    def __init__(self, path, cache=None):
+        """
+        Constructor
+
+        :type path: str
+        :param path: the JSON lines file
+
+        :type cache: ProductCache
+        :param cache: the products shared with the other streams, a new one by default
+        """
+        self.path = path
+        self.cache = cache if cache is not None else ProductCache()
+
+    def __iter__(self):
+        with open(self.path, encoding='utf-8') as lines:
+            for line in lines:
+                if not line.strip():
+                    continue
+
+                record = json.loads(line)
+                if isinstance(record, dict) and 'id' in record and 'product_type' in record:
+                    self.cache.define(record['id'], record)
+                else:
+                    yield self._parse(record)
+
+    def _parse(self, record):
+        """
+        Turns a line into an item of the stream.
+
+        :type record: List or Dict
+        :param record: the decoded line
+        """
+        raise NotImplementedError
+
+
+class CartStream(_JsonLinesStream):
+    """
+    Stream of the carts of a consumer, to give to a Consumer instead of a list. Every
+    line is a cart: a list of {"type", "product", "quantity"} operations, where the
+    product is the id of a defined product or its fields. Only the current cart is in
+    memory, so the first cart starts before the file is read.
+    """
+    def _parse(self, record):
+        return [{'type': operation['type'],
+                 'product': self.cache.get(operation['product']),
+                 'quantity': operation['quantity']}
+                for operation in record]
+
+
+class ProductionStream(_JsonLinesStream):
+    """
+    Stream of the products of a producer, to give to a Producer instead of a list.
+    Every line is a [product, quantity, sleep time] list, where the product is the id
+    of a defined product or its fields. The Producer iterates it again every round,
+    reading the file again.
+    """
+    def _parse(self, record):
+        product, quantity, sleep_time = record
+        return self.cache.get(product), quantity, sleep_time
+
+
+def _write_lines(path, records):
+    """
+    Writes the lines of a workload file. Every product gets an id line before its
+    first use.
+
+    :type path: str
+    :param path: the file
+
+    :type records: Iterable
+    :param records: the lines, with Product objects in place of the product references
+    """
+    ids = {}
+    with open(path, 'w', encoding='utf-8') as lines:
+        def reference(product):
+            product_id = ids.get(product)
+            if product_id is None:
+                product_id = ids[product] = "id{}".format(len(ids) + 1)
+                spec = product_spec(product)
+                spec['id'] = product_id
+                lines.write(json.dumps(spec) + "\n")
+            return product_id
+
+        for record in records:
+            lines.write(json.dumps(record(reference)) + "\n")
+
+
+def write_carts(path, carts):
+    """
+    Writes the carts of a consumer as a file read by CartStream.
+
+    :type path: str
+    :param path: the file
+
+    :type carts: Iterable
+    :param carts: the carts, in the format taken by Consumer
+    """
+    def cart_record(cart):
+        return lambda reference: [{'type': operation['type'],
+                                   'product': reference(operation['product']),
+                                   'quantity': operation['quantity']}
+                                  for operation in cart]
+
+    _write_lines(path, (cart_record(cart) for cart in carts))
+
+
+def write_production(path, products):
+    """
+    Writes the products of a producer as a file read by ProductionStream.
+
+    :type path: str
+    :param path: the file
+
+    :type products: Iterable
+    :param products: the (product, quantity, sleep time) tuples, in the format taken by Producer
+    """
+    def production_record(product, quantity, sleep_time):
+        return lambda reference: [reference(product), quantity, sleep_time]
+
+    _write_lines(path, (production_record(*item) for item in products))
+
+
+class TestWorkload(unittest.TestCase):
+    """
+    Class that tests the workload streams.
+    """
+    def setUp(self):
+        """
+        Setup the test.
+        """
+        self.directory = tempfile.mkdtemp()
+        self.tea = Tea("Linden", 9, "Herbal")
+        self.coffee = Coffee("Indonezia", 1, "5.05", "MEDIUM")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_round_trip_shares_products(self):
+        """
+        Tests that written carts are read back, with one object for equal products.
+        """
+        carts = [[{'type': 'add', 'product': self.tea, 'quantity': 2},
+                  {'type': 'remove', 'product': self.tea, 'quantity': 1}],
+                 [{'type': 'add', 'product': self.coffee, 'quantity': 3}]]
+        path = os.path.join(self.directory, "cons1.jsonl")
+        write_carts(path, carts)
+
+        stream = CartStream(path)
+        self.assertEqual(list(stream), carts)
+        self.assertEqual(list(stream), carts)
+
+        first, second = next(iter(stream))
+        self.assertIs(first['product'], second['product'])
+
+    def test_inline_products(self):
+        """
+        Tests that products written inline and by id share the cache of the streams.
+        """
+        path = os.path.join(self.directory, "prod1.jsonl")
+        with open(path, 'w', encoding='utf-8') as lines:
+            lines.write(json.dumps([product_spec(self.tea), 2, 0.1]) + "\n\n")
+            lines.write(json.dumps(dict(product_spec(self.coffee), id="id1")) + "\n")
+            lines.write(json.dumps(["id1", 1, 0]) + "\n")
+
+        cache = ProductCache()
+        self.assertEqual(list(ProductionStream(path, cache)),
+                         [(self.tea, 2, 0.1), (self.coffee, 1, 0)])
+        self.assertIs(cache.get(product_spec(self.tea)), cache.get(product_spec(self.tea)))
+
+    def test_undefined_product(self):
+        """
+        Tests that a product used before its id line is an error.
+        """
+        path = os.path.join(self.directory, "cons1.jsonl")
+        with open(path, 'w', encoding='utf-8') as lines:
+            lines.write(json.dumps([{'type': 'add', 'product': "id7", 'quantity': 1}]) + "\n")
+
+        with self.assertRaises(KeyError):
+            list(CartStream(path))
+
+    def test_feeds_producer_and_consumer(self):
+        """
+        Tests that a Producer and a Consumer run from the streams.
+        """
+        # pylint: disable=import-outside-toplevel
+        from clock import VirtualClock
+        from consumer import Consumer
+        from marketplace import Marketplace
+        from order_sink import BufferSink
+        from producer import Producer
+
+        cache = ProductCache()
+        production = os.path.join(self.directory, "prod1.jsonl")
+        write_production(production, [(self.tea, 2, 0), (self.coffee, 1, 0)])
+        carts = os.path.join(self.directory, "cons1.jsonl")
+        write_carts(carts, ([{'type': 'add', 'product': self.tea, 'quantity': 2},
+                             {'type': 'add', 'product': self.coffee, 'quantity': 1}]
+                            for _ in range(5)))
+
+        # The Producer publishes forever: the simulation stops it when the Consumer is
+        # done, and joins it, so it does not read the file after the directory is removed
+        clock = VirtualClock()
+        sink = BufferSink()
+        market = Marketplace(3, order_sink=sink, clock=clock)
+        producer = Producer(ProductionStream(production, cache), market, 0.01)
+        consumer = Consumer(CartStream(carts, cache), market, 0.01, name="cons1")
+        clock.run([producer, consumer], finish=[consumer])
+
+        self.assertFalse(producer.is_alive())
+        self.assertEqual(len(sink.lines), 15)